@@ -236,4 +236,8 @@ def init_models():
 
     # print_critical(shared.models)
     init_character_models()
-    import modules.utils.character # init waic
\ No newline at end of file
+    from modules.utils.character import waic
+    waic.prepare_index()
+    # LoRA 索引は裏で走査しておく (API のハンドラで初回の走査を待たせない)
+    from modules.utils.lora_index import lora_index
+    lora_index.refresh(wait=False)
\ No newline at end of file
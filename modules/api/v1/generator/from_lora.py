@@ -1,4 +1,6 @@
+import asyncio
 import json
+import os
 import random
 import re
 from pydantic import BaseModel
@@ -8,6 +10,7 @@ from fastapi import status
 from fastapi.responses import JSONResponse
 from logger import *
 from modules.utils.lora_util import find_lora, get_tag_freq_from_lora, read_lora_name
+from modules.utils.lora_index import lora_index
 
 class _GetPromptFromLoRA(BaseModel):
   lora_name: List[str]
@@ -205,6 +208,11 @@ async def generate_prompt_from_lora_v11(rq: _GeneratePromptFromLoRA):
 async def get_lora_names(rq: _GetPromptFromLoRA):
   lora_names = []
   for lora_name in rq.lora_name:
+    # sqlite の読み出し (初回は走査も) はイベントループを止めないようスレッドで行う
+    indexed = await asyncio.to_thread(lora_index.get, lora_name) if os.path.basename(lora_name) == lora_name else None
+    if indexed is not None:
+      lora_names.append(indexed["name"] if indexed["loadable"] else "")
+      continue
     lora_name = await read_lora_name(lora_name, allow_none=True)
     if lora_name is None:
       warn("Unknown LoRA name:", lora_name)
@@ -219,10 +227,32 @@ async def get_lora_names(rq: _GetPromptFromLoRA):
   )
 
 
+class _SearchLoRA(BaseModel):
+  query: str = ""
+  tags: List[str] = []
+  with_tags: bool = False
+  limit: int = 100
 
-
-
-
-
-
-
+@app.post("/v1/items/lora/search")
+async def search_lora(rq: _SearchLoRA):
+  """
+  LoRA 索引から名前 (部分一致) とタグ (すべて含む) で検索する
+  """
+  items = await asyncio.to_thread(lora_index.search, rq.query, rq.tags, rq.with_tags, rq.limit)
+  return JSONResponse(
+    {
+      "success": True,
+      "items": [
+        {
+          "file": item["fn"],
+          "name": item["name"],
+          "base_model": item["base_model"],
+          "has_tags": bool(item["has_tags"]),
+          "model_hash": item["model_hash"],
+          "preview": item["preview"],
+        }
+        for item in items
+      ]
+    },
+    status.HTTP_200_OK
+  )
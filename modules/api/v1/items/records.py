@@ -0,0 +1,79 @@
+import json
+from pydantic import BaseModel
+from shared import app
+from typing import *
+from fastapi import status
+from fastapi.responses import JSONResponse, StreamingResponse
+from modules.calculator.records import RecordQuery, decode_cursor, expand_record, iter_page_records, query_page
+from modules.calculator.save import generation_log
+
+class _QueryRecords(BaseModel):
+  start: Optional[float] = None # UNIX 秒 (含む)
+  end: Optional[float] = None # UNIX 秒 (含まない)
+  scripts: List[str] = [] # template (sdpem/lora など) のどれか
+  ratings: List[str] = [] # perfect / ok / bad / worst / undefined のどれか
+  end_types: List[str] = []
+  loras: List[str] = [] # すべて使っているもの
+  tags: List[str] = [] # ポジティブプロンプトにすべて含むもの
+  raw: bool = False # 保存したままの形 (短いキー) で返す
+  limit: int = 100
+  cursor: Optional[str] = None
+
+def _build_query(rq: _QueryRecords) -> RecordQuery:
+  return RecordQuery(
+    start=rq.start, end=rq.end, scripts=rq.scripts, ratings=rq.ratings,
+    end_types=rq.end_types, loras=rq.loras, tags=rq.tags,
+  )
+
+def _invalid(e: ValueError) -> JSONResponse:
+  return JSONResponse(
+    {"success": False, "message": str(e)},
+    status.HTTP_422_UNPROCESSABLE_ENTITY,
+    media_type="application/json"
+  )
+
+# 展開・decode は同期処理なので def にしてスレッドプールで動かす
+@app.post("/v1/items/records/query")
+def query_records(rq: _QueryRecords):
+  """
+  生成ログを条件で絞り込み、limit 件ずつ返す (続きは next_cursor を cursor に渡す)
+  """
+  if rq.limit < 1:
+    return _invalid(ValueError("Limit must be at least 1"))
+  try:
+    query = _build_query(rq)
+    log = generation_log()
+    items, next_cursor = query_page(query, rq.limit, rq.cursor, log)
+  except ValueError as e:
+    return _invalid(e)
+  return JSONResponse(
+    {
+      "success": True,
+      "items": items if rq.raw else [expand_record(r, log) for r in items],
+      "next_cursor": next_cursor,
+    },
+    status.HTTP_200_OK
+  )
+
+@app.post("/v1/items/records/stream")
+def stream_records(rq: _QueryRecords):
+  """
+  生成ログを条件で絞り込み、NDJSON (1 行 1 件) で流す。limit は無視して最後まで返す。
+  各行の "cursor" を /v1/items/records/query に渡せば、途切れたところから続けられる。
+  """
+  try:
+    query = _build_query(rq)
+    # カーソルの形式はここで確かめておく (ストリームが始まってからではエラーを返せない)
+    if rq.cursor:
+      decode_cursor(rq.cursor)
+    log = generation_log()
+    records = iter_page_records(query, rq.cursor, log)
+  except ValueError as e:
+    return _invalid(e)
+
+  def lines() -> Iterator[str]:
+    for record, cursor in records:
+      item = record if rq.raw else expand_record(record, log)
+      yield json.dumps({"record": item, "cursor": cursor}, ensure_ascii=False) + "\n"
+
+  return StreamingResponse(lines(), media_type="application/x-ndjson")
@@ -0,0 +1,172 @@
+"""
+Blacklist filtering benchmark (BlacklistMatcher vs. one regex call per pattern)
+
+Usage:
+  python modules/benchmark_blacklist.py [--patterns 100,1000,5000] [--pieces 40] [--prompts 200] [--json]
+
+リテラル 9 割 / 正規表現 1 割のブラックリストと、リテラル・パターン両方の filter rule を生成し、
+同じプロンプト群に対して以前の方式 (piece × pattern の search と rule ごとのプロンプト再走査) と
+BlacklistFilterRuleManager.apply_filter_rules の 1 プロンプトあたりの時間を比べる。
+両者の keep_map が一致することも確認する。
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# Add project root to path when running as standalone script
+if __name__ == "__main__":
+  sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from modules.blacklist import BlacklistFilterRule, BlacklistFilterRuleManager, BlacklistMatcher
+from modules.utils.prompt import Prompt
+
+
+def make_blacklist(n: int, rng: random.Random) -> list[re.Pattern]:
+  literals = [f"banned tag {i}" for i in range(n - n // 10)]
+  patterns = [rf"^\s*\w+ style {i}\b" if i % 2 else rf"(?:bad|worst) thing {i}$" for i in range(n // 10)]
+  return [
+    re.compile(rf"^\s*{re.escape(t)}\s*$", re.IGNORECASE) for t in literals
+  ] + [re.compile(p, re.IGNORECASE) for p in patterns]
+
+
+def make_rules(n: int, rng: random.Random) -> list[dict]:
+  rules = []
+  for i in range(n):
+    is_pattern = i % 5 == 0
+    rules.append({
+      "name": f"rule {i}",
+      "version": 1.0,
+      "enabled": True,
+      "data": {
+        "target": rf"banned tag {i}\d*" if is_pattern else f"banned tag {i}",
+        "rule_type": rng.choice(["has", "not_has"]),
+        "conditions": [f"tag {rng.randrange(200)}" for _ in range(rng.randint(1, 3))],
+        "is_pattern": is_pattern,
+      },
+    })
+  return rules
+
+
+def make_prompts(count: int, pieces: int, blacklist_size: int, rng: random.Random) -> list[str]:
+  prompts = []
+  for _ in range(count):
+    tags = []
+    for _ in range(pieces):
+      r = rng.random()
+      if r < 0.1:
+        tags.append(f"Banned Tag {rng.randrange(max(1, blacklist_size - blacklist_size // 10))}")
+      elif r < 0.15:
+        tags.append(f"(worst thing {rng.randrange(max(1, blacklist_size // 10))}:1.2)")
+      else:
+        tags.append(f"tag {rng.randrange(2000)}")
+    prompts.append(", ".join(tags))
+  return prompts
+
+
+def naive_keep_map(prompt: Prompt, blacklist: list[re.Pattern], rules: list[BlacklistFilterRule]) -> dict[int, bool]:
+  """以前の apply_filter_rules と同じ手順 (比較用)"""
+  keep_map = {}
+  for piece in prompt:
+    text = piece.text
+    if not any(p.search(text) for p in blacklist):
+      keep_map[id(piece)] = True
+      continue
+    keep = False
+    for rule in rules:
+      if rule.matches_target(text):
+        matched = set()
+        for other in prompt:
+          for idx, cond in enumerate(rule.compiled_conditions):
+            if cond.search(other.text):
+              matched.add(idx)
+        if rule.rule_type == "has":
+          ok = len(matched) == len(rule.conditions) and len(rule.conditions) > 0
+        else:
+          ok = len(matched) == 0 and len(rule.conditions) > 0
+        if ok:
+          keep = True
+          break
+    keep_map[id(piece)] = keep
+  return keep_map
+
+
+async def build_manager(rules: list[dict]) -> BlacklistFilterRuleManager:
+  # 設定ファイルを読み書きしないように直接組み立てる
+  manager = BlacklistFilterRuleManager.__new__(BlacklistFilterRuleManager)
+  manager.rules = {r["name"]: r for r in rules}
+  manager.scripts = []
+  for r in rules:
+    rule = BlacklistFilterRule(r)
+    await rule.prepare_rule()
+    manager.scripts.append(rule)
+  manager.revision = 1
+  manager.build_index()
+  manager.initialized = True
+  return manager
+
+
+async def benchmark(size: int, pieces: int, prompts: int, seed: int = 0) -> dict:
+  rng = random.Random(seed)
+  blacklist = make_blacklist(size, rng)
+  rules = make_rules(max(1, size // 20), rng)
+  manager = await build_manager(rules)
+  texts = make_prompts(prompts, pieces, size, rng)
+
+  t = time.perf_counter()
+  matcher = BlacklistMatcher(blacklist)
+  compile_ms = (time.perf_counter() - t) * 1000
+
+  # 初回呼び出し時の遅延 import (is_lora_trigger) を計測に含めない
+  await manager.apply_filter_rules(Prompt(texts[0]), matcher)
+  naive, compiled, mismatches = [], [], 0
+  for text in texts:
+    prompt = Prompt(text)
+    t = time.perf_counter()
+    expected = naive_keep_map(prompt, blacklist, manager.scripts)
+    naive.append(time.perf_counter() - t)
+    t = time.perf_counter()
+    actual = await manager.apply_filter_rules(prompt, matcher)
+    compiled.append(time.perf_counter() - t)
+    mismatches += expected != actual
+
+  return {
+    "patterns": size,
+    "rules": len(rules),
+    "pieces": pieces,
+    "prompts": prompts,
+    "compile_ms": compile_ms,
+    "naive_ms_per_prompt": statistics.mean(naive) * 1000,
+    "matcher_ms_per_prompt": statistics.mean(compiled) * 1000,
+    "speedup": statistics.mean(naive) / statistics.mean(compiled),
+    "mismatched_prompts": mismatches,
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark compiled blacklist matching against per-pattern regex calls")
+  parser.add_argument("--patterns", default="100,1000,5000", help="Comma separated blacklist sizes")
+  parser.add_argument("--pieces", type=int, default=40, help="Tags per prompt")
+  parser.add_argument("--prompts", type=int, default=200)
+  parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+  args = parser.parse_args()
+
+  results = [
+    asyncio.run(benchmark(int(n), args.pieces, args.prompts))
+    for n in args.patterns.split(",")
+  ]
+  if args.json:
+    print(json.dumps(results, indent=2))
+  else:
+    print(f"{'patterns':>9}{'rules':>7}{'compile ms':>12}{'naive ms':>10}{'matcher ms':>12}{'speedup':>9}{'mismatch':>10}")
+    for r in results:
+      print(
+        f"{r['patterns']:>9}{r['rules']:>7}{r['compile_ms']:>12.2f}{r['naive_ms_per_prompt']:>10.3f}"
+        f"{r['matcher_ms_per_prompt']:>12.3f}{r['speedup']:>8.1f}x{r['mismatched_prompts']:>10}"
+      )
@@ -17,6 +17,111 @@ def _get_is_lora_trigger():
     return _is_lora_trigger
 
 
+# obtain_blacklist() がリテラルから作るパターン: ^\s*{re.escape(tag)}\s*$
+_LITERAL_PATTERN = re.compile(r"^\^\\s\*(.+)\\s\*\$$", re.S)
+# 他のパターンと 1 つにまとめられないもの (番号/名前付きの後方参照, 先頭のグローバルフラグ)
+_UNCOMBINABLE = re.compile(r"\\[1-9]|\(\?P=|^\(\?[aiLmsux]+\)")
+
+
+def _literal_of(pattern: str, is_pattern: bool = True) -> Optional[str]:
+    """
+    Literal text the anchored pattern matches (after strip), or None if it is a real pattern.
+    is_pattern=False なら pattern 自体がリテラル (re.escape 前) として扱う
+    """
+    if not is_pattern:
+        literal = pattern
+    else:
+        m = _LITERAL_PATTERN.match(pattern)
+        if not m:
+            return None
+        inner = m.group(1)
+        literal = re.sub(r"\\(.)", r"\1", inner, flags=re.S)
+        if re.escape(literal) != inner:
+            return None
+    if not literal or literal != literal.strip():
+        return None
+    return literal
+
+
+class PromptTextIndex:
+    """Stripped piece texts of a prompt, for literal membership checks (built once per prompt)."""
+    
+    def __init__(self, prompt: Prompt):
+        self.texts = [piece.text for piece in prompt]
+        self.exact = {t.strip() for t in self.texts}
+        self.lower = {t.lower() for t in self.exact}
+    
+    def has_literal(self, literal: str, ignorecase: bool) -> bool:
+        return (literal.lower() in self.lower) if ignorecase else (literal in self.exact)
+
+
+class BlacklistMatcher:
+    """
+    Compiled form of a blacklist pattern list.
+    
+    - ^\s*literal\s*$ 形式のパターンは set (IGNORECASE なら小文字) の完全一致で判定する
+    - それ以外のパターンはフラグごとに 1 つの alternation にまとめて search 1 回で判定する
+    
+    matches(text) は any(p.search(text) for p in patterns) と同じ結果になる。
+    """
+    
+    cache_size: int = 32
+    _cache: dict[tuple, "BlacklistMatcher"] = {}
+    
+    def __init__(self, patterns: list[re.Pattern]):
+        self.size = len(patterns)
+        self.exact: set[str] = set()
+        self.lower: set[str] = set()
+        by_flags: dict[int, list[str]] = {}
+        self.separate: list[re.Pattern] = []
+        
+        for p in patterns:
+            literal = _literal_of(p.pattern)
+            if literal is not None:
+                if p.flags & re.IGNORECASE:
+                    self.lower.add(literal.lower())
+                else:
+                    self.exact.add(literal)
+            elif _UNCOMBINABLE.search(p.pattern):
+                self.separate.append(p)
+            else:
+                by_flags.setdefault(p.flags, []).append(p.pattern)
+        
+        self.combined: list[re.Pattern] = []
+        for flags, sources in by_flags.items():
+            try:
+                self.combined.append(re.compile("|".join(f"(?:{src})" for src in sources), flags))
+            except re.error:
+                # 重複した名前付きグループなど。まとめずに個別に判定する
+                self.separate.extend(re.compile(src, flags) for src in sources)
+    
+    @classmethod
+    def from_patterns(cls, patterns: list[re.Pattern]) -> "BlacklistMatcher":
+        """Matcher for `patterns`, reused while the same pattern list is passed."""
+        key = tuple((p.pattern, p.flags) for p in patterns)
+        matcher = cls._cache.get(key)
+        if matcher is None:
+            if len(cls._cache) >= cls.cache_size:
+                cls._cache.clear()
+            matcher = cls._cache[key] = cls(patterns)
+        return matcher
+    
+    def matches(self, text: str) -> bool:
+        stripped = text.strip()
+        if stripped in self.exact or stripped.lower() in self.lower:
+            return True
+        for pattern in self.combined:
+            if pattern.search(text):
+                return True
+        for pattern in self.separate:
+            if pattern.search(text):
+                return True
+        return False
+    
+    def __len__(self) -> int:
+        return self.size
+
+
 class BlacklistFilterRule:
     """
     Represents a single blacklist filter rule that determines when a blacklisted tag should NOT be filtered.
@@ -64,6 +169,10 @@ class BlacklistFilterRule:
         
         self.compiled_target: Optional[re.Pattern] = None
         self.compiled_conditions: list[re.Pattern] = []
+        # リテラルの target / condition (パターンでなければ) は PromptTextIndex で判定する
+        self.literal_target: Optional[str] = None
+        self.literal_conditions: list[Optional[str]] = []
+        self.ignorecase = False
         self.initialized = False
     
     async def prepare_rule(self):
@@ -80,12 +189,18 @@ class BlacklistFilterRule:
         debug(f"[BlacklistFilterRule] Compiled target pattern: {self.compiled_target.pattern}")
         
         # Compile condition patterns
+        self.compiled_conditions = []
         for condition in self.conditions:
             cond_pattern = condition if self.is_pattern else re.escape(condition)
             compiled = re.compile(rf"^\s*{cond_pattern}\s*$", flag)
             self.compiled_conditions.append(compiled)
             debug(f"[BlacklistFilterRule] Compiled condition pattern: {compiled.pattern}")
         
+        self.ignorecase = bool(flag & re.IGNORECASE)
+        self.literal_target = None if self.is_pattern else _literal_of(self.target, is_pattern=False)
+        self.literal_conditions = [
+            None if self.is_pattern else _literal_of(c, is_pattern=False) for c in self.conditions
+        ]
         self.initialized = True
     
     def matches_target(self, tag: str) -> bool:
@@ -94,22 +209,29 @@ class BlacklistFilterRule:
             return False
         return bool(self.compiled_target.search(tag))
     
-    def should_keep(self, prompt: Prompt) -> bool:
+    def should_keep(self, prompt: Prompt, index: Optional[PromptTextIndex] = None) -> bool:
         """
         Determine if the target should be kept based on the rule.
         
+        Args:
+            index: Pre-built PromptTextIndex of `prompt` (literal conditions become set lookups)
+        
         Returns True if the tag should NOT be filtered (should be kept).
         """
         if not self.enabled or not self.initialized:
             return False
+        if index is None:
+            index = PromptTextIndex(prompt)
         
         # Track which specific conditions are matched in the prompt
         matched_conditions = set()
-        for piece in prompt:
-            target_text = piece.text
-            for idx, cond_pattern in enumerate(self.compiled_conditions):
-                if cond_pattern.search(target_text):
+        for idx, cond_pattern in enumerate(self.compiled_conditions):
+            literal = self.literal_conditions[idx] if idx < len(self.literal_conditions) else None
+            if literal is not None:
+                if index.has_literal(literal, self.ignorecase):
                     matched_conditions.add(idx)
+            elif any(cond_pattern.search(text) for text in index.texts):
+                matched_conditions.add(idx)
         
         if self.rule_type == "has":
             # Keep the target if ALL conditions are present
@@ -132,6 +254,12 @@ class BlacklistFilterRuleManager:
         self.config_default = Path("./defaults/DEF/!blacklist_filter_rules.json")
         self.scripts: list[BlacklistFilterRule] = []
         self.initialized = False
+        # scripts を作り直すたびに増える (フィルタ結果のキャッシュの無効化に使う)
+        self.revision = 0
+        # リテラル target の rule を target (IGNORECASE なら小文字) で引く索引と、それ以外の rule
+        self.rules_by_target: dict[str, list[BlacklistFilterRule]] = {}
+        self.rules_by_target_lower: dict[str, list[BlacklistFilterRule]] = {}
+        self.pattern_rules: list[BlacklistFilterRule] = []
         
         try:
             self.load()
@@ -142,7 +270,29 @@ class BlacklistFilterRuleManager:
     async def init(self):
         """Initialize and prepare all rules"""
         self.scripts = await self.runners()
+        self.build_index()
         self.initialized = True
+        self.revision += 1
+    
+    def build_index(self):
+        """Index the enabled rules by their literal target"""
+        self.rules_by_target, self.rules_by_target_lower, self.pattern_rules = {}, {}, []
+        for rule in self.scripts:
+            if not rule.enabled:
+                continue
+            if rule.literal_target is None:
+                self.pattern_rules.append(rule)
+            elif rule.ignorecase:
+                self.rules_by_target_lower.setdefault(rule.literal_target.lower(), []).append(rule)
+            else:
+                self.rules_by_target.setdefault(rule.literal_target, []).append(rule)
+    
+    def rules_for(self, text: str) -> list[BlacklistFilterRule]:
+        """Rules whose target matches `text` (same as filtering scripts by matches_target)"""
+        stripped = text.strip()
+        rules = self.rules_by_target.get(stripped, []) + self.rules_by_target_lower.get(stripped.lower(), [])
+        rules.extend(r for r in self.pattern_rules if r.matches_target(text))
+        return rules
     
     async def reload(self):
         """Reload all rules"""
@@ -209,18 +359,31 @@ class BlacklistFilterRuleManager:
         """Create and prepare all rules"""
         return [await self.runner(name) for name in self.rules.keys()]
     
-    async def apply_filter_rules(self, prompt: Prompt, blacklist_patterns: list[re.Pattern], suppress: bool = True) -> dict[int, bool]:
+    async def apply_filter_rules(
+        self,
+        prompt: Prompt,
+        blacklist_patterns: list[re.Pattern] | BlacklistMatcher,
+        suppress: bool = True
+    ) -> dict[int, bool]:
         """
         Apply filter rules to determine which pieces should be kept.
         
+        Args:
+            blacklist_patterns: Blacklist patterns, or a BlacklistMatcher compiled from them
+        
         Returns a keep_map dictionary mapping piece IDs to whether they should be kept.
         """
         _debug = conditional_debug(not suppress)
         if not self.initialized:
             await self.init()
         
+        matcher = (
+            blacklist_patterns if isinstance(blacklist_patterns, BlacklistMatcher)
+            else BlacklistMatcher.from_patterns(blacklist_patterns)
+        )
         keep_map: dict[int, bool] = {}
         is_lora_trigger = _get_is_lora_trigger()
+        index: Optional[PromptTextIndex] = None
         
         for piece in list(prompt):
             # Skip LoRA trigger tags - they should always be kept
@@ -230,15 +393,9 @@ class BlacklistFilterRuleManager:
                 continue
             
             disweighted = piece.text
-            matched_blacklist = False
             
             # Check if this piece matches any blacklist pattern
-            for pattern in blacklist_patterns:
-                if pattern.search(disweighted):
-                    matched_blacklist = True
-                    break
-            
-            if not matched_blacklist:
+            if not matcher.matches(disweighted):
                 # Not in blacklist, keep it
                 keep_map[id(piece)] = True
                 _debug(f"[BlacklistFilter] Tag not in blacklist, keeping: {piece.value}")
@@ -246,13 +403,14 @@ class BlacklistFilterRuleManager:
             
             # Check if any filter rule applies to this blacklisted tag
             should_keep = False
-            for rule in self.scripts:
+            for rule in self.rules_for(disweighted):
                 _debug(f"[BlacklistFilter] Checking rule '{rule.name}' for tag: {piece.value}")
-                if rule.matches_target(disweighted):
-                    if rule.should_keep(prompt):
-                        _debug(f"[BlacklistFilterRule] Rule '{rule.name}' keeps tag: {piece.value}")
-                        should_keep = True
-                        break
+                if index is None:
+                    index = PromptTextIndex(prompt)
+                if rule.should_keep(prompt, index):
+                    _debug(f"[BlacklistFilterRule] Rule '{rule.name}' keeps tag: {piece.value}")
+                    should_keep = True
+                    break
             
             keep_map[id(piece)] = should_keep
         
@@ -0,0 +1,300 @@
+"""
+Offline CPU benchmark of the calculator package
+
+Usage:
+  python modules/calculator/benchmark.py [--scales small,medium] [--output bench.json] [--compare baseline.json]
+
+Zipf 分布に従う合成キャプションコーパスを各スケールで生成し、
+学習の各ステージ (カウント, PMI 行列, rating, LoRA 行列, 競合検出, 埋め込み, 保存) と
+推論 (エンジンの読み込み, get_similar_tags, generate_prompt) の時間とピークメモリ (tracemalloc) を測る。
+結果は JSON で書き出し、--compare で以前の結果と比較できる (コミット間の退行チェック用)。
+
+ネットワーク・GPU・学習済みモデルは使わない。メモリ計測はトレースのオーバーヘッドが時間に乗らないよう、
+時間を測った後に同じ処理をもう一度トレース付きで実行する (--no-memory で省略)。
+"""
+
+import argparse
+import gc
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+
+# Add project root to path when running as standalone script
+if __name__ == "__main__":
+  sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from modules.calculator.conflict import ConflictMap
+from modules.calculator.delta import CooccurrenceCounts
+from modules.calculator.embedding import TagEmbeddings
+from modules.calculator.inference import PromptInferenceEngine
+from modules.calculator.matrix import CooccurrenceMatrix
+from modules.calculator.similarity import SimilarityMatrix
+from modules.calculator.vocab import TagVocab
+
+RESULT_FORMAT = 1
+
+# name: (documents, tags, loras)
+SCALES: dict[str, tuple[int, int, int]] = {
+  "tiny": (500, 300, 5),
+  "small": (2_000, 1_000, 20),
+  "medium": (20_000, 5_000, 100),
+  "large": (100_000, 20_000, 500),
+}
+
+RATINGS = ["general", "sensitive", "explicit"]
+
+# --compare でこれより小さい値同士は比較しない
+NOISE_FLOOR = {"seconds": 0.01, "p95_ms": 0.5}
+
+
+def synthetic_corpus(
+  documents: int, tags: int, loras: int, zipf_s: float = 1.05, mean_length: int = 18, topics: int = 50, seed: int = 0
+) -> tuple[list[list[str]], list[str]]:
+  """
+  Zipf 分布のキャプションコーパス (タグのリスト, rating) を作る。
+
+  - タグの出現確率は順位 r に対して 1 / r^s
+  - 各文書はトピックを 1 つ持ち、タグの半分はトピック固有の語彙から選ぶ (共起に構造を持たせる)
+  - 人数・髪色のような排他的なグループからは最大 1 つだけ選ぶ (競合検出の対象)
+  - 約 3 割の文書にトピックに紐づく LoRA トリガーを付ける。rating もトピックに依存する
+  """
+  rng = np.random.default_rng(seed)
+  names = np.array([f"tag {i}" for i in range(tags)], dtype=object)
+  weights = 1.0 / np.arange(1, tags + 1) ** zipf_s
+  weights /= weights.sum()
+  topic_vocab = [rng.choice(tags, size=max(4, tags // topics), replace=False, p=weights) for _ in range(topics)]
+  topic_rating = rng.dirichlet([4.0, 1.5, 1.0], size=topics)
+  exclusive = [["1girl", "1boy", "2girls", "multiple girls"], [f"{c} hair" for c in ("black", "blonde", "red", "white", "blue")]]
+  lora_names = [f"<lora:synthetic_{i}>" for i in range(loras)]
+
+  docs, ratings = [], []
+  for _ in range(documents):
+    topic = int(rng.integers(topics))
+    length = max(3, int(rng.poisson(mean_length)))
+    general = names[rng.choice(tags, size=length // 2 + 1, p=weights)]
+    local = names[rng.choice(topic_vocab[topic], size=length - length // 2)]
+    doc = set(general) | set(local)
+    for group in exclusive:
+      if rng.random() < 0.8:
+        doc.add(group[int(rng.integers(len(group)))])
+    if loras and rng.random() < 0.3:
+      doc.add(lora_names[(topic * 7 + int(rng.integers(3))) % loras])
+    docs.append(list(doc))
+    ratings.append(RATINGS[int(rng.choice(3, p=topic_rating[topic]))])
+  return docs, ratings
+
+
+def _measure(fn: Callable[[], Any], memory: bool) -> tuple[Any, float, int | None]:
+  """Returns (result, seconds, peak traced bytes or None)."""
+  gc.collect()
+  t = time.perf_counter()
+  result = fn()
+  seconds = time.perf_counter() - t
+  peak = None
+  if memory:
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+  return result, seconds, peak
+
+
+def _latency(values: list[float]) -> dict:
+  values = sorted(values)
+  return {
+    "calls": len(values),
+    "p50_ms": statistics.median(values) * 1000,
+    "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))] * 1000,
+    "max_ms": values[-1] * 1000,
+  }
+
+
+def run_scale(name: str, memory: bool = True, embedding_dim: int = 0, calls: int = 100, seed: int = 0) -> list[dict]:
+  documents, tags, loras = SCALES[name]
+  results: list[dict] = []
+
+  def record(stage: str, seconds: float, peak: int | None = None, **extra):
+    results.append({"scale": name, "stage": stage, "seconds": seconds, "peak_bytes": peak, **extra})
+
+  corpus, seconds, _ = _measure(lambda: synthetic_corpus(documents, tags, loras, seed=seed), False)
+  docs, ratings = corpus
+  record("corpus", seconds, documents=documents, tags=tags, loras=loras, mean_length=statistics.mean(map(len, docs)))
+
+  def count():
+    vocab = TagVocab()
+    counts = CooccurrenceCounts()
+    for doc, rating in zip(docs, ratings):
+      counts.add(vocab.encode(doc), rating)
+    return vocab, counts
+  (vocab, counts), seconds, peak = _measure(count, memory)
+  record("count", seconds, peak)
+
+  min_sample = max(20, documents // 1000)
+  (matrix_data, tag_counts, lora_matrix, always_tag), seconds, peak = _measure(
+    lambda: CooccurrenceMatrix.create_matrix_from_counts(counts, vocab), memory
+  )
+  record("create_matrix", seconds, peak, pairs=sum(map(len, matrix_data.values())) + sum(map(len, lora_matrix.values())))
+
+  rating_matrix, seconds, peak = _measure(lambda: CooccurrenceMatrix.create_rating_matrix_from_counts(counts, min_sample), memory)
+  record("rating_matrix", seconds, peak, rows=len(rating_matrix))
+
+  (lora_similarity, lora_conflict), seconds, peak = _measure(
+    lambda: CooccurrenceMatrix.create_lora_metrices(lora_matrix=lora_matrix), memory
+  )
+  record("create_lora_metrices", seconds, peak, loras=len(lora_matrix))
+
+  matrix = CooccurrenceMatrix(
+    matrix_data, dict(tag_counts), lora_matrix, rating_matrix, always_tag, lora_similarity, lora_conflict, vocab
+  )
+  min_occurrences = max(20, documents // 200)
+  conflict, seconds, peak = _measure(lambda: ConflictMap.auto_detect_conflicts(
+    matrix=matrix, tag_counts=matrix.counts, total_documents=counts.total,
+    min_occurrences=min_occurrences, min_confidence=0.3, merge_with_existing=False,
+  ), memory)
+  record("detect_conflicts", seconds, peak, min_occurrences=min_occurrences, conflicts=len(conflict.to_file(None, True)["conflicts"]))
+
+  embedding = None
+  if embedding_dim > 0:
+    embedding, seconds, peak = _measure(lambda: TagEmbeddings.fit(matrix.matrix, len(vocab), embedding_dim), memory)
+    record("fit_embedding", seconds, peak, dim=embedding_dim)
+
+  def save():
+    data = {
+      "vocab": vocab.to_list(),
+      "matrix": matrix.to_file(None, build_data=True, include_vocab=False),
+      "matrix.conflict": conflict.to_file(None, True),
+    }
+    if embedding is not None:
+      data["matrix.embedding"] = embedding.to_file()
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+  raw, seconds, peak = _measure(save, memory)
+  record("save", seconds, peak, bytes=len(raw))
+
+  with tempfile.TemporaryDirectory() as tmp:
+    path = Path(tmp) / "data.json"
+    path.write_bytes(raw)
+    engine, seconds, peak = _measure(lambda: PromptInferenceEngine(path), memory)
+  record("engine_load", seconds, peak)
+
+  rng = np.random.default_rng(seed + 1)
+  rows = list(matrix.matrix.keys())
+  sampled = [int(rows[i]) for i in rng.choice(len(rows), size=min(calls, len(rows)), replace=False)]
+
+  similarity = SimilarityMatrix.from_cooccurrence_matrix(matrix, embedding)
+  latencies = []
+  for tag in sampled:
+    t = time.perf_counter()
+    similarity.get_similar_tags(tag)
+    latencies.append(time.perf_counter() - t)
+  record("get_similar_tags", sum(latencies), **_latency(latencies))
+
+  inits = [vocab.decode([int(x) for x in rng.choice(sampled, size=2, replace=False)]) for _ in range(calls)]
+  for stage, kwargs in (
+    ("generate_prompt[cold]", {}),
+    ("generate_prompt[warm]", {}),
+    ("generate_prompt[beam]", {"mode": "beam", "beam_width": 4}),
+  ):
+    if stage == "generate_prompt[cold]":
+      engine._scored_cache.clear()
+    latencies, lengths = [], []
+    for init in inits:
+      t = time.perf_counter()
+      lengths.append(len(engine.generate_prompt(init, [], **kwargs)))
+      latencies.append(time.perf_counter() - t)
+    record(stage, sum(latencies), **_latency(latencies), mean_tags=statistics.mean(lengths))
+
+  return results
+
+
+def _git_commit() -> str | None:
+  try:
+    return subprocess.run(
+      ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+      cwd=Path(__file__).parent,
+    ).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def compare(current: dict, baseline: dict, threshold: float = 1.2) -> list[str]:
+  """以前の結果に対して threshold 倍以上遅く / 大きくなったステージを列挙する"""
+  before = {(r["scale"], r["stage"]): r for r in baseline["results"]}
+  lines = []
+  for r in current["results"]:
+    old = before.get((r["scale"], r["stage"]))
+    if old is None or r["stage"] == "corpus":
+      continue
+    for key in ("seconds", "p95_ms", "peak_bytes"):
+      a, b = old.get(key), r.get(key)
+      if not a or b is None:
+        continue
+      if key in NOISE_FLOOR and max(a, b) < NOISE_FLOOR[key]:
+        # 計測誤差に埋もれる短いステージは比較しない
+        continue
+      ratio = b / a
+      mark = "REGRESSION" if ratio >= threshold else ("improved" if ratio <= 1 / threshold else "")
+      lines.append(f"{r['scale']:<8}{r['stage']:<24}{key:<12}{a:>14.4g}{b:>14.4g}{ratio:>8.2f}x  {mark}")
+  return lines
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark calculator training stages and inference on synthetic corpora")
+  parser.add_argument("--scales", default="small,medium", help=f"Comma separated scales ({', '.join(SCALES)})")
+  parser.add_argument("--output", type=Path, default=Path("calculator_benchmark.json"), help="Where to write the results")
+  parser.add_argument("--compare", type=Path, default=None, help="Previous results to compare against")
+  parser.add_argument("--threshold", type=float, default=1.2, help="Ratio reported as a regression by --compare")
+  parser.add_argument("--embedding-dim", type=int, default=0, help="Also benchmark SVD embeddings (0 = skip)")
+  parser.add_argument("--calls", type=int, default=100, help="Inference calls per measurement")
+  parser.add_argument("--no-memory", action="store_true", help="Skip the traced pass for peak memory")
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+
+  scales = [s.strip() for s in args.scales.split(",") if s.strip()]
+  unknown = [s for s in scales if s not in SCALES]
+  if unknown:
+    parser.error(f"unknown scales: {unknown}")
+
+  output = {
+    "format": RESULT_FORMAT,
+    "meta": {
+      "commit": _git_commit(),
+      "created_at": datetime.now(timezone.utc).isoformat(),
+      "python": platform.python_version(),
+      "numpy": np.__version__,
+      "platform": platform.platform(),
+      "processor": platform.processor(),
+      "seed": args.seed,
+      "memory": not args.no_memory,
+    },
+    "results": [],
+  }
+  for scale in scales:
+    print(f"[{scale}] {SCALES[scale][0]} documents, {SCALES[scale][1]} tags...", file=sys.stderr)
+    for r in run_scale(scale, not args.no_memory, args.embedding_dim, args.calls, args.seed):
+      output["results"].append(r)
+      peak = "" if r["peak_bytes"] is None else f"  peak {r['peak_bytes'] / 1048576:.1f} MiB"
+      p95 = f"  p95 {r['p95_ms']:.2f} ms" if "p95_ms" in r else ""
+      print(f"  {r['stage']:<24}{r['seconds']:>9.3f}s{p95}{peak}", file=sys.stderr)
+
+  args.output.parent.mkdir(parents=True, exist_ok=True)
+  with args.output.open("w", encoding="utf-8") as f:
+    json.dump(output, f, indent=2)
+  print(f"results written to {args.output}", file=sys.stderr)
+
+  if args.compare is not None:
+    with args.compare.open("r", encoding="utf-8") as f:
+      baseline = json.load(f)
+    print(f"{'scale':<8}{'stage':<24}{'metric':<12}{'baseline':>14}{'current':>14}{'ratio':>9}")
+    for line in compare(output, baseline, args.threshold):
+      print(line)
@@ -0,0 +1,106 @@
+"""
+Latency vs beam width of PromptInferenceEngine's beam search mode
+
+Usage:
+  python modules/calculator/benchmark_beam.py <trained data.json> --init "1girl, solo" [--widths 1,2,4,8,16] [--budget 0.05] [--runs 50] [--cold] [--max-overrun-ms 2]
+
+各ビーム幅で同じ初期タグから runs 回生成し、レイテンシ (p50/p95/max) と
+生成されたタグ同士の平均 PMI (coherence)・タグ数を表示する。比較のため sample モードも測る。
+--cold では毎回ビームサーチ用の候補の配列化からやり直す (キャッシュなし)。
+beam モードの p95 レイテンシが budget + max-overrun-ms を超えたら終了コード 1 で終わる
+(max は OS のスケジューリングによる数 ms の揺れを含むので判定には使わない)。
+"""
+
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from itertools import combinations
+from pathlib import Path
+
+# Add project root to path when running as standalone script
+if __name__ == "__main__":
+  sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from modules.calculator.inference import PromptInferenceEngine
+from modules.calculator.preprocessing import PreProcessor
+
+
+def coherence(engine: PromptInferenceEngine, tags: list[str]) -> float:
+  """Mean PMI over all pairs of the (known) generated tags."""
+  ids = engine.vocab.encode(PreProcessor.seprompt(tags), add=False)
+  pairs = list(combinations(set(ids), 2))
+  if not pairs:
+    return 0.0
+  return sum(engine.matrix.matrix.get(a, {}).get(b, 0.0) for a, b in pairs) / len(pairs)
+
+
+def benchmark(engine: PromptInferenceEngine, init: list[str], widths: list[int], budget: float, runs: int, top_k: int, temperature: float, cold: bool = False) -> list[dict]:
+  results = []
+  modes = [("sample", 0)] + [("beam", w) for w in widths]
+  # スコアリングはキャッシュされるので最初に一度だけ温めておく
+  engine.generate_prompt(init, top_k=top_k)
+  for mode, width in modes:
+    rng = random.Random(0)
+    latencies, scores, counts = [], [], []
+    for _ in range(runs):
+      scored = engine.score_candidates(init, top_k=top_k)
+      if cold:
+        engine._beam_pool_cache.clear()
+      t = time.perf_counter()
+      if mode == "beam":
+        tags = engine._beam_prompt(scored, temperature, top_k, 0.7, width, budget, rng=rng)
+      else:
+        tags = engine._sample_prompt(scored, temperature, top_k, 0.7, rng)
+      latencies.append((time.perf_counter() - t) * 1000)
+      scores.append(coherence(engine, tags))
+      counts.append(len(tags))
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    results.append({
+      "mode": mode,
+      "beam_width": width,
+      "p50_ms": statistics.median(latencies),
+      "p95_ms": p95,
+      "max_ms": latencies[-1],
+      "over_ms": max(0.0, p95 - budget * 1000) if mode == "beam" else 0.0,
+      "coherence": statistics.mean(scores),
+      "tags": statistics.mean(counts),
+    })
+  return results
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark beam search latency against beam width")
+  parser.add_argument("data", type=Path, help="Trained data file (output of training.train)")
+  parser.add_argument("--init", required=True, help="Comma separated initial tags")
+  parser.add_argument("--widths", default="1,2,4,8,16", help="Comma separated beam widths")
+  parser.add_argument("--budget", type=float, default=0.05, help="Time budget per prompt in seconds")
+  parser.add_argument("--runs", type=int, default=50)
+  parser.add_argument("--top-k", type=int, default=10)
+  parser.add_argument("--temperature", type=float, default=1.0)
+  parser.add_argument("--cold", action="store_true", help="Rebuild the beam candidate pool on every run")
+  parser.add_argument("--max-overrun-ms", type=float, default=1.0, help="Allowed p95 latency over the budget (beam mode)")
+  parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+  args = parser.parse_args()
+
+  engine = PromptInferenceEngine(args.data)
+  results = benchmark(
+    engine, args.init.split(","), [int(w) for w in args.widths.split(",")],
+    args.budget, args.runs, args.top_k, args.temperature, args.cold,
+  )
+  if args.json:
+    print(json.dumps(results, indent=2))
+  else:
+    print(f"{'mode':<8}{'width':>6}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'over ms':>10}{'coherence':>11}{'tags':>7}")
+    for r in results:
+      print(
+        f"{r['mode']:<8}{r['beam_width']:>6}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['max_ms']:>10.2f}"
+        f"{r['over_ms']:>10.2f}{r['coherence']:>11.3f}{r['tags']:>7.1f}"
+      )
+  over = [r for r in results if r["over_ms"] > args.max_overrun_ms]
+  if over:
+    print(f"Budget exceeded by more than {args.max_overrun_ms} ms: " + ", ".join(f"width {r['beam_width']}" for r in over), file=sys.stderr)
+    sys.exit(1)
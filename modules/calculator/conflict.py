@@ -19,13 +19,17 @@ import json
 from pathlib import Path
 
 from modules.calculator.matrix import CooccurrenceMatrix
+from modules.calculator.vocab import TagVocab
+
+# 学習済みデータの競合マップ形式 (2: TagVocab の ID で保存)
+CONFLICT_FORMAT = 2
 
 
 @dataclass
 class DetectedConflict:
-  """Represents an automatically detected conflict between two tags."""
-  tag_a: str
-  tag_b: str
+  """Represents an automatically detected conflict between two tags (vocabulary ids)."""
+  tag_a: int
+  tag_b: int
   confidence: float
   suppression_a_given_b: float
   suppression_b_given_a: float
@@ -46,7 +50,8 @@ class HighConfidenceConflictDetector:
     min_suppression: float = 0.15,
     context_sim_range: Tuple[float, float] = (0.25, 0.75),
     confidence_threshold: float = 0.7,
-    word2vec_model: Optional[any] = None
+    word2vec_model: Optional[any] = None,
+    vocab: Optional[TagVocab] = None
   ):
     """
     Initialize conflict detector.
@@ -57,18 +62,22 @@ class HighConfidenceConflictDetector:
       context_sim_range: Valid range for context similarity (default: 0.25-0.75)
       confidence_threshold: Minimum confidence to report conflict (default: 0.7)
       word2vec_model: Optional Word2Vec model for semantic analysis
+      vocab: Vocabulary to decode tag ids for the Word2Vec lookup
     """
     self.min_occurrences = min_occurrences
     self.min_suppression = min_suppression
     self.context_sim_range = context_sim_range
     self.confidence_threshold = confidence_threshold
     self.word2vec_model = word2vec_model
+    self.vocab = vocab
   
   def detect_conflicts(
     self,
-    matrix_data: Dict[str, Dict[str, float]],
-    tag_counts: Dict[str, int],
-    total_documents: int
+    matrix_data: Dict[int, Dict[int, float]],
+    tag_counts: Dict[int, int],
+    total_documents: int,
+    only_tags: Optional[Set[int]] = None,
+    shard: Tuple[int, int] = (0, 1)
   ) -> List[DetectedConflict]:
     """
     Detect all conflicting tag pairs from co-occurrence matrix.
@@ -77,6 +86,9 @@ class HighConfidenceConflictDetector:
       matrix_data: Co-occurrence matrix {tag_a: {tag_b: score}}
       tag_counts: Tag occurrence counts {tag: count}
       total_documents: Total number of documents/samples
+      only_tags: If given, only pairs containing at least one of these tags are checked
+      shard: (index, count) - only check pairs whose first tag falls into this shard,
+        so the pair scan can be split across workers
     
     Returns:
       List of detected conflicts sorted by confidence (descending)
@@ -88,38 +100,60 @@ class HighConfidenceConflictDetector:
     ]
     
     conflicts = []
-    checked_pairs: Set[Tuple[str, str]] = set()
-    
-    # Check all pairs of valid tags
-    for i, tag_a in enumerate(valid_tags):
-      for tag_b in valid_tags[i + 1:]:
-        # Avoid duplicate checks
-        pair = tuple(sorted([tag_a, tag_b]))
-        if pair in checked_pairs:
-          continue
-        checked_pairs.add(pair)
-        
-        # Detect conflict between this pair
-        conflict = self._detect_pair(
-          tag_a, tag_b,
-          matrix_data,
-          tag_counts,
-          total_documents
-        )
-        
-        if conflict is not None:
-          conflicts.append(conflict)
+    for tag_a, tag_b in self._candidate_pairs(valid_tags, only_tags, shard):
+      # Detect conflict between this pair
+      conflict = self._detect_pair(
+        tag_a, tag_b,
+        matrix_data,
+        tag_counts,
+        total_documents
+      )
+      
+      if conflict is not None:
+        conflicts.append(conflict)
     
     # Sort by confidence (highest first)
     conflicts.sort(key=lambda c: c.confidence, reverse=True)
     return conflicts
   
+  @staticmethod
+  def _candidate_pairs(
+    valid_tags: List[int],
+    only_tags: Optional[Set[int]],
+    shard: Tuple[int, int]
+  ):
+    """
+    Each unordered pair of valid tags to check once.
+    
+    With only_tags the scan is only_tags × valid_tags (O(|only_tags|·V) instead of O(V²)),
+    so incremental runs scale with the delta. Shards split the first tag of the pair.
+    """
+    shard_index, shard_count = shard
+    if only_tags is None:
+      for i, tag_a in enumerate(valid_tags):
+        if i % shard_count != shard_index:
+          continue
+        for tag_b in valid_tags[i + 1:]:
+          yield tag_a, tag_b
+      return
+    
+    touched = [tag for tag in valid_tags if tag in only_tags]
+    rank = {tag: i for i, tag in enumerate(touched)}
+    for i, tag_a in enumerate(touched):
+      if i % shard_count != shard_index:
+        continue
+      for tag_b in valid_tags:
+        # touched 同士の組は先に出てくる方からだけ調べる
+        if tag_b == tag_a or rank.get(tag_b, i + 1) < i:
+          continue
+        yield tag_a, tag_b
+  
   def _detect_pair(
     self,
-    tag_a: str,
-    tag_b: str,
-    matrix_data: Dict[str, Dict[str, float]],
-    tag_counts: Dict[str, int],
+    tag_a: int,
+    tag_b: int,
+    matrix_data: Dict[int, Dict[int, float]],
+    tag_counts: Dict[int, int],
     total_documents: int
   ) -> Optional[DetectedConflict]:
     """
@@ -192,10 +226,10 @@ class HighConfidenceConflictDetector:
   
   def _suppression_rate(
     self,
-    tag_b: str,
-    tag_a: str,
-    matrix_data: Dict[str, Dict[str, float]],
-    tag_counts: Dict[str, int],
+    tag_b: int,
+    tag_a: int,
+    matrix_data: Dict[int, Dict[int, float]],
+    tag_counts: Dict[int, int],
     total_documents: int
   ) -> float:
     """
@@ -250,10 +284,10 @@ class HighConfidenceConflictDetector:
   
   def _get_cooccurrence_count(
     self,
-    tag_a: str,
-    tag_b: str,
-    matrix_data: Dict[str, Dict[str, float]],
-    tag_counts: Dict[str, int],
+    tag_a: int,
+    tag_b: int,
+    matrix_data: Dict[int, Dict[int, float]],
+    tag_counts: Dict[int, int],
     total_documents: int
   ) -> int:
     """
@@ -300,9 +334,9 @@ class HighConfidenceConflictDetector:
   
   def _context_similarity(
     self,
-    tag_a: str,
-    tag_b: str,
-    matrix_data: Dict[str, Dict[str, float]]
+    tag_a: int,
+    tag_b: int,
+    matrix_data: Dict[int, Dict[int, float]]
   ) -> float:
     """
     Calculate context similarity using weighted Jaccard similarity.
@@ -343,7 +377,7 @@ class HighConfidenceConflictDetector:
     
     return intersection / union
   
-  def _semantic_check(self, tag_a: str, tag_b: str) -> float:
+  def _semantic_check(self, tag_a: int, tag_b: int) -> float:
     """
     Check semantic opposition using Word2Vec.
     
@@ -357,6 +391,9 @@ class HighConfidenceConflictDetector:
     if self.word2vec_model is None:
       return 0.0
     
+    if self.vocab is not None:
+      tag_a, tag_b = self.vocab.tag(tag_a), self.vocab.tag(tag_b)
+    
     try:
       # Get word vectors
       vec_a = self.word2vec_model.wv[tag_a]
@@ -444,14 +481,14 @@ class HighConfidenceConflictDetector:
     return confidence
 
 class ConflictMap:
-    def __init__(self, conflicts: Optional[Dict[str, List[str]]] = None):
+    def __init__(self, conflicts: Optional[Dict[int, List[int]]] = None):
         """
         Initialize conflict map.
 
         Args:
-            conflicts: Dictionary of {tag: [conflicting_tags]}
+            conflicts: Dictionary of {tag_id: [conflicting_tag_ids]}
         """
-        self.conflicts: Dict[str, Set[str]] = {}
+        self.conflicts: Dict[int, Set[int]] = {}
         if conflicts:
             for tag, conflict_list in conflicts.items():
                 self.conflicts[tag] = set(conflict_list)
@@ -462,28 +499,44 @@ class ConflictMap:
       )
 
     @classmethod
-    def from_file(cls, path: Path | dict) -> 'ConflictMap':
-        """Load conflict map from JSON file."""
+    def from_file(cls, path: Path | dict, vocab: Optional[TagVocab] = None) -> 'ConflictMap':
+        """
+        Load conflict map from JSON file.
+        
+        Args:
+            vocab: Vocabulary of the matrix this map belongs to (required for old string-keyed data)
+        """
         if isinstance(path, dict):
           data = path
         else:
           if not path.exists(): raise FileNotFoundError(f"Conflict map not found at {path}")
           with open(path, 'r', encoding='utf-8') as f:
             data = json.load(f)
-            
-        return cls(data)
+        
+        if data.get("format") == CONFLICT_FORMAT:
+          return cls({tag: others for tag, others in data.get("conflicts", [])})
+        # 旧形式 (タグ文字列がキー)
+        if vocab is None:
+          raise ValueError("vocab is required to load string-keyed conflict maps")
+        return cls({
+          vocab.add(tag): vocab.encode(others)
+          for tag, others in data.items()
+        })
 
     def to_file(self, path: Path, build_data: bool = False):
         """Save conflict map to JSON file."""
         # Convert sets to lists for JSON serialization
-        data = {tag: list(conflicts) for tag, conflicts in self.conflicts.items()}
+        data = {
+          "format": CONFLICT_FORMAT,
+          "conflicts": [[tag, list(conflicts)] for tag, conflicts in self.conflicts.items()]
+        }
         if build_data: return data
         
         path.parent.mkdir(parents=True, exist_ok=True)
         with open(path, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
     
-    def add_conflict(self, tag_a: str, tag_b: str):
+    def add_conflict(self, tag_a: int, tag_b: int):
         """
         Add bidirectional conflict between two tags.
         
@@ -499,7 +552,34 @@ class ConflictMap:
         self.conflicts[tag_a].add(tag_b)
         self.conflicts[tag_b].add(tag_a)
     
-    def has_conflict(self, existing_tags: Set[str], new_tag: str) -> bool:
+    def merge(self, other: 'ConflictMap'):
+        """
+        Add every conflict of another map.
+        
+        Args:
+            other: ConflictMap to merge into this one
+        """
+        for tag, conflicts in other.conflicts.items():
+            for conflict in conflicts:
+                self.add_conflict(tag, conflict)
+    
+    def discard_tags(self, tags: Set[int]):
+        """
+        Remove every conflict that involves one of the given tags.
+        
+        Args:
+            tags: Tags whose conflicts should be re-detected
+        """
+        for tag in tags:
+            for other in self.conflicts.pop(tag, set()):
+                others = self.conflicts.get(other)
+                if others is None:
+                    continue
+                others.discard(tag)
+                if not others:
+                    del self.conflicts[other]
+    
+    def has_conflict(self, existing_tags: Set[int], new_tag: int) -> bool:
         """
         Check if adding new_tag conflicts with existing tags.
         
@@ -520,14 +600,16 @@ class ConflictMap:
     def auto_detect_conflicts(
         cls,
         matrix: 'CooccurrenceMatrix',
-        tag_counts: dict[str, int],
+        tag_counts: dict[int, int],
         total_documents: int,
         min_occurrences: int = 250,
         min_confidence: float = 0.7,
         word2vec_model: Optional[any] = None,
         merge_with_existing: bool = True,
-        base_map: Optional['ConflictMap'] = None
-    ) -> tuple['ConflictMap', list[tuple[str, str, float]]]:
+        base_map: Optional['ConflictMap'] = None,
+        only_tags: Optional[Set[int]] = None,
+        shard: Tuple[int, int] = (0, 1)
+    ) -> 'ConflictMap':
         """
         Automatically detect conflicting tag pairs from co-occurrence data.
 
@@ -545,9 +627,15 @@ class ConflictMap:
             word2vec_model: Optional Word2Vec model for semantic analysis
             merge_with_existing: If True, add detected conflicts to base_map
             base_map: Optional ConflictMap to merge into
+            only_tags: If given, only conflicts involving these tags are re-detected
+                (existing conflicts of these tags in base_map are discarded first).
+                Pairs of other tags keep the verdict of the previous detection, which used
+                the previous total_documents; callers should run a full detection once the
+                document count has drifted (see training.CONFLICT_DELTA_MAX_DRIFT)
+            shard: (index, count) of the pair scan to run (see detect_conflicts)
 
         Returns:
-            Tuple of (ConflictMap, detected conflicts list)
+            ConflictMap with the detected conflicts added
         """
         if base_map is not None:
           if not merge_with_existing:
@@ -556,15 +644,21 @@ class ConflictMap:
             conflict_map = base_map
         else:
           conflict_map = cls()
+        
+        if only_tags is not None:
+            conflict_map.discard_tags(only_tags)
           
         detected = HighConfidenceConflictDetector(
             min_occurrences=min_occurrences,
             confidence_threshold=min_confidence,
-            word2vec_model=word2vec_model
+            word2vec_model=word2vec_model,
+            vocab=getattr(matrix, "vocab", None)
         ).detect_conflicts(
             matrix.matrix,
             tag_counts,
-            total_documents
+            total_documents,
+            only_tags=only_tags,
+            shard=shard
         )
         
         for conflict in detected:
@@ -0,0 +1,363 @@
+"""
+Incremental (delta) training state for the prompt calculator
+
+PMI / rating / conflict の各マトリクスは派生データなので、差分学習のために
+元になる生のカウントと前処理結果を学習データの隣のチェックポイントディレクトリ (`<stem>.ckpt/`) に保持する。
+
+- CooccurrenceCounts: 共起数・周辺数・rating数 (加算/減算できる、キーは TagVocab の ID)
+- CaptionJournal: 前処理結果の追記専用ログ (captions.jsonl)。画像ごとに最後のエントリが有効
+- TrainingState: 語彙、prompt/booru のカウント、及びカウント済みの画像の署名 (state.json)
+
+次回の学習では追加・変更・削除された画像だけを前処理し、カウントの差分をマージする。
+前処理結果はバッチごとにジャーナルへ追記されるので、途中で落ちても処理済みの画像はやり直さない。
+"""
+
+import json
+import math
+import os
+import uuid
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from modules.calculator.vocab import TagVocab, pack_rows, unpack_rows
+
+STATE_VERSION = 3
+
+
+def write_json_atomic(path: Path, data) -> None:
+  """tmp に書いてから置き換える (途中で落ちても前の内容が残る)"""
+  path.parent.mkdir(parents=True, exist_ok=True)
+  tmp = path.with_name(path.name + ".tmp")
+  with tmp.open("w", encoding="utf-8") as f:
+    json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+  os.replace(tmp, path)
+
+
+def read_json(path: Path) -> Optional[dict]:
+  if not path.exists():
+    return None
+  try:
+    with path.open("r", encoding="utf-8") as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+
+class CooccurrenceCounts:
+  """Raw co-occurrence / marginal / rating counts that can be updated in both directions."""
+
+  def __init__(
+    self,
+    total: int = 0,
+    counts: Optional[Dict[int, int]] = None,
+    cooccur: Optional[Dict[int, Dict[int, int]]] = None,
+    rating_counts: Optional[Dict[int, Dict[str, int]]] = None,
+  ):
+    self.total: int = total
+    self.counts: Dict[int, int] = defaultdict(int, counts or {})
+    self.cooccur: Dict[int, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+    for tag, others in (cooccur or {}).items():
+      self.cooccur[tag].update(others)
+    self.rating_counts: Dict[int, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    for tag, ratings in (rating_counts or {}).items():
+      self.rating_counts[tag].update(ratings)
+
+  def __reduce__(self):
+    # defaultdict(lambda) は pickle できないので、ワーカープロセスへ渡すときは dict 形式を経由する
+    return (CooccurrenceCounts.from_dict, (self.to_dict(),))
+
+  def _apply(self, tags: Iterable[int], rating: Optional[str], sign: int) -> Set[int]:
+    unique_tags = set(tags)
+    self.total += sign
+    for tag in unique_tags:
+      self.counts[tag] += sign
+      if self.counts[tag] <= 0:
+        del self.counts[tag]
+      if rating is not None:
+        row = self.rating_counts[tag]
+        row[rating] += sign
+        if row[rating] <= 0:
+          del row[rating]
+        if not row:
+          del self.rating_counts[tag]
+      for other in unique_tags:
+        if tag == other:
+          continue
+        row = self.cooccur[tag]
+        row[other] += sign
+        if row[other] <= 0:
+          del row[other]
+      if not self.cooccur[tag]:
+        del self.cooccur[tag]
+    return unique_tags
+
+  def add(self, tags: Iterable[int], rating: Optional[str] = None) -> Set[int]:
+    """Add one document. Returns the tags whose counts changed."""
+    return self._apply(tags, None if rating is None else str(rating), 1)
+
+  def remove(self, tags: Iterable[int], rating: Optional[str] = None) -> Set[int]:
+    """Remove a previously added document. Returns the tags whose counts changed."""
+    return self._apply(tags, None if rating is None else str(rating), -1)
+
+  def pmi_row(self, tag: int) -> Dict[int, float]:
+    """
+    PMI = log(P(tag, other) / (P(tag) * P(other)))
+        = log(count(tag, other) * N / (count(tag) * count(other)))
+    """
+    count_tag = self.counts.get(tag, 0)
+    others = self.cooccur.get(tag)
+    if count_tag <= 0 or not others or self.total <= 0:
+      return {}
+
+    row = {}
+    for other, cooccur_count in others.items():
+      count_other = self.counts.get(other, 0)
+      if cooccur_count > 0 and count_other > 0:
+        row[other] = math.log(cooccur_count * self.total / (count_tag * count_other))
+    return row
+
+  def rating_row(self, tag: int, min_sample: int) -> Optional[Dict[str, float]]:
+    total_tag_count = self.counts.get(tag, 0)
+    if total_tag_count < min_sample or tag not in self.rating_counts:
+      return None
+    return {
+      rating: count / total_tag_count
+      for rating, count in self.rating_counts[tag].items()
+    }
+
+  def neighbors(self, tags: Iterable[int]) -> Set[int]:
+    """Tags that co-occur with any of the given tags (their PMI rows reference them)."""
+    found = set()
+    for tag in tags:
+      found.update(self.cooccur.get(tag, {}).keys())
+    return found
+
+  def to_dict(self) -> dict:
+    return {
+      "total": self.total,
+      "counts": [list(self.counts.keys()), list(self.counts.values())],
+      "cooccur": pack_rows(self.cooccur),
+      "rating_counts": [[tag, dict(r)] for tag, r in self.rating_counts.items()],
+    }
+
+  @classmethod
+  def from_dict(cls, data: dict, size: int = 0) -> "CooccurrenceCounts":
+    ids, counts = data.get("counts", [[], []])
+    return cls(
+      total=data.get("total", 0),
+      counts=dict(zip(ids, counts)),
+      cooccur=unpack_rows(data.get("cooccur", []), size),
+      rating_counts={tag: r for tag, r in data.get("rating_counts", [])},
+    )
+
+
+class CaptionJournal:
+  """
+  Append-only log of preprocessed captions.
+
+  1行目はヘッダー {"fingerprint": {...}}、以降は
+  {"key": image_path, "sig": [mtime_ns, size, caption_mtime_ns], "prompt": [tags], "booru": [tags], "rating": str | None}
+  または削除を表す {"key": image_path, "removed": true}。
+  rating が None のエントリは前処理で除外された画像 (再処理しないために記録だけ残す)。
+  タグは文字列のまま保存するので、語彙 (state.json) と独立して壊れない。
+  """
+
+  def __init__(self, path: Path, fingerprint: dict):
+    self.path = path
+    self.fingerprint = fingerprint
+    self.lines = 0
+
+  def _header_matches(self) -> bool:
+    try:
+      with self.path.open("r", encoding="utf-8") as f:
+        return json.loads(f.readline()).get("fingerprint") == self.fingerprint
+    except (OSError, ValueError, AttributeError):
+      return False
+
+  def open(self) -> bool:
+    """Create the journal if needed. Returns False when an incompatible journal was discarded."""
+    if self.path.exists() and self._header_matches():
+      return True
+    existed = self.path.exists()
+    write_json_atomic(self.path, {"fingerprint": self.fingerprint})
+    with self.path.open("a", encoding="utf-8") as f:
+      f.write("\n")
+    return not existed
+
+  def __iter__(self) -> Iterator[dict]:
+    """Stream entries in write order. A truncated last line (crash while writing) is ignored."""
+    with self.path.open("r", encoding="utf-8") as f:
+      f.readline()
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          continue
+        if isinstance(entry, dict) and "key" in entry:
+          yield entry
+
+  def scan(self) -> Dict[str, List[int]]:
+    """Latest signature of every image that is still present."""
+    latest: Dict[str, List[int]] = {}
+    self.lines = 0
+    for entry in self:
+      self.lines += 1
+      if entry.get("removed"):
+        latest.pop(entry["key"], None)
+      else:
+        latest[entry["key"]] = entry["sig"]
+    return latest
+
+  def append(self, entries: Iterable[dict]) -> None:
+    with self.path.open("a", encoding="utf-8") as f:
+      for entry in entries:
+        f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.lines += 1
+      f.flush()
+      os.fsync(f.fileno())
+
+  def compact(self, latest: Dict[str, List[int]]) -> None:
+    """Drop superseded entries and tombstones (only after the counts reflect `latest`)."""
+    if self.lines <= len(latest) * 1.5:
+      return
+    tmp = self.path.with_name(self.path.name + ".tmp")
+    written = set()
+    with tmp.open("w", encoding="utf-8") as f:
+      f.write(json.dumps({"fingerprint": self.fingerprint}, ensure_ascii=False) + "\n")
+      for entry in self:
+        key = entry["key"]
+        if entry.get("removed") or key in written or latest.get(key) != entry["sig"]:
+          continue
+        written.add(key)
+        f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+    os.replace(tmp, self.path)
+    self.lines = len(written)
+
+
+class TrainingState:
+  """
+  Raw counts persisted in the checkpoint directory.
+
+  applied: {image_path: sig} カウントに反映済みの画像の署名
+  revision: カウントが変わるたびに更新される。各ステージのチェックポイントはこの値で自分が最新か判断する
+  pending: 最後に学習データを書き出した時点 (base) からの差分
+    {"base": revision, "total": 画像数, "prompt": [ids], "booru": [ids]}
+  """
+
+  def __init__(
+    self,
+    fingerprint: dict,
+    applied: Optional[Dict[str, List[int]]] = None,
+    prompt: Optional[CooccurrenceCounts] = None,
+    booru: Optional[CooccurrenceCounts] = None,
+    revision: Optional[str] = None,
+    vocab: Optional[TagVocab] = None,
+    pending: Optional[dict] = None,
+  ):
+    self.fingerprint = fingerprint
+    self.vocab = vocab or TagVocab()
+    self.applied: Dict[str, List[int]] = applied or {}
+    self.prompt = prompt or CooccurrenceCounts()
+    self.booru = booru or CooccurrenceCounts()
+    self.revision = revision
+    self.pending = pending
+
+  @staticmethod
+  def checkpoint_dir(output: Path) -> Path:
+    return output.with_name(output.stem + ".ckpt")
+
+  @staticmethod
+  def signature(image_path: str) -> List[int]:
+    st = os.stat(image_path)
+    caption = image_path + ".txt"
+    cap_mtime = os.stat(caption).st_mtime_ns if os.path.exists(caption) else 0
+    return [st.st_mtime_ns, st.st_size, cap_mtime]
+
+  def _count(self, entry: dict, sign: int) -> Tuple[Set[int], Set[int]]:
+    if entry.get("rating") is None:
+      return set(), set()
+    prompt_ids = self.vocab.encode(entry.get("prompt") or [])
+    booru_ids = self.vocab.encode(entry.get("booru") or [])
+    if sign > 0:
+      return self.prompt.add(prompt_ids, entry["rating"]), self.booru.add(booru_ids, entry["rating"])
+    return self.prompt.remove(prompt_ids, entry["rating"]), self.booru.remove(booru_ids, entry["rating"])
+
+  def update(self, journal: CaptionJournal, latest: Dict[str, List[int]]) -> Tuple[Set[int], Set[int]]:
+    """
+    Bring the counts in line with the journal's latest entries by streaming it once.
+    Returns the touched (prompt_ids, booru_ids) of this update.
+    """
+    to_remove = {k: sig for k, sig in self.applied.items() if latest.get(k) != sig}
+    to_add = {k: sig for k, sig in latest.items() if self.applied.get(k) != sig}
+    touched_prompt: Set[int] = set()
+    touched_booru: Set[int] = set()
+    if not to_remove and not to_add:
+      return touched_prompt, touched_booru
+
+    previous_revision, previous_total = self.revision, self.prompt.total
+    for entry in journal:
+      key, sig = entry["key"], entry.get("sig")
+      if entry.get("removed"):
+        continue
+      if key in to_remove and to_remove[key] == sig:
+        del to_remove[key]
+        tp, tb = self._count(entry, -1)
+        touched_prompt |= tp
+        touched_booru |= tb
+      elif key in to_add and to_add[key] == sig:
+        # 同じ署名のエントリが重複していても最初の1つだけ数える
+        del to_add[key]
+        tp, tb = self._count(entry, 1)
+        touched_prompt |= tp
+        touched_booru |= tb
+    self.applied = dict(latest)
+
+    if to_remove:
+      # 反映済みのエントリがジャーナルに無い (手動で消された等) のでカウントを作り直す
+      self.prompt, self.booru, self.applied = CooccurrenceCounts(), CooccurrenceCounts(), {}
+      self.pending = None
+      self.update(journal, latest)
+      # base が None なら各ステージはフル再計算する
+      self.pending = {"base": None, "total": 0, "prompt": [], "booru": []}
+      self.revision = uuid.uuid4().hex
+      return set(self.prompt.counts), set(self.booru.counts)
+
+    if self.pending is None:
+      self.pending = {"base": previous_revision, "total": previous_total, "prompt": [], "booru": []}
+    self.pending["prompt"] = list(set(self.pending["prompt"]) | touched_prompt)
+    self.pending["booru"] = list(set(self.pending["booru"]) | touched_booru)
+    self.revision = uuid.uuid4().hex
+    return touched_prompt, touched_booru
+
+  def commit(self) -> None:
+    """Every stage reflects the current revision."""
+    self.pending = None
+
+  @classmethod
+  def load(cls, path: Path) -> Optional["TrainingState"]:
+    data = read_json(path)
+    if data is None or data.get("version") != STATE_VERSION:
+      return None
+    vocab = TagVocab.from_list(data.get("vocab", []))
+    return cls(
+      fingerprint=data.get("fingerprint", {}),
+      applied=data.get("applied", {}),
+      prompt=CooccurrenceCounts.from_dict(data.get("prompt", {}), len(vocab)),
+      booru=CooccurrenceCounts.from_dict(data.get("booru", {}), len(vocab)),
+      revision=data.get("revision"),
+      vocab=vocab,
+      pending=data.get("pending"),
+    )
+
+  def save(self, path: Path) -> None:
+    write_json_atomic(path, {
+      "version": STATE_VERSION,
+      "revision": self.revision,
+      "fingerprint": self.fingerprint,
+      "vocab": self.vocab.to_list(),
+      "applied": self.applied,
+      "pending": self.pending,
+      "prompt": self.prompt.to_dict(),
+      "booru": self.booru.to_dict(),
+    })
@@ -0,0 +1,125 @@
+"""
+Truncated-SVD tag embeddings
+
+PPMI 行列 (タグ × 文脈タグ) を低ランク (既定 128 次元) に分解し、
+各タグを L2 正規化済みの float32 ベクトルとして保持する。
+PPMI コサイン類似度の近似がベクトルの内積 1 回で求まるため、
+SimilarityMatrix の類似度・多様性・冗長性チェックを定数時間で行える。
+
+学習データには "<base>.embedding" として保存される:
+  {"format": 1, "dim": d, "rows": n, "dtype": "float32", "data": base64(little-endian)}
+rows は学習時の語彙数。それ以降に追加されたIDはゼロベクトル (類似度 0) として扱う。
+"""
+
+import base64
+from typing import Dict, Optional
+
+import numpy as np
+from scipy import sparse
+
+EMBEDDING_FORMAT = 1
+DEFAULT_EMBEDDING_DIM = 128
+
+
+def ppmi_matrix(matrix_data: Dict[int, Dict[int, float]], size: int) -> sparse.csr_matrix:
+  """{tag: {other: pmi}} → size × size の疎な PPMI 行列"""
+  rows, cols, values = [], [], []
+  for tag, others in matrix_data.items():
+    for other, pmi in others.items():
+      if pmi > 0:
+        rows.append(tag)
+        cols.append(other)
+        values.append(pmi)
+  m = sparse.csr_matrix(
+    (np.asarray(values, dtype=np.float32), (rows, cols)), shape=(size, size)
+  )
+  m.sum_duplicates()
+  return m
+
+
+def randomized_svd(m: sparse.csr_matrix, dim: int, n_iter: int = 4, oversample: int = 10, seed: int = 0):
+  """
+  Halko et al. の randomized SVD。上位 dim 個の (U, S) を返す。
+  ARPACK (svds) より速く、seed を固定すれば結果も決定的。
+  """
+  rng = np.random.default_rng(seed)
+  k = min(dim + oversample, min(m.shape))
+  q = m @ rng.standard_normal((m.shape[1], k)).astype(np.float32)
+  q, _ = np.linalg.qr(q)
+  for _ in range(n_iter):
+    # 数値安定のため各反復で直交化する
+    q, _ = np.linalg.qr(m.T @ q)
+    q, _ = np.linalg.qr(m @ q)
+  b = (m.T @ q).T
+  u_b, s, _ = np.linalg.svd(b, full_matrices=False)
+  u = q @ u_b
+  return u[:, :dim], s[:dim]
+
+
+class TagEmbeddings:
+  """Row-normalized dense tag vectors (TagVocab id → row)."""
+
+  def __init__(self, vectors: np.ndarray):
+    self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+  @property
+  def dim(self) -> int:
+    return self.vectors.shape[1]
+
+  def __len__(self) -> int:
+    return self.vectors.shape[0]
+
+  @classmethod
+  def fit(cls, matrix_data: Dict[int, Dict[int, float]], size: int, dim: int = DEFAULT_EMBEDDING_DIM, seed: int = 0) -> "TagEmbeddings":
+    """
+    Factor the PPMI matrix of `matrix_data` (ids < size) into `dim`-dimensional vectors.
+    タグ a のベクトル = (U S)[a] / ||(U S)[a]|| なので、内積は rank-d 近似した PPMI 行のコサインになる。
+    """
+    m = ppmi_matrix(matrix_data, size)
+    if m.nnz == 0 or size <= 1:
+      return cls(np.zeros((size, max(1, dim)), dtype=np.float32))
+    u, s = randomized_svd(m, dim, seed=seed)
+    vectors = (u * s).astype(np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    if vectors.shape[1] < dim:
+      vectors = np.pad(vectors, ((0, 0), (0, dim - vectors.shape[1])))
+    return cls(vectors)
+
+  def vector(self, tag: int) -> Optional[np.ndarray]:
+    if 0 <= tag < len(self):
+      return self.vectors[tag]
+    return None
+
+  def similarity(self, tag_a: int, tag_b: int) -> float:
+    a, b = self.vector(tag_a), self.vector(tag_b)
+    if a is None or b is None:
+      return 0.0
+    return max(0.0, min(1.0, float(a @ b)))
+
+  def similarities(self, tag: int, others: list[int]) -> np.ndarray:
+    """Similarity of `tag` to each of `others` (clamped to [0, 1])."""
+    v = self.vector(tag)
+    if v is None or not others:
+      return np.zeros(len(others), dtype=np.float32)
+    idx = np.asarray(others, dtype=np.int64)
+    valid = idx < len(self)
+    out = np.zeros(len(idx), dtype=np.float32)
+    out[valid] = self.vectors[idx[valid]] @ v
+    return np.clip(out, 0.0, 1.0)
+
+  def to_file(self) -> dict:
+    return {
+      "format": EMBEDDING_FORMAT,
+      "dim": self.dim,
+      "rows": len(self),
+      "dtype": "float32",
+      "data": base64.b64encode(self.vectors.astype("<f4").tobytes()).decode("ascii"),
+    }
+
+  @classmethod
+  def from_file(cls, data: dict) -> Optional["TagEmbeddings"]:
+    if not data or data.get("format") != EMBEDDING_FORMAT:
+      return None
+    raw = np.frombuffer(base64.b64decode(data["data"]), dtype="<f4")
+    return cls(raw.reshape(data["rows"], data["dim"]))
@@ -0,0 +1,157 @@
+"""
+Process-wide cache of PromptInferenceEngine
+
+学習データの読み込み (JSON のパースと行列の構築) は重いので、
+forever テンプレートやタブごとにエンジンを作らず、このキャッシュから共有する。
+
+- キーは (解決済みパス, base)。ファイルの (mtime, size) が変わったら再読み込みする
+- 既に読み込み済みのエンジンがある場合、再読み込みはバックグラウンドで行い、
+  完了するまでは古いエンジンを返す (完了したら差し替える)
+- 一定時間使われなかったエンジンと、max_entries を超えた古いエンジンは破棄する
+- サンプリング設定 (temperature, top_k など) はキーに含まないので再読み込みは起きない
+"""
+
+import asyncio
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Literal, Optional
+
+from logger import info, warn
+from modules.calculator.inference import PromptInferenceEngine
+
+Base = Literal["matrix", "booru"]
+
+
+@dataclass
+class _Entry:
+  engine: PromptInferenceEngine
+  signature: tuple[int, int]  # (mtime_ns, size)
+  last_used: float = field(default_factory=time.monotonic)
+  # バックグラウンドで読み込み中 / 読み込みに失敗したファイルのシグネチャ
+  loading: Optional[tuple[int, int]] = None
+  failed: Optional[tuple[int, int]] = None
+
+
+class EngineCache:
+  def __init__(self, max_entries: int = 4, idle_seconds: float = 1800.0):
+    self.max_entries = max_entries
+    self.idle_seconds = idle_seconds
+    self._entries: dict[tuple[str, str], _Entry] = {}
+    self._lock = threading.Lock()
+    # 同じファイルの初回読み込みが同時に走らないようにする
+    self._load_locks: dict[tuple[str, str], threading.Lock] = {}
+
+  @staticmethod
+  def _signature(path: Path) -> tuple[int, int]:
+    try:
+      st = path.stat()
+    except FileNotFoundError:
+      raise FileNotFoundError(f"data directory not found at {path}; run training first") from None
+    return (st.st_mtime_ns, st.st_size)
+
+  def get(self, path: str | Path, base: Base = "matrix") -> PromptInferenceEngine:
+    """
+    Engine for the trained data at `path`.
+    初回はその場で読み込む (ブロックする)。ファイルが更新されていた場合は古いエンジンを返しつつ裏で読み直す。
+    """
+    path = Path(path).resolve()
+    key = (str(path), base)
+    try:
+      signature = self._signature(path)
+    except FileNotFoundError:
+      # 学習の書き出し中などでファイルが一時的に無いときは、読み込み済みのエンジンを使い続ける
+      with self._lock:
+        entry = self._entries.get(key)
+        if entry is None:
+          raise
+        entry.last_used = time.monotonic()
+        return entry.engine
+    with self._lock:
+      self._evict(exclude=key)
+      entry = self._entries.get(key)
+      if entry is not None:
+        entry.last_used = time.monotonic()
+        if entry.signature != signature and entry.loading != signature and entry.failed != signature:
+          entry.loading = signature
+          threading.Thread(
+            target=self._reload, args=(key, path, base, signature), daemon=True, name="engine-reload"
+          ).start()
+        return entry.engine
+      load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+    with load_lock:
+      with self._lock:
+        entry = self._entries.get(key)
+        if entry is not None:
+          return entry.engine
+      try:
+        engine = self._load(path, base)
+        with self._lock:
+          self._entries[key] = _Entry(engine, signature)
+          self._evict(exclude=key)
+      finally:
+        # 失敗しても残さない (待っていた呼び出しはそれぞれ読み込みを試す)
+        with self._lock:
+          if self._load_locks.get(key) is load_lock:
+            del self._load_locks[key]
+      return engine
+
+  async def aget(self, path: str | Path, base: Base = "matrix") -> PromptInferenceEngine:
+    """get() without blocking the event loop on the first load."""
+    return await asyncio.to_thread(self.get, path, base)
+
+  def invalidate(self, path: Optional[str | Path] = None) -> None:
+    """Drop the cached engines of `path` (all engines if None)."""
+    with self._lock:
+      if path is None:
+        self._entries.clear()
+        return
+      resolved = str(Path(path).resolve())
+      for key in [k for k in self._entries if k[0] == resolved]:
+        del self._entries[key]
+
+  def _load(self, path: Path, base: Base) -> PromptInferenceEngine:
+    t = time.perf_counter()
+    engine = PromptInferenceEngine(path, base)
+    info(f"[EngineCache] loaded {path} ({base}) in {time.perf_counter() - t:.2f}s")
+    return engine
+
+  def _reload(self, key: tuple[str, str], path: Path, base: Base, signature: tuple[int, int]) -> None:
+    try:
+      engine = self._load(path, base)
+    except Exception as e:
+      warn(f"[EngineCache] failed to reload {path}, keeping the previous engine: {e}")
+      with self._lock:
+        entry = self._entries.get(key)
+        if entry is not None and entry.loading == signature:
+          entry.loading = None
+          entry.failed = signature
+      return
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        # 読み込み中に破棄された
+        return
+      if entry.loading == signature:
+        entry.loading = None
+      elif signature[0] < entry.signature[0]:
+        # 後から始めた新しいファイルの読み込みが先に終わっている
+        return
+      entry.engine = engine
+      entry.signature = signature
+      entry.failed = None
+
+  def _evict(self, exclude: tuple[str, str]) -> None:
+    now = time.monotonic()
+    for key, entry in list(self._entries.items()):
+      if key != exclude and now - entry.last_used > self.idle_seconds:
+        del self._entries[key]
+    if len(self._entries) > self.max_entries:
+      victims = sorted((k for k in self._entries if k != exclude), key=lambda k: self._entries[k].last_used)
+      for key in victims[:len(self._entries) - self.max_entries]:
+        del self._entries[key]
+
+
+engine_cache = EngineCache()
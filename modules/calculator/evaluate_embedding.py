@@ -0,0 +1,104 @@
+"""
+Compare SVD tag embeddings with the exact PPMI cosine similarity
+
+Usage:
+  python modules/calculator/evaluate_embedding.py <trained data.json> [--base matrix] [--k 10] [--sample 500] [--dim 128]
+
+学習データに "<base>.embedding" が無い場合は --dim の次元でその場で作る。
+出力:
+  - overlap@k: 無作為に選んだタグについて、厳密な PPMI コサインの上位 k 近傍と埋め込みの上位 k 近傍の重なり
+  - threshold agreement: 近傍候補について「類似度 >= しきい値」の判定が一致した割合
+  - メモリ (疎な PPMI 行列 vs 埋め込み) と類似度 1 回あたりの時間
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+
+# Add project root to path when running as standalone script
+if __name__ == "__main__":
+  sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from modules.calculator.embedding import DEFAULT_EMBEDDING_DIM, TagEmbeddings, ppmi_matrix
+from modules.calculator.matrix import CooccurrenceMatrix
+from modules.calculator.similarity import SimilarityMatrix
+from modules.calculator.vocab import TagVocab
+
+
+def evaluate(data: dict, base: str = "matrix", k: int = 10, sample: int = 500, dim: int = DEFAULT_EMBEDDING_DIM, threshold: float = 0.3, seed: int = 0) -> dict:
+  vocab = TagVocab.from_list(data["vocab"]) if "vocab" in data else None
+  matrix = CooccurrenceMatrix.from_file(data[base], vocab)
+  size = len(matrix.vocab)
+
+  t = time.perf_counter()
+  embeddings = TagEmbeddings.from_file(data.get(base + ".embedding"))
+  if embeddings is None:
+    embeddings = TagEmbeddings.fit(matrix.matrix, size, dim)
+  fit_time = time.perf_counter() - t
+
+  ppmi = ppmi_matrix(matrix.matrix, size)
+  norms = np.sqrt(np.asarray(ppmi.multiply(ppmi).sum(axis=1)).ravel())
+  inv = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+  unit = (sparse.diags(inv.astype(np.float32)) @ ppmi).tocsr()
+
+  tags = np.flatnonzero(norms > 0)
+  rng = np.random.default_rng(seed)
+  chosen = rng.choice(tags, size=min(sample, len(tags)), replace=False)
+
+  overlaps, agree = [], []
+  for tag in chosen:
+    exact = np.asarray((unit @ unit[tag].T).todense()).ravel()
+    approx = embeddings.vectors[:size] @ embeddings.vectors[tag]
+    exact[tag] = approx[tag] = -np.inf
+    top_exact = set(np.argpartition(-exact, k)[:k].tolist())
+    top_approx = set(np.argpartition(-approx, k)[:k].tolist())
+    overlaps.append(len(top_exact & top_approx) / k)
+    cand = np.fromiter(top_exact | top_approx, dtype=np.int64)
+    agree.append(np.mean((exact[cand] >= threshold) == (approx[cand] >= threshold)))
+
+  # 類似度 1 回あたりの時間 (キャッシュを使わない条件で比較する)
+  pairs = rng.choice(tags, size=(2000, 2))
+  exact_sim = SimilarityMatrix(matrix.matrix)
+  t = time.perf_counter()
+  for a, b in pairs:
+    exact_sim._calculate_similarity(int(a), int(b))
+  exact_us = (time.perf_counter() - t) / len(pairs) * 1e6
+  t = time.perf_counter()
+  for a, b in pairs:
+    embeddings.similarity(int(a), int(b))
+  emb_us = (time.perf_counter() - t) / len(pairs) * 1e6
+
+  return {
+    "tags": int(len(tags)),
+    "dim": embeddings.dim,
+    "k": k,
+    "overlap_at_k": float(np.mean(overlaps)),
+    "threshold": threshold,
+    "threshold_agreement": float(np.mean(agree)),
+    "ppmi_nnz": int(ppmi.nnz),
+    "ppmi_bytes": int(ppmi.data.nbytes + ppmi.indices.nbytes + ppmi.indptr.nbytes),
+    "embedding_bytes": int(embeddings.vectors.nbytes),
+    "fit_seconds": fit_time,
+    "exact_similarity_us": exact_us,
+    "embedding_similarity_us": emb_us,
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Compare SVD tag embeddings with exact PPMI cosine neighbors")
+  parser.add_argument("data", type=Path, help="Trained data file (output of training.train)")
+  parser.add_argument("--base", default="matrix", choices=["matrix", "booru"])
+  parser.add_argument("--k", type=int, default=10, help="Neighbors compared per tag")
+  parser.add_argument("--sample", type=int, default=500, help="Number of tags to sample")
+  parser.add_argument("--dim", type=int, default=DEFAULT_EMBEDDING_DIM, help="Dimensions when the data has no embeddings")
+  parser.add_argument("--threshold", type=float, default=0.3, help="Similarity threshold for the agreement check")
+  args = parser.parse_args()
+
+  with args.data.open("r", encoding="utf-8") as f:
+    data = json.load(f)
+  print(json.dumps(evaluate(data, args.base, args.k, args.sample, args.dim, args.threshold), indent=2))
@@ -0,0 +1,133 @@
+"""
+Size / quality report for pruned and reduced-precision trained data
+
+Usage:
+  python modules/calculator/evaluate_pruning.py <trained data.json> [--min-pmi 0] [--top-k 64] [--min-count 0] [--dtype float16] [--samples 200]
+
+学習データ (枝刈りなし) を読み込み、指定した設定で枝刈り/精度削減したものと比較する。
+--min-count は学習チェックポイント (<stem>.ckpt/state.json) の生カウントを使う。
+出力:
+  - ファイルサイズ、PMI ペア数、エンジンのメモリ (tracemalloc) の前後
+  - 推論結果の変化: 無作為な初期タグについて
+      候補スコア上位 top_k の一致率 (Jaccard)
+      temperature=0 のビームサーチ出力 (決定的) の一致率 (Jaccard)
+"""
+
+import argparse
+import gc
+import json
+import random
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+# Add project root to path when running as standalone script
+if __name__ == "__main__":
+  sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from modules.calculator.delta import TrainingState
+from modules.calculator.inference import PromptInferenceEngine
+from modules.calculator.matrix import CooccurrenceMatrix
+from modules.calculator.vocab import TagVocab
+
+
+def _load_engine(data: dict, base: str) -> tuple[PromptInferenceEngine, int, int]:
+  """Returns (engine, file bytes, traced bytes of the loaded engine)."""
+  raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+  with tempfile.NamedTemporaryFile("wb", suffix=".json", delete=False) as f:
+    f.write(raw)
+    path = Path(f.name)
+  try:
+    gc.collect()
+    tracemalloc.start()
+    engine = PromptInferenceEngine(path, base)
+    gc.collect()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+  finally:
+    path.unlink()
+  return engine, len(raw), memory
+
+
+def _jaccard(a, b) -> float:
+  a, b = set(a), set(b)
+  if not a and not b:
+    return 1.0
+  return len(a & b) / len(a | b)
+
+
+def evaluate(
+  data: dict,
+  base: str = "matrix",
+  min_pmi: float | None = None,
+  top_k: int = 0,
+  min_count: int = 0,
+  dtype: str | None = None,
+  counts_path: Path | None = None,
+  samples: int = 200,
+  gen_top_k: int = 10,
+  seed: int = 0,
+) -> dict:
+  vocab = TagVocab.from_list(data["vocab"]) if "vocab" in data else None
+  matrix = CooccurrenceMatrix.from_file(data[base], vocab)
+  counts = None
+  if min_count > 0 and counts_path is not None:
+    state = TrainingState.load(counts_path)
+    if state is not None:
+      # チェックポイントの語彙は学習データと同じ順序で ID を振っている
+      counts = state.prompt if base == "matrix" else state.booru
+  pruned = matrix.pruned(min_pmi, top_k, min_count, counts)
+
+  reduced = dict(data)
+  reduced[base] = pruned.to_file(None, build_data=True, include_vocab="vocab" not in data, dtype=dtype)
+
+  full_engine, full_bytes, full_mem = _load_engine(data, base)
+  small_engine, small_bytes, small_mem = _load_engine(reduced, base)
+
+  rng = random.Random(seed)
+  rows = [t for t in full_engine.matrix.matrix.keys()]
+  score_overlap, output_overlap = [], []
+  for _ in range(samples):
+    init = [full_engine.vocab.tag(t) for t in rng.sample(rows, min(len(rows), rng.randint(1, 3)))]
+    a = full_engine.score_candidates(init, [], gen_top_k)
+    b = small_engine.score_candidates(init, [], gen_top_k)
+    if a is None or b is None:
+      continue
+    top_a = sorted(a.scores, key=a.scores.get, reverse=True)[:gen_top_k]
+    top_b = sorted(b.scores, key=b.scores.get, reverse=True)[:gen_top_k]
+    score_overlap.append(_jaccard(top_a, top_b))
+    out_a = full_engine._beam_prompt(a, 0.0, gen_top_k, 0.7, beam_width=1, time_budget=1.0)
+    out_b = small_engine._beam_prompt(b, 0.0, gen_top_k, 0.7, beam_width=1, time_budget=1.0)
+    output_overlap.append(_jaccard(out_a, out_b))
+
+  return {
+    "settings": {"min_pmi": min_pmi, "top_k": top_k, "min_count": min_count, "dtype": dtype},
+    "pairs": [matrix.entry_count(), pruned.entry_count()],
+    "file_bytes": [full_bytes, small_bytes],
+    "engine_bytes": [full_mem, small_mem],
+    "file_reduction": full_bytes / max(1, small_bytes),
+    "engine_reduction": full_mem / max(1, small_mem),
+    "candidate_top_k_jaccard": sum(score_overlap) / max(1, len(score_overlap)),
+    "greedy_output_jaccard": sum(output_overlap) / max(1, len(output_overlap)),
+    "samples": len(score_overlap),
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Measure size reduction and inference change of pruned trained data")
+  parser.add_argument("data", type=Path, help="Trained data file trained without pruning")
+  parser.add_argument("--base", default="matrix", choices=["matrix", "booru"])
+  parser.add_argument("--min-pmi", type=float, default=None)
+  parser.add_argument("--top-k", type=int, default=0)
+  parser.add_argument("--min-count", type=int, default=0)
+  parser.add_argument("--dtype", default=None, choices=["float32", "float16"])
+  parser.add_argument("--samples", type=int, default=200)
+  args = parser.parse_args()
+
+  with args.data.open("r", encoding="utf-8") as f:
+    data = json.load(f)
+  counts_path = TrainingState.checkpoint_dir(args.data) / "state.json"
+  print(json.dumps(evaluate(
+    data, args.base, args.min_pmi, args.top_k, args.min_count, args.dtype, counts_path, args.samples
+  ), indent=2))
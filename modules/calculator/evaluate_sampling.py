@@ -0,0 +1,167 @@
+"""
+Check that the Gumbel-top-k candidate sampler matches the previous repeated-softmax sampler
+
+Usage:
+  python modules/calculator/evaluate_sampling.py [--trials 60000] [--seed 0] [--json]
+
+合成した候補 (conflict する組・類似度で弾かれる組・採用済みタグと conflict する候補を含む) から
+PromptInferenceEngine._sample_candidates と以前の実装 (残りの候補の softmax から random.choices で
+1 つずつ引き、conflict/類似なら取り除く) で同じ回数だけ引き、
+順序つきの結果の分布を chi-square 検定で比べる。p 値が --alpha を下回ったら終了コード 1 で終わる。
+"""
+
+import argparse
+import json
+import math
+import random
+import sys
+from collections import Counter
+from pathlib import Path
+
+from scipy.stats import chi2_contingency
+
+# Add project root to path when running as standalone script
+if __name__ == "__main__":
+  sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from modules.calculator.conflict import ConflictMap
+from modules.calculator.inference import PromptInferenceEngine
+
+
+class _PairSimilarity:
+  """Fixed similarity for the listed pairs (0 otherwise)."""
+
+  def __init__(self, pairs: dict[tuple[int, int], float]):
+    self.pairs = {}
+    for (a, b), s in pairs.items():
+      self.pairs[(a, b)] = self.pairs[(b, a)] = s
+
+  def max_similarity(self, tag: int, others: list[int]) -> float:
+    return max((self.pairs.get((tag, o), 0.0) for o in others), default=0.0)
+
+
+# (名前, 候補のスコア, 採用済み, conflict, 類似度, temperature, k, similarity_threshold)
+CASES = [
+  (
+    "conflicts+similarity",
+    {0: 2.0, 1: 1.6, 2: 1.5, 3: 1.2, 4: 1.1, 5: 0.9, 6: 0.8, 7: 0.3},
+    [100],
+    {100: [2], 2: [100], 3: [4], 4: [3]},
+    {(5, 6): 0.9, (0, 7): 0.95},
+    0.7, 3, 0.8,
+  ),
+  (
+    "flat-scores",
+    {i: 1.0 + 0.05 * i for i in range(6)},
+    [],
+    {0: [1], 1: [0]},
+    {},
+    1.0, 2, 0.8,
+  ),
+  (
+    "low-temperature",
+    {0: 3.0, 1: 2.9, 2: 2.5, 3: 1.0, 4: 0.5},
+    [],
+    {},
+    {(0, 1): 0.85},
+    0.3, 2, 0.8,
+  ),
+]
+
+
+def make_engine(conflicts: dict[int, list[int]], similarity: dict[tuple[int, int], float]) -> PromptInferenceEngine:
+  # 学習データは使わないので __init__ を通さず、サンプリングに要るものだけを持たせる
+  engine = PromptInferenceEngine.__new__(PromptInferenceEngine)
+  engine.conflict = ConflictMap(conflicts)
+  engine.similarity = _PairSimilarity(similarity)
+  return engine
+
+
+def legacy_sample(
+  engine: PromptInferenceEngine,
+  candidates: dict[int, float],
+  temperature: float,
+  k: int,
+  selected: list[int],
+  similarity_threshold: float,
+  rng: random.Random,
+) -> list[int]:
+  """The previous _sample_candidates (one softmax over the remaining pool per pick)."""
+  pool = dict(candidates)
+  picks: list[int] = []
+  temp = max(0.05, temperature)
+  while pool and len(picks) < k:
+    max_score = max(pool.values())
+    weight_pairs = []
+    for tag, score in pool.items():
+      w = math.exp((score - max_score) / temp)
+      if math.isfinite(w) and w > 0:
+        weight_pairs.append((tag, w))
+    if not weight_pairs:
+      break
+    tags, weights = zip(*weight_pairs)
+    choice = rng.choices(tags, weights=weights, k=1)[0]
+    if engine.conflict.has_conflict(set(selected) | set(picks), choice):
+      del pool[choice]
+      continue
+    if engine._is_similar(choice, selected + picks, similarity_threshold):
+      del pool[choice]
+      continue
+    picks.append(choice)
+    del pool[choice]
+  return picks
+
+
+def compare(case: tuple, trials: int, seed: int) -> dict:
+  name, candidates, selected, conflicts, similarity, temperature, k, threshold = case
+  engine = make_engine(conflicts, similarity)
+  old_rng, new_rng = random.Random(seed), random.Random(seed + 1)
+  old, new = Counter(), Counter()
+  for _ in range(trials):
+    old[tuple(legacy_sample(engine, candidates, temperature, k, selected, threshold, old_rng))] += 1
+    new[tuple(engine._sample_candidates(candidates, temperature, k, selected, threshold, rng=new_rng))] += 1
+
+  outcomes = sorted(set(old) | set(new))
+  # 期待度数が小さすぎるセルはまとめる (chi-square の近似が崩れないように)
+  rare = [o for o in outcomes if old[o] + new[o] < 10]
+  table = [[old[o] for o in outcomes if o not in rare], [new[o] for o in outcomes if o not in rare]]
+  if rare:
+    table[0].append(sum(old[o] for o in rare))
+    table[1].append(sum(new[o] for o in rare))
+  chi2, p, dof, _ = chi2_contingency(table)
+  return {
+    "case": name,
+    "outcomes": len(outcomes),
+    "chi2": round(float(chi2), 2),
+    "dof": int(dof),
+    "p": round(float(p), 4),
+    "top": [
+      {"picks": list(o), "old": old[o] / trials, "new": new[o] / trials}
+      for o in sorted(outcomes, key=lambda o: -old[o])[:5]
+    ],
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--trials", type=int, default=60_000)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--alpha", type=float, default=0.001)
+  parser.add_argument("--json", action="store_true")
+  args = parser.parse_args()
+
+  results = [compare(case, args.trials, args.seed) for case in CASES]
+  failed = [r for r in results if r["p"] < args.alpha]
+  if args.json:
+    print(json.dumps({"results": results, "ok": not failed}, indent=2))
+  else:
+    for r in results:
+      print(f"{r['case']:>22}  {r['outcomes']} outcomes  chi2={r['chi2']:.2f} (dof {r['dof']})  p={r['p']:.4f}")
+      for t in r["top"]:
+        print(f"{'':>22}  {str(t['picks']):<12} old {t['old']:.4f}  new {t['new']:.4f}")
+    print("OK" if not failed else f"FAILED: {', '.join(r['case'] for r in failed)}")
+  sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+  main()
@@ -1,22 +1,49 @@
+import heapq
 import json
 import math
 import random
 import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Literal
+from typing import Literal, Optional
+
+import numpy as np
 
 from logger import warn
 from modules.calculator.conflict import ConflictMap
+from modules.calculator.embedding import TagEmbeddings
 from modules.calculator.lora_asc import LoRAAssociation
-from modules.calculator.matrix import CooccurrenceMatrix, is_lora_trigger
+from modules.calculator.matrix import CooccurrenceMatrix
 from modules.calculator.preprocessing import PreProcessor
 from modules.calculator.similarity import SimilarityMatrix
+from modules.calculator.vocab import TagVocab, is_lora_trigger
+
+
+@dataclass(frozen=True)
+class ScoredCandidates:
+  """サンプリング前までの決定的なスコアリング結果 (同じ設定なら使い回せる)"""
+  original_init: list[str]
+  always_added: list[str]
+  base_set: list[int]
+  scores: dict[int, float]
 
 
 class PromptInferenceEngine:
   """Co-occurrenceベースで追加タグを提案するための簡易推論エンジン。"""
-
-  def __init__(self, data_dir: str | Path, base: Literal["matrix", "booru"] = "matrix"):
+  
+  # 設定ごとのスコアリング結果を保持する数
+  scored_cache_size: int = 32
+  # ビームサーチで展開する候補数 (top_k に対する倍率と最小値)
+  beam_pool_factor: int = 4
+  beam_pool_min: int = 32
+  # LoRA 同士の conflict スコアに掛けるペナルティ
+  beam_lora_conflict_weight: float = 1.0
+  # time_budget のうち、最良のビームを貪欲法で top_k まで埋めるために残しておく割合
+  beam_fill_reserve: float = 0.2
+
+  def __init__(self, data_dir: str | Path, base: Literal["matrix", "booru"] = "matrix", use_embeddings: bool = True):
     self.data_dir = Path(data_dir)
     if not self.data_dir.exists():
       raise FileNotFoundError(f"data directory not found at {self.data_dir}; run training first")
@@ -24,10 +51,17 @@ class PromptInferenceEngine:
     with open(self.data_dir, "r", encoding="utf-8") as f:
       data = json.load(f)
     
-    self.matrix = CooccurrenceMatrix.from_file(data[base])
-    self.conflict = ConflictMap.from_file(data[base+".conflict"])
-    self.similarity = SimilarityMatrix.from_cooccurrence_matrix(self.matrix)
+    vocab = TagVocab.from_list(data["vocab"]) if "vocab" in data else None
+    self.matrix = CooccurrenceMatrix.from_file(data[base], vocab)
+    self.vocab = self.matrix.vocab
+    self.conflict = ConflictMap.from_file(data[base+".conflict"], self.vocab)
+    # SVD 埋め込みが学習されていれば類似度はその内積で求める
+    embeddings = TagEmbeddings.from_file(data.get(base+".embedding")) if use_embeddings else None
+    self.similarity = SimilarityMatrix.from_cooccurrence_matrix(self.matrix, embeddings)
     self.lora = LoRAAssociation(self.matrix)
+    self._scored_cache: OrderedDict[tuple, Optional[ScoredCandidates]] = OrderedDict()
+    # (id(scored), pool_size, similarity_threshold) -> (scored, pool)。scored を持っておき id の再利用を防ぐ
+    self._beam_pool_cache: OrderedDict[tuple, tuple] = OrderedDict()
     
   @staticmethod
   def _normalize_tag(tag: str) -> str | None:
@@ -46,11 +80,11 @@ class PromptInferenceEngine:
 
     return norm if norm else None
 
-  def _collect_candidates(self, current: set[str], top_k: int) -> dict[str, float]:
-    candidates: dict[str, float] = {}
+  def _collect_candidates(self, current: set[int], top_k: int) -> dict[int, float]:
+    candidates: dict[int, float] = {}
 
     for tag in current:
-      related = self.matrix.get_related_tags(tag, top_k=top_k * 3)
+      related = self.matrix.get_related_ids(tag, top_k=top_k * 3)
       for cand, score in related:
         if score <= 0:
           continue
@@ -60,12 +94,12 @@ class PromptInferenceEngine:
 
     return candidates
 
-  def _apply_lora_boost(self, candidates: dict[str, float], active_loras: dict[str, float]) -> dict[str, float]:
+  def _apply_lora_boost(self, candidates: dict[int, float], active_loras: dict[int, float]) -> dict[int, float]:
     if not candidates or not active_loras:
       return candidates
 
     boosts = self.lora.get_boosted_tags(active_loras, list(candidates.keys()))
-    adjusted: dict[str, float] = {}
+    adjusted: dict[int, float] = {}
 
     for tag, score in candidates.items():
       multiplier = boosts.get(tag, 1.0)
@@ -73,11 +107,11 @@ class PromptInferenceEngine:
 
     return adjusted
 
-  def _apply_rating_bias(self, candidates: dict[str, float], target_rating: str, force_rating: float, strength: float) -> dict[str, float]:
+  def _apply_rating_bias(self, candidates: dict[int, float], target_rating: str, force_rating: float, strength: float) -> dict[int, float]:
     if not candidates or strength <= 0:
       return candidates
 
-    biased: dict[str, float] = {}
+    biased: dict[int, float] = {}
 
     for tag, score in candidates.items():
       rating_prob = self.matrix.rating_matrix.get(tag, {}).get(str(target_rating), 0.0)
@@ -86,8 +120,8 @@ class PromptInferenceEngine:
 
     return biased
 
-  def _filter_conflicts(self, candidates: dict[str, float], current: set[str], negatives: set[str]) -> dict[str, float]:
-    filtered: dict[str, float] = {}
+  def _filter_conflicts(self, candidates: dict[int, float], current: set[int], negatives: set[int]) -> dict[int, float]:
+    filtered: dict[int, float] = {}
 
     for tag, score in candidates.items():
       if tag in negatives:
@@ -100,23 +134,22 @@ class PromptInferenceEngine:
 
     return filtered
 
-  def _is_similar(self, tag: str, selected: list[str], threshold: float) -> bool:
-    for existing in selected:
-      if self.similarity.calculate_similarity(tag, existing) >= threshold:
-        return True
-    return False
+  def _is_similar(self, tag: int, selected: list[int], threshold: float) -> bool:
+    if not selected:
+      return False
+    return self.similarity.max_similarity(tag, selected) >= threshold
 
   def _apply_negative_penalty(
     self,
-    candidates: dict[str, float],
-    negatives: set[str],
+    candidates: dict[int, float],
+    negatives: set[int],
     strength: float,
     threshold: float,
-  ) -> dict[str, float]:
+  ) -> dict[int, float]:
     if not candidates or not negatives:
       return candidates
 
-    adjusted: dict[str, float] = {}
+    adjusted: dict[int, float] = {}
 
     for tag, score in candidates.items():
       if tag in negatives:
@@ -156,46 +189,55 @@ class PromptInferenceEngine:
 
   def _sample_candidates(
     self,
-    candidates: dict[str, float],
+    candidates: dict[int, float],
     temperature: float,
     k: int,
-    selected: list[str],
+    selected: list[int],
     similarity_threshold: float,
-  ) -> list[str]:
+    rng: random.Random = None,
+  ) -> list[int]:
+    """
+    softmax(score / temperature) に従って重複なしで k 個選ぶ。
+
+    Gumbel-top-k (exponential race): E ~ Exp(1) に対して log(E) - log(w) の昇順は
+    「残りの候補から softmax で1つ引いて取り除く」を繰り返した順序と同じ分布になる。
+    そのため候補ごとに一度だけキーを作り、ヒープから順に取り出して
+    競合/類似で弾かれたものを飛ばせばよい (O(C + k log C))。
+    """
     if not candidates:
       return []
+    if rng is None:
+      rng = random
 
-    pool = dict(candidates)
-    picks: list[str] = []
     temp = max(0.05, temperature)
+    max_score = max(candidates.values())
+    heap: list[tuple[float, int]] = []
+    for tag, score in candidates.items():
+      log_w = (score - max_score) / temp
+      if not math.isfinite(log_w):
+        continue
+      heap.append((math.log(max(rng.expovariate(1.0), 5e-324)) - log_w, tag))
+    heapq.heapify(heap)
 
-    while pool and len(picks) < k:
-      tags = list(pool.keys())
-      scores = list(pool.values())
-      max_score = max(scores)
-      weight_pairs = []
-      for tag, score in zip(tags, scores):
-        w = math.exp((score - max_score) / temp)
-        if math.isfinite(w) and w > 0:
-          weight_pairs.append((tag, w))
-
-      if not weight_pairs:
-        break
-
-      tags, weights = zip(*weight_pairs)
+    picks: list[int] = []
+    accepted = list(selected)
+    # 採用済みタグと競合するタグの集合 (ConflictMap は双方向)
+    blocked: set[int] = set()
+    for tag in selected:
+      blocked |= self.conflict.conflicts.get(tag, set())
 
-      choice = random.choices(tags, weights=weights, k=1)[0]
+    while heap and len(picks) < k:
+      _, choice = heapq.heappop(heap)
 
-      if self.conflict.has_conflict(set(selected) | set(picks), choice):
-        del pool[choice]
+      if choice in blocked:
         continue
 
-      if self._is_similar(choice, selected + picks, similarity_threshold):
-        del pool[choice]
+      if self._is_similar(choice, accepted, similarity_threshold):
         continue
 
       picks.append(choice)
-      del pool[choice]
+      accepted.append(choice)
+      blocked |= self.conflict.conflicts.get(choice, set())
 
     return picks
   
@@ -219,45 +261,77 @@ class PromptInferenceEngine:
         continue
     return w
 
-  def generate_prompt(
+  def score_candidates(
     self,
     init_tags: list[str],
     init_negatives: list[str] = ["worst quality", "1boy"],
-    temperature: float = 1.0,
     top_k: int = 10,
-    similarity_threshold: float = 0.7,
     target_rating: Literal["general", "sensitive", "explicit"] = "general",
     rating_strength: float = 1.0,
     force_rating: float = 0.0,
     negative_strength: float = float("inf"),
     negative_threshold: float = 0.05,
     append_always_tags: bool = True,
-  ) -> list[str]:
+  ) -> Optional[ScoredCandidates]:
+    """
+    _collect_candidates → _apply_lora_boost → _apply_rating_bias → _apply_negative_penalty → _filter_conflicts
+    までの決定的な部分を実行する。結果は設定ごとにキャッシュされる。
+    """
+    key = (
+      tuple(init_tags), tuple(init_negatives), top_k, target_rating,
+      rating_strength, force_rating, negative_strength, negative_threshold, append_always_tags,
+    )
+    if key in self._scored_cache:
+      self._scored_cache.move_to_end(key)
+      return self._scored_cache[key]
+
+    scored = self._score_candidates(
+      init_tags, init_negatives, top_k, target_rating,
+      rating_strength, force_rating, negative_strength, negative_threshold, append_always_tags,
+    )
+    self._scored_cache[key] = scored
+    if len(self._scored_cache) > self.scored_cache_size:
+      self._scored_cache.popitem(last=False)
+    return scored
+
+  def _score_candidates(
+    self,
+    init_tags: list[str],
+    init_negatives: list[str],
+    top_k: int,
+    target_rating: str,
+    rating_strength: float,
+    force_rating: float,
+    negative_strength: float,
+    negative_threshold: float,
+    append_always_tags: bool,
+  ) -> Optional[ScoredCandidates]:
     original_init = list(dict.fromkeys(init_tags))
-    active_loras: dict[str, float] = {}
+    active_loras: dict[int, float] = {}
     for t in init_tags:
       if not is_lora_trigger(t):
         continue
       norm = PreProcessor.normalize_tag(t)
-      if norm is None:
+      if norm is None or norm not in self.vocab:
         continue
-      active_loras[norm] = self.get_lora_weight(t)
+      active_loras[self.vocab.get(norm)] = self.get_lora_weight(t)
 
     normalized = PreProcessor.seprompt(init_tags)
     negative_tags = PreProcessor.seprompt(init_negatives)
-    negative_set = set(negative_tags)
+    # 学習データに無いタグは共起・競合・類似度を持たないので ID 空間では無視してよい
+    negative_set = set(self.vocab.encode(negative_tags, add=False))
 
     if not normalized or len(normalized) == 0:
-      return []
+      return None
 
-    base_set = list(dict.fromkeys(normalized))
+    base_set = list(dict.fromkeys(self.vocab.encode(normalized, add=False)))
 
     always_added: list[str] = []
     if append_always_tags:
       for tag in self.matrix.always_tag:
         if tag not in base_set and not self.conflict.has_conflict(set(base_set), tag):
           base_set.append(tag)
-          always_added.append(tag)
+          always_added.append(self.vocab.tag(tag))
 
     candidate_scores = self._collect_candidates(set(base_set), max(1, top_k))
     candidate_scores = self._apply_lora_boost(candidate_scores, active_loras)
@@ -275,16 +349,295 @@ class PromptInferenceEngine:
     )
     candidate_scores = self._filter_conflicts(candidate_scores, set(base_set), negative_set)
 
+    return ScoredCandidates(original_init, always_added, base_set, candidate_scores)
+
+  def _sample_prompt(
+    self,
+    scored: ScoredCandidates,
+    temperature: float,
+    top_k: int,
+    similarity_threshold: float,
+    rng: random.Random = None,
+  ) -> list[str]:
     picks = self._sample_candidates(
-      candidate_scores,
+      scored.scores,
       temperature=temperature,
       k=max(1, top_k),
-      selected=base_set,
+      selected=scored.base_set,
       similarity_threshold=similarity_threshold,
+      rng=rng,
+    )
+    return scored.original_init + scored.always_added + self.vocab.decode(picks)
+
+  def _beam_pool(self, scored: ScoredCandidates, top_k: int, similarity_threshold: float, deadline: Optional[float] = None):
+    """
+    ビームサーチ用に上位候補を配列化する。
+    Returns (ids, scale, unary, pair, conflict, similar_to_base)
+      scale: 最大の候補スコア
+      unary: 候補スコア / scale
+      pair: 候補同士の PMI から LoRA 同士の conflict を引いたもの (対角は 0)
+      conflict: 候補同士の競合 (ConflictMap)
+      similar_to_base: base_set のいずれかと類似度がしきい値以上
+    
+    作った配列は scored ごとにキャッシュする。deadline (time.perf_counter() の値) を過ぎたら
+    そこまでに処理したスコア上位の候補だけで打ち切る (打ち切った配列はキャッシュしない)。
+    """
+    pool_size = max(self.beam_pool_min, self.beam_pool_factor * top_k)
+    key = (id(scored), pool_size, similarity_threshold)
+    cached = self._beam_pool_cache.get(key)
+    if cached is not None and cached[0] is scored:
+      self._beam_pool_cache.move_to_end(key)
+      return cached[1]
+    
+    items = heapq.nlargest(pool_size, scored.scores.items(), key=lambda x: x[1])
+    ids = [tag for tag, _ in items]
+    m = len(ids)
+    unary = np.asarray([score for _, score in items], dtype=np.float64)
+    scale = float(unary[0]) if m > 0 and unary[0] > 0 else 1.0
+    unary /= scale
+    
+    index = {tag: i for i, tag in enumerate(ids)}
+    pair = np.zeros((m, m), dtype=np.float64)
+    conflict = np.zeros((m, m), dtype=bool)
+    similar_to_base = np.zeros(m, dtype=bool)
+    done = m
+    for i, tag in enumerate(ids):
+      if deadline is not None and time.perf_counter() >= deadline:
+        done = i
+        break
+      row = self.matrix.matrix.get(tag)
+      if row:
+        # 短い方を走査する
+        if len(row) < m:
+          for other, pmi in row.items():
+            j = index.get(other)
+            if j is not None:
+              pair[i, j] = pmi
+        else:
+          for j, other in enumerate(ids):
+            pmi = row.get(other)
+            if pmi is not None:
+              pair[i, j] = pmi
+      for other in self.conflict.conflicts.get(tag, ()):
+        j = index.get(other)
+        if j is not None:
+          conflict[i, j] = conflict[j, i] = True
+      if self.vocab.is_lora(tag):
+        for other, score in self.matrix.lora_conflict_matrix.get(tag, {}).items():
+          j = index.get(other)
+          if j is not None:
+            pair[i, j] -= self.beam_lora_conflict_weight * score
+            pair[j, i] -= self.beam_lora_conflict_weight * score
+      if scored.base_set:
+        similar_to_base[i] = self._is_similar(tag, scored.base_set, similarity_threshold)
+    
+    if done < m:
+      # 行 i < done は列 j >= done も書いているので正方形に切り出す
+      ids, unary = ids[:done], unary[:done]
+      pair, conflict, similar_to_base = pair[:done, :done], conflict[:done, :done], similar_to_base[:done]
+    np.fill_diagonal(pair, 0.0)
+    pool = (ids, scale, unary, pair, conflict, similar_to_base)
+    if done == m:
+      self._beam_pool_cache[key] = (scored, pool)
+      if len(self._beam_pool_cache) > self.scored_cache_size:
+        self._beam_pool_cache.popitem(last=False)
+    return pool
+
+  def _beam_prompt(
+    self,
+    scored: ScoredCandidates,
+    temperature: float,
+    top_k: int,
+    similarity_threshold: float,
+    beam_width: int = 4,
+    time_budget: float = 0.05,
+    coherence_weight: float = 1.0,
+    rng: random.Random = None,
+  ) -> list[str]:
+    """
+    ビームサーチで top_k 個のタグを選ぶ。
+    
+    部分プロンプト S の評価値は候補ごとの追加ゲインの和:
+      gain(c | S) = unary[c] + coherence_weight * mean_{s in S} pair[c, s]
+    unary は候補スコア (PMI + LoRA boost + rating/negative 補正) の正規化値、
+    pair は候補同士の PMI (LoRA 同士の conflict はペナルティとして引かれる)。
+    ConflictMap の競合と類似度しきい値を超える組み合わせは展開しない。
+    
+    各ビームの全候補へのゲインは行列演算で一度に計算する。
+    temperature > 0 のときは unary に Gumbel ノイズを加えて毎回異なる結果にする。
+    
+    time_budget (秒) は候補の配列化も含めた上限で、その (1 - beam_fill_reserve) までを
+    配列化とビームの展開に使い、残りで最良のビームを貪欲法で top_k まで埋める。
+    時間の確認は候補 1 行の配列化・類似度 1 回・候補の並べ替え 1 回ごとに行うので、
+    超過はそのうち最も重い 1 回分 (既定のプールの大きさで数十 µs) まで。
+    時間内に埋めきれなかった場合は top_k より少ないタグを返す。
+    """
+    start = time.perf_counter()
+    budget = max(0.0, time_budget)
+    deadline = start + budget
+    beam_deadline = start + budget * (1.0 - self.beam_fill_reserve)
+    if rng is None:
+      rng = random
+    k = max(1, top_k)
+    ids, scale, unary, pair, conflict, similar_to_base = self._beam_pool(scored, k, similarity_threshold, beam_deadline)
+    m = len(ids)
+    if m == 0:
+      return scored.original_init + scored.always_added
+    
+    if temperature > 0:
+      # score / temperature + Gumbel と同じ順序になる摂動 (beam_width=1, coherence_weight=0 なら sample モードと同じ分布)
+      noise = np.asarray([-math.log(max(rng.expovariate(1.0), 5e-324)) for _ in range(m)])
+      unary = unary + max(0.05, temperature) / scale * noise
+    
+    # 類似度は候補同士のペアを遅延評価する (埋め込みがあれば実質ベクトル演算)
+    similar_cache: dict[tuple[int, int], bool] = {}
+    def is_similar(i: int, selected: tuple[int, ...]) -> bool:
+      for j in selected:
+        key = (i, j) if i < j else (j, i)
+        v = similar_cache.get(key)
+        if v is None:
+          v = self.similarity.calculate_similarity(ids[i], ids[j]) >= similarity_threshold
+          similar_cache[key] = v
+        if v:
+          return True
+      return False
+    
+    base_blocked = similar_to_base.copy()
+    # beam: (score, selected indices, blocked mask, pair sum vector)
+    beams = [(0.0, (), base_blocked, np.zeros(m))]
+    width = max(1, beam_width)
+    
+    def expand(beam, limit, until):
+      score, selected, blocked, acc = beam
+      mean = acc / len(selected) if selected else acc
+      gains = unary + coherence_weight * mean
+      gains = np.where(blocked, -np.inf, gains)
+      order = np.argsort(-gains)
+      out = []
+      for i in order:
+        if not np.isfinite(gains[i]) or len(out) >= limit:
+          break
+        if time.perf_counter() >= until:
+          break
+        if is_similar(int(i), selected):
+          continue
+        # blocked | conflict[i] は新しい配列なので呼び出し側で書き換えてよい
+        out.append((score + gains[i], selected + (int(i),), blocked | conflict[i], acc + pair[i], int(i)))
+      return out
+    
+    finished = False
+    while not finished and len(beams[0][1]) < k:
+      if time.perf_counter() >= beam_deadline:
+        break
+      expanded = []
+      for beam in beams:
+        # 1段の展開中でも時間切れなら、展開済みのビームだけで次に進む
+        if expanded and time.perf_counter() >= beam_deadline:
+          break
+        for score, selected, blocked, acc, i in expand(beam, width, beam_deadline):
+          blocked[i] = True
+          expanded.append((score, selected, blocked, acc))
+      if not expanded:
+        # 時間切れで 1 つも展開できなかった場合は貪欲法に任せる
+        finished = time.perf_counter() < beam_deadline
+        break
+      # 同じタグ集合に到達したビームは1つにまとめる
+      seen = set()
+      unique = []
+      for beam in sorted(expanded, key=lambda b: b[0], reverse=True):
+        key = frozenset(beam[1])
+        if key in seen:
+          continue
+        seen.add(key)
+        unique.append(beam)
+        if len(unique) >= width:
+          break
+      beams = unique
+    
+    best = beams[0]
+    # 時間切れの場合は残しておいた時間で最良のビームを貪欲に埋める
+    while not finished and len(best[1]) < k and time.perf_counter() < deadline:
+      nxt = expand(best, 1, deadline)
+      if not nxt:
+        break
+      score, selected, blocked, acc, i = nxt[0]
+      blocked[i] = True
+      best = (score, selected, blocked, acc)
+    
+    picks = [ids[i] for i in best[1]]
+    return scored.original_init + scored.always_added + self.vocab.decode(picks)
+
+  def generate_prompt(
+    self,
+    init_tags: list[str],
+    init_negatives: list[str] = ["worst quality", "1boy"],
+    temperature: float = 1.0,
+    top_k: int = 10,
+    similarity_threshold: float = 0.7,
+    target_rating: Literal["general", "sensitive", "explicit"] = "general",
+    rating_strength: float = 1.0,
+    force_rating: float = 0.0,
+    negative_strength: float = float("inf"),
+    negative_threshold: float = 0.05,
+    append_always_tags: bool = True,
+    mode: Literal["sample", "beam"] = "sample",
+    beam_width: int = 4,
+    time_budget: float = 0.05,
+  ) -> list[str]:
+    """
+    mode="sample": softmax(score / temperature) から独立にサンプリングする
+    mode="beam": 候補同士の PMI の一貫性も考慮したビームサーチ (time_budget 秒以内, see _beam_prompt)
+    """
+    scored = self.score_candidates(
+      init_tags, init_negatives, top_k, target_rating,
+      rating_strength, force_rating, negative_strength, negative_threshold, append_always_tags,
     )
+    if scored is None:
+      return []
+    if mode == "beam":
+      return self._beam_prompt(scored, temperature, top_k, similarity_threshold, beam_width, time_budget)
+    return self._sample_prompt(scored, temperature, top_k, similarity_threshold)
 
-    combined = original_init + always_added + picks
-    return combined
+  def generate_prompts(
+    self,
+    n: int,
+    init_tags: list[str],
+    init_negatives: list[str] = ["worst quality", "1boy"],
+    temperature: float = 1.0,
+    top_k: int = 10,
+    similarity_threshold: float = 0.7,
+    target_rating: Literal["general", "sensitive", "explicit"] = "general",
+    rating_strength: float = 1.0,
+    force_rating: float = 0.0,
+    negative_strength: float = float("inf"),
+    negative_threshold: float = 0.05,
+    append_always_tags: bool = True,
+    seed: Optional[int] = None,
+    mode: Literal["sample", "beam"] = "sample",
+    beam_width: int = 4,
+    time_budget: float = 0.05,
+  ) -> list[list[str]]:
+    """
+    同じ設定で n 個のプロンプトを生成する。
+    候補のスコアリングは一度だけ行い、各プロンプトはそこから独立にサンプリングする。
+    seed を指定すると結果が再現可能になる。
+    """
+    scored = self.score_candidates(
+      init_tags, init_negatives, top_k, target_rating,
+      rating_strength, force_rating, negative_strength, negative_threshold, append_always_tags,
+    )
+    if scored is None or n <= 0:
+      return [[] for _ in range(max(0, n))]
+    rng = random.Random(seed)
+    if mode == "beam":
+      return [
+        self._beam_prompt(scored, temperature, top_k, similarity_threshold, beam_width, time_budget, rng=rng)
+        for _ in range(n)
+      ]
+    return [
+      self._sample_prompt(scored, temperature, top_k, similarity_threshold, rng)
+      for _ in range(n)
+    ]
 
   def generate_prompt_text(
     self,
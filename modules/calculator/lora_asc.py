@@ -7,11 +7,118 @@ Features:
 1. Recommend tags highly associated with specific LoRAs
 2. Detect conflicts between multiple active LoRAs
 3. Prioritize LoRA-related tags in prompt generation
+
+LoRA triggers and tags are TagVocab ids (see vocab.py); the examples below
+show the tag strings for readability.
 """
 
-from typing import Dict, List, Set, Tuple, Optional
+from typing import Dict, Iterable, List, Set, Tuple, Optional
 import re
 
+import numpy as np
+from scipy import sparse
+
+# 学習時に保存する LoRA ごとの近傍数 (similarity / conflict)
+LORA_TOP_K = 50
+
+# PMI がこの値を超える/下回るタグを「反対の関連」として扱う (conflict)
+LORA_CONFLICT_PMI = 0.5
+
+
+class LoRAProfiles:
+    """
+    Sparse LoRA × tag matrix of PMI associations.
+    
+    Pairwise LoRA similarity (cosine of PPMI vectors) and conflict scores
+    (mean |pmi_a - pmi_b| / 2 over tags with opposite associations) are
+    computed with sparse matrix products, block by block, so memory stays
+    bounded by block_size × LoRA count.
+    """
+    
+    def __init__(self, lora_matrix: Dict[int, Dict[int, float]]):
+        self.loras: List[int] = list(lora_matrix.keys())
+        self.index: Dict[int, int] = {lora: i for i, lora in enumerate(self.loras)}
+        
+        tag_index: Dict[int, int] = {}
+        rows, cols, values = [], [], []
+        for i, lora in enumerate(self.loras):
+            for tag, pmi in lora_matrix[lora].items():
+                j = tag_index.setdefault(tag, len(tag_index))
+                rows.append(i)
+                cols.append(j)
+                values.append(pmi)
+        self.tags: List[int] = list(tag_index.keys())
+        
+        shape = (len(self.loras), len(self.tags))
+        pmi = sparse.csr_matrix(
+            (np.asarray(values, dtype=np.float32), (rows, cols)), shape=shape
+        )
+        pmi.sum_duplicates()
+        self.pmi = pmi
+        
+        # Row-normalized PPMI for cosine similarity
+        ppmi = pmi.maximum(0).tocsr()
+        norms = np.sqrt(np.asarray(ppmi.multiply(ppmi).sum(axis=1)).ravel())
+        inv = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+        self.unit = sparse.diags(inv.astype(np.float32)) @ ppmi
+        
+        # Opposite-association components for conflict scores
+        pos = pmi.multiply(pmi > LORA_CONFLICT_PMI).tocsr()
+        neg = (-pmi).multiply(pmi < -LORA_CONFLICT_PMI).tocsr()
+        self.pos_value, self.neg_value = pos, neg
+        self.pos_ind = (pos > 0).astype(np.float32)
+        self.neg_ind = (neg > 0).astype(np.float32)
+    
+    def __len__(self) -> int:
+        return len(self.loras)
+    
+    def similarity_block(self, rows: np.ndarray) -> np.ndarray:
+        """Dense (len(rows), L) cosine similarity block clamped to [0, 1]."""
+        block = (self.unit[rows] @ self.unit.T).toarray()
+        return np.clip(block, 0.0, 1.0)
+    
+    def conflict_block(self, rows: np.ndarray) -> np.ndarray:
+        """Dense (len(rows), L) conflict score block in [0, 1]."""
+        pv, pi = self.pos_value[rows], self.pos_ind[rows]
+        nv, ni = self.neg_value[rows], self.neg_ind[rows]
+        total = (
+            pv @ self.neg_ind.T + pi @ self.neg_value.T
+            + nv @ self.pos_ind.T + ni @ self.pos_value.T
+        ).toarray() / 2.0
+        count = (pi @ self.neg_ind.T + ni @ self.pos_ind.T).toarray()
+        score = np.divide(total, count, out=np.zeros_like(total), where=count > 0)
+        return np.minimum(1.0, score)
+    
+    def _top_k_row(self, values: np.ndarray, k: int, skip: int) -> Dict[int, float]:
+        values = values.copy()
+        values[skip] = 0.0
+        candidates = np.flatnonzero(values > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-values[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-values[candidates], kind="stable")]
+        return {self.loras[j]: float(values[j]) for j in candidates}
+    
+    def top_k(
+        self,
+        rows: Optional[Iterable[int]] = None,
+        k: int = LORA_TOP_K,
+        block_size: int = 256
+    ) -> Iterable[Tuple[int, np.ndarray, np.ndarray, Dict[int, float], Dict[int, float]]]:
+        """
+        Yields (row, similarity_values, conflict_values, top_k_similar, top_k_conflicting)
+        for each requested LoRA row.
+        """
+        rows = np.arange(len(self.loras)) if rows is None else np.asarray(list(rows), dtype=np.int64)
+        for start in range(0, len(rows), block_size):
+            chunk = rows[start:start + block_size]
+            sim = self.similarity_block(chunk)
+            conf = self.conflict_block(chunk)
+            for n, i in enumerate(chunk):
+                yield (
+                    int(i), sim[n], conf[n],
+                    self._top_k_row(sim[n], k, i), self._top_k_row(conf[n], k, i)
+                )
+
 
 class LoRAAssociation:
     """
@@ -42,18 +149,23 @@ class LoRAAssociation:
         self._similarity_cache = matrix_data.lora_similarity_matrix
         self._conflict_cache = matrix_data.lora_conflict_matrix
         
-        # PPMI vector cache for on-demand calculations
-        self._ppmi_cache: Dict[str, Dict[str, float]] = {}
-        self._norm_cache: Dict[str, float] = {}
+        # Sparse LoRA × tag matrix for on-demand calculations (built lazily)
+        self._profiles: Optional[LoRAProfiles] = None
+    
+    @property
+    def profiles(self) -> LoRAProfiles:
+        if self._profiles is None:
+            self._profiles = LoRAProfiles(self.lora_matrix)
+        return self._profiles
     
     
     def get_related_tags(
         self,
-        lora_name: str,
-        activation_tags: Optional[List[str]] = None,
+        lora_name: int,
+        activation_tags: Optional[List[int]] = None,
         top_k: int = 20,
         min_score: float = 0.5
-    ) -> List[Tuple[str, float]]:
+    ) -> List[Tuple[int, float]]:
         """
         Get tags most associated with a specific LoRA.
         
@@ -90,10 +202,10 @@ class LoRAAssociation:
     
     def get_boosted_tags(
         self,
-        active_loras: Dict[str, float],
-        candidate_tags: List[str],
+        active_loras: Dict[int, float],
+        candidate_tags: List[int],
         boost_factor: float = 1.5
-    ) -> Dict[str, float]:
+    ) -> Dict[int, float]:
         """
         Calculate boost scores for tags based on active LoRAs.
         
@@ -145,14 +257,14 @@ class LoRAAssociation:
     
     def detect_lora_conflicts(
         self,
-        lora_a: str,
-        lora_b: str
-    ) -> Tuple[float, List[str]]:
+        lora_a: int,
+        lora_b: int
+    ) -> Tuple[float, List[int]]:
         """
         Detect conflicts between two LoRAs.
         
-        Uses pre-calculated conflict matrix if available (from training),
-        otherwise calculates on-demand.
+        Uses pre-calculated top-k conflict matrix if available (from training),
+        otherwise calculates on-demand with the sparse LoRA × tag matrix.
         
         Conflicts are identified by:
         1. Tags with opposite associations (positive for A, negative for B)
@@ -175,42 +287,31 @@ class LoRAAssociation:
             return (self._conflict_cache[lora_b][lora_a], [])
         
         
-        # Calculate on-demand (not in pre-calculated matrix)
+        # Calculate on-demand (not in pre-calculated top-k matrix)
         if lora_a not in self.lora_matrix or lora_b not in self.lora_matrix:
             return (0.0, [])
         
+        profiles = self.profiles
+        conflict_score = float(profiles.conflict_block(np.array([profiles.index[lora_a]]))[0, profiles.index[lora_b]])
+        if conflict_score <= 0:
+            return (0.0, [])
+        
         tags_a = self.lora_matrix[lora_a]
         tags_b = self.lora_matrix[lora_b]
-        
-        conflicting_tags = []
-        conflict_score = 0.0
-        comparison_count = 0
-        
-        # Find tags that have opposite associations
-        common_tags = set(tags_a.keys()) & set(tags_b.keys())
-        
-        for tag in common_tags:
-            pmi_a = tags_a[tag]
-            pmi_b = tags_b[tag]
-            
-            # Check for opposite associations
-            if (pmi_a > 0.5 and pmi_b < -0.5) or (pmi_a < -0.5 and pmi_b > 0.5):
-                conflicting_tags.append(tag)
-                conflict_score += abs(pmi_a - pmi_b) / 2.0
-                comparison_count += 1
-        
-        # Normalize conflict score
-        if comparison_count > 0:
-            conflict_score = min(1.0, conflict_score / comparison_count)
+        conflicting_tags = [
+            tag for tag in tags_a.keys() & tags_b.keys()
+            if (tags_a[tag] > LORA_CONFLICT_PMI and tags_b[tag] < -LORA_CONFLICT_PMI)
+            or (tags_a[tag] < -LORA_CONFLICT_PMI and tags_b[tag] > LORA_CONFLICT_PMI)
+        ]
         
         return (conflict_score, conflicting_tags)
 
     
     def check_multi_lora_compatibility(
         self,
-        active_loras: List[str],
+        active_loras: List[int],
         conflict_threshold: float = 0.6
-    ) -> Dict[str, List[Tuple[str, float]]]:
+    ) -> Dict[str, List[Tuple[int, float]]]:
         """
         Check compatibility between multiple active LoRAs.
         
@@ -245,11 +346,11 @@ class LoRAAssociation:
     
     def get_recommended_tags_for_loras(
         self,
-        active_loras: List[str],
-        current_tags: Set[str],
+        active_loras: List[int],
+        current_tags: Set[int],
         top_k: int = 10,
         min_score: float = 0.3
-    ) -> List[Tuple[str, float, List[str]]]:
+    ) -> List[Tuple[int, float, List[int]]]:
         """
         Get recommended tags based on all active LoRAs.
         
@@ -273,8 +374,8 @@ class LoRAAssociation:
             recs = lora.get_recommended_tags_for_loras(loras, current)
             # [("blue_eyes", 2.5, ["<lora:A>", "<lora:B>"]), ...]
         """
-        tag_scores: Dict[str, float] = {}
-        tag_lora_support: Dict[str, List[str]] = {}
+        tag_scores: Dict[int, float] = {}
+        tag_lora_support: Dict[int, List[int]] = {}
         
         for lora in active_loras:
             if lora not in self.lora_matrix:
@@ -303,49 +404,7 @@ class LoRAAssociation:
         
         return recommendations[:top_k]
     
-    def _get_lora_ppmi_vector(self, lora: str) -> Dict[str, float]:
-        """
-        Get PPMI (Positive PMI) vector for a LoRA.
-        
-        The vector represents "which tags does this LoRA co-occur with?"
-        Used for calculating LoRA-to-LoRA similarity.
-        """
-        if lora in self._lora_ppmi_cache:
-            return self._lora_ppmi_cache[lora]
-        
-        if lora not in self.lora_matrix:
-            self._lora_ppmi_cache[lora] = {}
-            return {}
-        
-        # Convert PMI to PPMI (keep only positive associations)
-        ppmi_vector = {
-            tag: max(0.0, pmi_score)
-            for tag, pmi_score in self.lora_matrix[lora].items()
-        }
-        
-        self._lora_ppmi_cache[lora] = ppmi_vector
-        return ppmi_vector
-    
-    def _get_lora_vector_norm(self, lora: str) -> float:
-        """
-        Calculate L2 norm of LoRA's PPMI vector.
-        Used for cosine similarity calculation.
-        """
-        if lora in self._lora_norm_cache:
-            return self._lora_norm_cache[lora]
-        
-        ppmi_vector = self._get_lora_ppmi_vector(lora)
-        
-        if not ppmi_vector:
-            self._lora_norm_cache[lora] = 0.0
-            return 0.0
-        
-        import math
-        norm = math.sqrt(sum(score ** 2 for score in ppmi_vector.values()))
-        self._lora_norm_cache[lora] = norm
-        return norm
-    
-    def calculate_lora_similarity(self, lora_a: str, lora_b: str) -> float:
+    def calculate_lora_similarity(self, lora_a: int, lora_b: int) -> float:
         """
         Calculate similarity between two LoRAs based on their usage patterns.
         
@@ -382,35 +441,20 @@ class LoRAAssociation:
         
 
         
-        # Calculate on-demand using PPMI vectors
-        ppmi_a = self._get_lora_ppmi_vector(lora_a)
-        ppmi_b = self._get_lora_ppmi_vector(lora_b)
-        
-        if not ppmi_a or not ppmi_b:
-            return 0.0
-        
-        # Calculate dot product (shared tag associations)
-        shared_tags = set(ppmi_a.keys()) & set(ppmi_b.keys())
-        dot_product = sum(ppmi_a[tag] * ppmi_b[tag] for tag in shared_tags)
-        
-        # Calculate norms
-        norm_a = self._get_lora_vector_norm(lora_a)
-        norm_b = self._get_lora_vector_norm(lora_b)
-        
-        if norm_a == 0.0 or norm_b == 0.0:
+        # Calculate on-demand (cosine of the sparse PPMI rows)
+        if lora_a not in self.lora_matrix or lora_b not in self.lora_matrix:
             return 0.0
         
-        # Cosine similarity
-        similarity = dot_product / (norm_a * norm_b)
-        return max(0.0, min(1.0, similarity))
+        profiles = self.profiles
+        return float(profiles.similarity_block(np.array([profiles.index[lora_a]]))[0, profiles.index[lora_b]])
 
     
     def get_similar_loras(
         self,
-        lora: str,
+        lora: int,
         top_k: int = 5,
         min_similarity: float = 0.3
-    ) -> List[Tuple[str, float]]:
+    ) -> List[Tuple[int, float]]:
         """
         Find LoRAs with similar usage patterns.
         
@@ -436,16 +480,22 @@ class LoRAAssociation:
         if lora not in self.lora_matrix:
             return []
         
-        similarities = []
-        
-        for other_lora in self.lora_matrix.keys():
-            if other_lora == lora:
-                continue
-            
-            similarity = self.calculate_lora_similarity(lora, other_lora)
-            
-            if similarity >= min_similarity:
-                similarities.append((other_lora, similarity))
+        # Pre-calculated top-k neighbors are enough when they cover the request
+        cached = self._similarity_cache.get(lora)
+        if cached is not None and len(cached) >= top_k:
+            similarities = [
+                (other, score) for other, score in cached.items()
+                if other != lora and score >= min_similarity
+            ]
+        else:
+            profiles = self.profiles
+            i = profiles.index[lora]
+            values = profiles.similarity_block(np.array([i]))[0]
+            similarities = [
+                (profiles.loras[j], float(values[j]))
+                for j in np.flatnonzero(values >= max(min_similarity, np.finfo(np.float32).tiny))
+                if j != i
+            ]
         
         # Sort by similarity (descending)
         similarities.sort(key=lambda x: x[1], reverse=True)
@@ -1,37 +1,59 @@
 import asyncio
+import heapq
 import json
 import math
-import re
-from collections import defaultdict
 from pathlib import Path
 from typing import Dict, List, Optional, Set, Tuple
 
-LORA_TRIGGER_PATTERN = r"^<lora:(.*)?>"
+import numpy as np
 
-def is_lora_trigger(tag: str) -> bool:
-  """Check if a tag is a LoRA trigger (e.g., <lora:name:weight>)"""
-  return re.match(LORA_TRIGGER_PATTERN, tag.strip()) is not None
+from modules.calculator.delta import CooccurrenceCounts
+from modules.calculator.lora_asc import LORA_TOP_K, LoRAProfiles
+from modules.calculator.vocab import TagVocab, encode_rows, pack_rows, unpack_rows
+
+# 学習済みデータのマトリクス形式 (2: TagVocab の ID をキーにした行形式)
+MATRIX_FORMAT = 2
 
 class CooccurrenceMatrix:
-    """Manages tag co-occurrence probabilities using PMI (Pointwise Mutual Information)"""
+    """
+    Manages tag co-occurrence probabilities using PMI (Pointwise Mutual Information)
+    
+    All internal structures are keyed by TagVocab ids. The string-based helpers
+    (get_related_tags / get_probability) translate at the boundary.
+    """
     
     def __init__(
       self,
-      matrix: Dict[str, Dict[str, float]],
-      counts: Dict[str, int],
-      lora_matrix: Dict[str, Dict[str, float]],
-      rating_matrix: Dict[str, Dict[str, float]],
-      always_tag: List[str],
-      lora_similarity_matrix: Optional[Dict[str, Dict[str, float]]],
-      lora_conflict_matrix: Optional[Dict[str, Dict[str, float]]]
+      matrix: Dict[int, Dict[int, float]],
+      counts: Dict[int, int],
+      lora_matrix: Dict[int, Dict[int, float]],
+      rating_matrix: Dict[int, Dict[str, float]],
+      always_tag: List[int],
+      lora_similarity_matrix: Optional[Dict[int, Dict[int, float]]],
+      lora_conflict_matrix: Optional[Dict[int, Dict[int, float]]],
+      vocab: TagVocab
     ):
-        self.matrix: Dict[str, Dict[str, float]] = matrix
-        self.counts: Dict[str, int] = counts
-        self.lora_matrix: Dict[str, Dict[str, float]] = lora_matrix
-        self.rating_matrix: Dict[str, Dict[str, float]] = rating_matrix
-        self.always_tag: List[str] = always_tag
-        self.lora_similarity_matrix: Dict[str, Dict[str, float]] = lora_similarity_matrix
-        self.lora_conflict_matrix: Dict[str, Dict[str, float]] = lora_conflict_matrix
+        self.matrix: Dict[int, Dict[int, float]] = matrix
+        self.counts: Dict[int, int] = counts
+        self.lora_matrix: Dict[int, Dict[int, float]] = lora_matrix
+        self.rating_matrix: Dict[int, Dict[str, float]] = rating_matrix
+        self.always_tag: List[int] = always_tag
+        self.lora_similarity_matrix: Dict[int, Dict[int, float]] = lora_similarity_matrix
+        self.lora_conflict_matrix: Dict[int, Dict[int, float]] = lora_conflict_matrix
+        self.vocab: TagVocab = vocab
+
+    def get_related_ids(self, tag_id: int, top_k: int = 50) -> List[Tuple[int, float]]:
+        """get_related_tags for vocabulary ids."""
+        row = self.matrix.get(tag_id)
+        if row is None:
+            return []
+
+        related = sorted(
+            row.items(),
+            key=lambda x: x[1],
+            reverse=True
+        )
+        return related[:top_k]
 
     def get_related_tags(self, tag: str, top_k: int = 50) -> List[Tuple[str, float]]:
         """
@@ -44,15 +66,10 @@ class CooccurrenceMatrix:
         Returns:
             List of (tag, pmi_score) tuples sorted by PMI score (highest first)
         """
-        if tag not in self.matrix:
+        tag_id = self.vocab.get(tag)
+        if tag_id is None:
             return []
-
-        related = sorted(
-            self.matrix[tag].items(),
-            key=lambda x: x[1],
-            reverse=True
-        )
-        return related[:top_k]
+        return [(self.vocab.tag(i), score) for i, score in self.get_related_ids(tag_id, top_k)]
 
     def get_probability(self, tag_a: str, tag_b: str) -> float:
         """
@@ -61,13 +78,21 @@ class CooccurrenceMatrix:
         Negative PMI = negative association / mutual exclusion
         PMI around 0 = independent tags
         """
-        if tag_a in self.matrix and tag_b in self.matrix[tag_a]:
-            return self.matrix[tag_a][tag_b]
+        a, b = self.vocab.get(tag_a), self.vocab.get(tag_b)
+        if a is None or b is None:
             return 0.0
+        return self.matrix.get(a, {}).get(b, 0.0)
 
     @classmethod
-    def from_file(cls, path: Path | dict) -> "CooccurrenceMatrix":
-        """Load matrix from JSON file"""
+    def from_file(cls, path: Path | dict, vocab: Optional[TagVocab] = None) -> "CooccurrenceMatrix":
+        """
+        Load matrix from JSON file
+        
+        Args:
+            path: JSON file or already loaded data
+            vocab: Vocabulary the ids refer to (shared with the other matrices of the file).
+                Old string-keyed data is converted into it (a new one is created if None).
+        """
         if isinstance(path, dict):
           data = path
         else:
@@ -75,234 +100,357 @@ class CooccurrenceMatrix:
             raise FileNotFoundError(f"Co-occurrence matrix not found at {path}")
           with open(path, "r", encoding="utf-8") as f:
             data = json.load(f)
+        
+        if data.get("format") != MATRIX_FORMAT:
+          # 旧形式 (タグ文字列がキー)
+          vocab = vocab if vocab is not None else TagVocab()
+          return cls(
+              matrix=encode_rows(data.get("matrix", {}), vocab),
+              counts={vocab.add(t): c for t, c in data.get("counts", {}).items()},
+              lora_matrix=encode_rows(data.get("lora_matrix", {}), vocab),
+              rating_matrix={vocab.add(t): r for t, r in data.get("rating_matrix", {}).items()},
+              always_tag=vocab.encode(data.get("always_tag", [])),
+              lora_similarity_matrix=encode_rows(data.get("lora_similarity_matrix", {}), vocab),
+              lora_conflict_matrix=encode_rows(data.get("lora_conflict_matrix", {}), vocab),
+              vocab=vocab
+          )
+        
+        if vocab is None:
+          vocab = TagVocab.from_list(data["vocab"])
+        size = len(vocab)
+        ids, counts = data.get("counts", [[], []])
         return cls(
-            matrix=data.get("matrix", {}),
-            counts=data.get("counts", {}),
-            lora_matrix=data.get("lora_matrix", {}),
-            rating_matrix=data.get("rating_matrix", {}),
+            matrix=unpack_rows(data.get("matrix", []), size),
+            counts=dict(zip(ids, counts)),
+            lora_matrix=unpack_rows(data.get("lora_matrix", []), size),
+            rating_matrix={row: ratings for row, ratings in data.get("rating_matrix", [])},
             always_tag=data.get("always_tag", []),
-            lora_similarity_matrix=data.get("lora_similarity_matrix", {}),
-            lora_conflict_matrix=data.get("lora_conflict_matrix", {})
+            lora_similarity_matrix=unpack_rows(data.get("lora_similarity_matrix", []), size),
+            lora_conflict_matrix=unpack_rows(data.get("lora_conflict_matrix", []), size),
+            vocab=vocab
         )
 
-    def to_file(self, path: Path, build_data: bool = False) -> None:
-        """Save matrix to JSON file"""
+    def to_file(self, path: Path, build_data: bool = False, include_vocab: bool = True, dtype: Optional[str] = None) -> None:
+        """
+        Save matrix to JSON file
+        
+        Args:
+            include_vocab: Embed the vocabulary (disable when the caller stores a shared one)
+            dtype: Store the PMI rows as "float32" / "float16" binary instead of JSON numbers
+        """
         data = {
-                "matrix": self.matrix,
-                "counts": self.counts,
-                "lora_matrix": self.lora_matrix,
-                "rating_matrix": self.rating_matrix,
+                "format": MATRIX_FORMAT,
+                "matrix": pack_rows(self.matrix, dtype),
+                "counts": [list(self.counts.keys()), list(self.counts.values())],
+                "lora_matrix": pack_rows(self.lora_matrix, dtype),
+                "rating_matrix": [[row, ratings] for row, ratings in self.rating_matrix.items()],
                 "always_tag": self.always_tag,
-                "lora_similarity_matrix": self.lora_similarity_matrix,
-                "lora_conflict_matrix": self.lora_conflict_matrix
+                "lora_similarity_matrix": pack_rows(self.lora_similarity_matrix),
+                "lora_conflict_matrix": pack_rows(self.lora_conflict_matrix)
             }
+        if include_vocab:
+            data["vocab"] = self.vocab.to_list()
         if build_data: return data
         
         path.parent.mkdir(parents=True, exist_ok=True)
         with open(path, "w", encoding="utf-8") as f:
             json.dump(
               data, 
-              f, ensure_ascii=False, indent=2
+              f, ensure_ascii=False, separators=(",", ":")
             )
     
+    def pruned(
+        self,
+        min_pmi: Optional[float] = None,
+        top_k: int = 0,
+        min_count: int = 0,
+        counts: Optional[CooccurrenceCounts] = None,
+    ) -> "CooccurrenceMatrix":
+        """
+        Copy with the PMI rows (tag and LoRA) pruned for export.
+        
+        学習チェックポイントは差分学習のため枝刈りしない。書き出す学習データだけに使う。
+        
+        Args:
+            min_pmi: Drop pairs with PMI below this value (0.0 drops every negative association)
+            top_k: Keep only the top-K pairs by PMI per row (0 = unlimited)
+            min_count: Drop pairs that co-occurred fewer times than this (requires counts)
+            counts: Raw counts the matrix was built from
+        """
+        def prune(rows: Dict[int, Dict[int, float]]) -> Dict[int, Dict[int, float]]:
+            out = {}
+            for tag, row in rows.items():
+                items = row.items()
+                if min_pmi is not None:
+                    items = [(o, v) for o, v in items if v >= min_pmi]
+                if min_count > 0 and counts is not None:
+                    co = counts.cooccur.get(tag, {})
+                    items = [(o, v) for o, v in items if co.get(o, 0) >= min_count]
+                if top_k > 0 and len(items) > top_k:
+                    items = heapq.nlargest(top_k, items, key=lambda x: x[1])
+                if items:
+                    out[tag] = dict(items)
+            return out
+        
+        return CooccurrenceMatrix(
+            prune(self.matrix), self.counts, prune(self.lora_matrix), self.rating_matrix, self.always_tag,
+            self.lora_similarity_matrix, self.lora_conflict_matrix, self.vocab
+        )
+
+    def entry_count(self) -> int:
+        """Number of stored PMI pairs (tag and LoRA rows)."""
+        return sum(len(r) for r in self.matrix.values()) + sum(len(r) for r in self.lora_matrix.values())
+
     @classmethod
     async def build_cls(
-      cls, tag_lists: list[list[str]], rating: list[str], min_sample: int = 250
+      cls, tag_lists: list[list[str]], rating: list[str], min_sample: int = 250, vocab: Optional[TagVocab] = None
     ):
-      matrix_data, tag_counts, lora_matrix, always_tag = await asyncio.to_thread(cls.create_matrix, tag_lists=tag_lists)
-      rating_matrix = await asyncio.to_thread(cls.create_rating_matrix, tag_lists=tag_lists, each_ratings=rating, min_sample=min_sample)
-      lora_similarity, lora_conflict = await asyncio.to_thread(cls.create_lora_metrices, lora_matrix=lora_matrix)
-      
-      return cls(
-        matrix_data, tag_counts, lora_matrix, rating_matrix, always_tag,
-        lora_similarity, lora_conflict
-      )
+      vocab = vocab if vocab is not None else TagVocab()
+      counts = CooccurrenceCounts()
+      for tags, r in zip(tag_lists, rating):
+        counts.add(vocab.encode(tags), r)
+      return await asyncio.to_thread(cls.from_counts, counts, vocab, min_sample)
+
+    @staticmethod
+    def _place_row(
+        tag: int,
+        row: Dict[int, float],
+        vocab: TagVocab,
+        matrix_data: Dict[int, Dict[int, float]],
+        lora_matrix: Dict[int, Dict[int, float]],
+        always_tag: List[int]
+    ) -> None:
+        """Put a PMI row into the matrix it belongs to (tag / LoRA / always_tag)."""
+        if len(row) == 0:
+          return
+        row = {k: v for k, v in row.items() if v != 0}
+        if len(row) == 0:
+          always_tag.append(tag)
+        elif vocab.is_lora(tag):
+          lora_matrix[tag] = row
+        else:
+          matrix_data[tag] = row
+
+    @staticmethod
+    def create_matrix_from_counts(counts: CooccurrenceCounts, vocab: TagVocab) -> tuple[dict[int, dict[int, float]], dict[int, int], dict[int, dict[int, float]], list[int]]:
+        """Calculate PMI rows for every tag id in the raw counts."""
+        matrix_data: Dict[int, Dict[int, float]] = {}
+        lora_matrix: Dict[int, Dict[int, float]] = {}
+        always_tag = []
+
+        for tag in counts.cooccur.keys():
+          CooccurrenceMatrix._place_row(tag, counts.pmi_row(tag), vocab, matrix_data, lora_matrix, always_tag)
+
+        return matrix_data, counts.counts, lora_matrix, always_tag
 
     @staticmethod
-    def create_matrix(tag_lists: List[List[str]]) -> tuple[dict[str, dict[str, float]], dict[str, int], dict[str, dict[str, float]], list[str]]:
+    def create_matrix(tag_lists: List[List[str]], vocab: TagVocab) -> tuple[dict[int, dict[int, float]], dict[int, int], dict[int, dict[int, float]], list[int]]:
         """
         Args:
           tag_lists: List of tag sets (e.g., from generation logs)
+          vocab: Vocabulary to intern the tags into
 
         Returns:
-          Tuple of (co-occurrence matrix, tag counts, lora matrix)
+          Tuple of (co-occurrence matrix, tag counts, lora matrix, always tags), keyed by vocab ids
         """
-        # Count co-occurrences
-        cooccur_counts: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
-        total_documents = len(tag_lists)
-        tag_counts: Dict[str, int] = defaultdict(int)
-        matrix_data: Dict[str, Dict[str, float]] = {}
-        lora_matrix: Dict[str, Dict[str, float]] = {}
-        always_tag = []
-        
-
+        counts = CooccurrenceCounts()
         for tags in tag_lists:
-          unique_tags = list(set(tags))  # Remove duplicates within a set
-
-          for tag in unique_tags:
-            tag_counts[tag] += 1
-            for other_tag in unique_tags:
-              if tag != other_tag:
-                cooccur_counts[tag][other_tag] += 1
-
-        # Calculate PMI scores
-        for tag, others in cooccur_counts.items():
-          p_tag = tag_counts[tag] / total_documents  # P(tag)
-
-          # matrix_data[tag] = {}
-          d = {}
-
-          for other_tag, cooccur_count in others.items():
-            p_other = tag_counts[other_tag] / total_documents  # P(other)
-            p_together = cooccur_count / total_documents  # P(tag, other)
-
-            # PMI = log(P(tag, other) / (P(tag) * P(other)))
-            if p_tag > 0 and p_other > 0 and p_together > 0:
-              pmi = math.log(p_together / (p_tag * p_other))
-
-              # Normalize PMI to [0, 1] range using sigmoid-like transformation
-              # Positive PMI = strong association, negative PMI = weak/negative association
-              # We use max(0, pmi) to keep only positive associations
-              # normalized_pmi = max(0.0, pmi)
-
-              # matrix_data[tag][other_tag] = pmi
-              d[other_tag] = pmi
-          
-          if len(d) > 0:
-            d = {k: v for k, v in d.items() if v != 0}
-            if len(d) == 0:
-              always_tag.append(tag)
-            else:
-              if is_lora_trigger(tag):
-                lora_matrix[tag] = d
-              else:
-                matrix_data[tag] = d
-        
-        
-        return matrix_data, tag_counts, lora_matrix, always_tag
+          counts.add(vocab.encode(tags))
+
+        return CooccurrenceMatrix.create_matrix_from_counts(counts, vocab)
+
+    @staticmethod
+    def create_rating_matrix_from_counts(counts: CooccurrenceCounts, min_sample: int = 250) -> dict[int, dict[str, float]]:
+        steering_matrix: dict[int, dict[str, float]] = {}
+        for tag in counts.rating_counts.keys():
+          row = counts.rating_row(tag, min_sample)
+          if row is not None:
+            steering_matrix[tag] = row
+        return steering_matrix
 
     @staticmethod
     def create_rating_matrix(
         tag_lists: list[list[str]], 
         each_ratings: list[str | int | float],
+        vocab: TagVocab,
         min_sample: int = 250
-    ) -> dict[str, dict[str, float]]:
+    ) -> dict[int, dict[str, float]]:
         if len(tag_lists) != len(each_ratings):
             raise ValueError(
                 f"tag_lists and each_ratings must have the same length: "
                 f"{len(tag_lists)} != {len(each_ratings)}"
             )
         
-        ratings_str = [str(r) for r in each_ratings]
-        
-        tag_counts: dict[str, int] = defaultdict(int)
-        tag_rating_counts: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
-        
-        for tags, rating in zip(tag_lists, ratings_str):
-            unique_tags = list(set(tags))
-            
-            for tag in unique_tags:
-                tag_counts[tag] += 1
-                tag_rating_counts[tag][rating] += 1
+        counts = CooccurrenceCounts()
+        for tags, rating in zip(tag_lists, each_ratings):
+            counts.add(vocab.encode(tags), rating)
         
-        steering_matrix: dict[str, dict[str, float]] = {}
-        
-        for tag, rating_dict in tag_rating_counts.items():
-            total_tag_count = tag_counts[tag]
-            if total_tag_count < min_sample:
-              continue
-            
-            steering_matrix[tag] = {}
-            
-            for rating, cooccur_count in rating_dict.items():
-                probability = cooccur_count / total_tag_count
-                steering_matrix[tag][rating] = probability
-        
-        return steering_matrix
+        return CooccurrenceMatrix.create_rating_matrix_from_counts(counts, min_sample)
+
+    @classmethod
+    def from_counts(cls, counts: CooccurrenceCounts, vocab: TagVocab, min_sample: int = 250) -> "CooccurrenceMatrix":
+        """Build every matrix from raw counts (full rebuild without re-reading the dataset)."""
+        matrix_data, tag_counts, lora_matrix, always_tag = cls.create_matrix_from_counts(counts, vocab)
+        rating_matrix = cls.create_rating_matrix_from_counts(counts, min_sample)
+        lora_similarity, lora_conflict = cls.create_lora_metrices(lora_matrix=lora_matrix)
+        return cls(
+          matrix_data, dict(tag_counts), lora_matrix, rating_matrix, always_tag,
+          lora_similarity, lora_conflict, vocab
+        )
+
+    def apply_counts_delta(
+        self,
+        counts: CooccurrenceCounts,
+        touched: Set[int],
+        previous_total: int,
+        min_sample: int = 250
+    ) -> Set[int]:
+        """
+        Update the matrices in place after `counts` was changed for the `touched` tag ids.
+
+        - Rows of touched tags are recomputed from counts.
+        - In other rows only the columns of touched tags are recomputed.
+        - When the document count changed, every remaining PMI value is shifted by
+          log(N_new / N_old) (PMI = log(c_ab) + log(N) - log(c_a) - log(c_b)).
+
+        Returns:
+            Set of row tags whose PMI values were recomputed
+        """
+        shift = 0.0
+        if previous_total > 0 and counts.total > 0 and previous_total != counts.total:
+          shift = math.log(counts.total / previous_total)
+
+        affected_rows = set(touched) | set(self.always_tag)
+        column_rows = counts.neighbors(touched) - affected_rows
+
+        for tag in affected_rows:
+          self.matrix.pop(tag, None)
+          self.lora_matrix.pop(tag, None)
+        self.always_tag = [t for t in self.always_tag if t not in affected_rows]
+
+        if shift != 0.0:
+          for rows in (self.matrix, self.lora_matrix):
+            for row in rows.values():
+              for other in row:
+                row[other] += shift
+
+        for tag in column_rows:
+          row = self.lora_matrix.get(tag) if self.vocab.is_lora(tag) else self.matrix.get(tag)
+          if row is None:
+            affected_rows.add(tag)
+            continue
+          full = counts.pmi_row(tag)
+          for other in touched:
+            value = full.get(other, 0.0)
+            if value != 0:
+              row[other] = value
+            else:
+              row.pop(other, None)
+          if len(row) == 0:
+            self.matrix.pop(tag, None)
+            self.lora_matrix.pop(tag, None)
+            self._place_row(tag, full, self.vocab, self.matrix, self.lora_matrix, self.always_tag)
+
+        for tag in affected_rows:
+          self._place_row(tag, counts.pmi_row(tag), self.vocab, self.matrix, self.lora_matrix, self.always_tag)
+
+        self.counts = dict(counts.counts)
+        for tag in touched:
+          row = counts.rating_row(tag, min_sample)
+          if row is None:
+            self.rating_matrix.pop(tag, None)
+          else:
+            self.rating_matrix[tag] = row
+
+        changed_rows = affected_rows | column_rows
+        changed_loras = {t for t in changed_rows if self.vocab.is_lora(t)}
+        if changed_loras or shift != 0.0:
+          self.lora_similarity_matrix, self.lora_conflict_matrix = self.create_lora_metrices(
+            lora_matrix=self.lora_matrix,
+            only=changed_loras if shift == 0.0 else None,
+            previous=(self.lora_similarity_matrix, self.lora_conflict_matrix)
+          )
+        return changed_rows
     
     @staticmethod
     def create_lora_metrices(
-        lora_matrix: Dict[str, Dict[str, float]]
-    ) -> Tuple[Dict[str, Dict[str, float]], Dict[str, Dict[str, float]]]:
+        lora_matrix: Dict[int, Dict[int, float]],
+        only: Optional[Set[int]] = None,
+        previous: Optional[Tuple[Dict[int, Dict[int, float]], Dict[int, Dict[int, float]]]] = None,
+        top_k: int = LORA_TOP_K
+    ) -> Tuple[Dict[int, Dict[int, float]], Dict[int, Dict[int, float]]]:
         """
         Pre-calculate LoRA similarity and conflict matrices for persistence.
         
-        This is computationally expensive, so we do it once during training
-        and save the results to JSON.
+        Scores are calculated with sparse matrix products over a LoRA × tag
+        matrix (see LoRAProfiles) and only the top-k neighbors per LoRA are kept,
+        so the saved data grows with L·k instead of L².
         
         Args:
             lora_matrix: LoRA -> tag -> PMI associations
+            only: If given (with previous), only pairs involving these LoRAs are recalculated
+            previous: Previously calculated (similarity, conflict) matrices to update
+            top_k: Number of neighbors stored per LoRA
         
         Returns:
             Tuple of (lora_similarity_matrix, lora_conflict_matrix)
-            - lora_similarity_matrix: lora_a -> lora_b -> similarity_score
-            - lora_conflict_matrix: lora_a -> lora_b -> conflict_score
+            - lora_similarity_matrix: lora_a -> {lora_b: similarity_score} (top-k, > 0)
+            - lora_conflict_matrix: lora_a -> {lora_b: conflict_score} (top-k, > 0)
         """
-        lora_list = list(lora_matrix.keys())
+        similarity_matrix: Dict[int, Dict[int, float]] = {}
+        conflict_matrix: Dict[int, Dict[int, float]] = {}
+        if len(lora_matrix) == 0:
+            return similarity_matrix, conflict_matrix
         
-        # Helper: Calculate PPMI vector for a LoRA
-        def get_ppmi_vector(lora: str) -> Dict[str, float]:
-            if lora not in lora_matrix:
-                return {}
-            return {
-                tag: max(0.0, pmi)
-                for tag, pmi in lora_matrix[lora].items()
-            }
+        profiles = LoRAProfiles(lora_matrix)
+        
+        if only is None or previous is None:
+            for i, _, _, sim, conf in profiles.top_k(k=top_k):
+                lora = profiles.loras[i]
+                similarity_matrix[lora] = sim
+                conflict_matrix[lora] = conf
+            return similarity_matrix, conflict_matrix
+        
+        # Keep rows/pairs that are not affected by the delta
+        shortened: Set[int] = set()
+        for target, prev in zip((similarity_matrix, conflict_matrix), previous):
+            for lora_a, row in (prev or {}).items():
+                if lora_a not in lora_matrix or lora_a in only:
+                    continue
+                target[lora_a] = {
+                    lora_b: score for lora_b, score in row.items()
+                    if lora_b in lora_matrix and lora_b not in only
+                }
+                if len(row) >= top_k and len(target[lora_a]) < len(row):
+                    shortened.add(lora_a)
         
-        # Helper: Calculate L2 norm
-        def get_vector_norm(ppmi_vector: Dict[str, float]) -> float:
-            if not ppmi_vector:
-                return 0.0
-            return math.sqrt(sum(score ** 2 for score in ppmi_vector.values()))
+        # Recalculate changed rows and merge their scores into the other rows
+        rows = [profiles.index[lora] for lora in only if lora in profiles.index]
+        touched_rows: Set[int] = set()
+        for i, sim_values, conf_values, sim, conf in profiles.top_k(rows, k=top_k):
+            lora_a = profiles.loras[i]
+            similarity_matrix[lora_a] = sim
+            conflict_matrix[lora_a] = conf
+            for target, values in ((similarity_matrix, sim_values), (conflict_matrix, conf_values)):
+                for j in np.flatnonzero(values > 0):
+                    lora_b = profiles.loras[j]
+                    if j == i or lora_b in only:
+                        continue
+                    target.setdefault(lora_b, {})[lora_a] = float(values[j])
+                    touched_rows.add(lora_b)
         
-        # Calculate all pairwise similarities and conflicts
-        similarity_matrix: Dict[str, Dict[str, float]] = defaultdict(dict)
-        conflict_matrix: Dict[str, Dict[str, float]] = defaultdict(dict)
+        for target in (similarity_matrix, conflict_matrix):
+            for lora in touched_rows:
+                row = target.get(lora)
+                if row is not None and len(row) > top_k:
+                    target[lora] = dict(sorted(row.items(), key=lambda x: x[1], reverse=True)[:top_k])
         
-        for i, lora_a in enumerate(lora_list):
-            ppmi_a = get_ppmi_vector(lora_a)
-            norm_a = get_vector_norm(ppmi_a)
-            
-            for lora_b in lora_list[i+1:]:
-                ppmi_b = get_ppmi_vector(lora_b)
-                norm_b = get_vector_norm(ppmi_b)
-                
-                # Calculate similarity (cosine similarity of PPMI vectors)
-                similarity = 0.0
-                if ppmi_a and ppmi_b and norm_a > 0 and norm_b > 0:
-                    shared_tags = set(ppmi_a.keys()) & set(ppmi_b.keys())
-                    dot_product = sum(ppmi_a[tag] * ppmi_b[tag] for tag in shared_tags)
-                    similarity = max(0.0, min(1.0, dot_product / (norm_a * norm_b)))
-                
-                # Store bidirectionally
-                similarity_matrix[lora_a][lora_b] = similarity
-                similarity_matrix[lora_b][lora_a] = similarity
-                
-                # Calculate conflict (opposite associations)
-                conflict_score = 0.0
-                if lora_a in lora_matrix and lora_b in lora_matrix:
-                    tags_a = lora_matrix[lora_a]
-                    tags_b = lora_matrix[lora_b]
-                    common_tags = set(tags_a.keys()) & set(tags_b.keys())
-                    
-                    conflicting_count = 0
-                    total_conflict = 0.0
-                    
-                    for tag in common_tags:
-                        pmi_a = tags_a[tag]
-                        pmi_b = tags_b[tag]
-                        
-                        # Check for opposite associations
-                        if (pmi_a > 0.5 and pmi_b < -0.5) or (pmi_a < -0.5 and pmi_b > 0.5):
-                            total_conflict += abs(pmi_a - pmi_b) / 2.0
-                            conflicting_count += 1
-                    
-                    if conflicting_count > 0:
-                        conflict_score = min(1.0, total_conflict / conflicting_count)
-                
-                # Store bidirectionally
-                conflict_matrix[lora_a][lora_b] = conflict_score
-                conflict_matrix[lora_b][lora_a] = conflict_score
+        # 上位 k 件が埋まっていた行から変わった近傍を外した場合、新しいスコアが下がっていると
+        # 保存していない k+1 番目以降と入れ替わるので、その行だけ計算し直す
+        refill = [profiles.index[lora] for lora in shortened if lora in profiles.index]
+        for i, _, _, sim, conf in profiles.top_k(refill, k=top_k):
+            lora = profiles.loras[i]
+            similarity_matrix[lora] = sim
+            conflict_matrix[lora] = conf
         
-        # Convert defaultdicts to regular dicts for JSON serialization
-        return dict(similarity_matrix), dict(conflict_matrix)
+        return similarity_matrix, conflict_matrix
@@ -16,8 +16,69 @@ from modules.utils.prompt import PromptPiece
 from modules.utils.lora_util import is_lora_trigger
 from modules.config import get_config
 from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 config = get_config()
 
+@lru_cache(maxsize=1 << 18)
+def _normalize_tag(tag: str) -> Optional[str | tuple[str, ...]]:
+  """normalize_tag の本体 (キャッシュされるため複数タグは tuple で返す)"""
+  tag = tag.strip()
+  p = []
+  if is_lora_trigger(tag):
+    return re.sub(r"(<lora:[^:>]+):[^>]+>", r"\1>", tag)
+  elif "<lora:" in tag:
+    tags = tag.split()
+    for t in tags:
+      if is_lora_trigger(t):
+        p.append(re.sub(r"(<lora:[^:>]+):[^>]+>", r"\1>", t))
+        tag = tag.replace(t, "")
+    tag = " ".join(tag.split())
+    if tag.strip() == "":
+      return tuple(p)
+  
+  if any(
+    tag == b for b in ["BREAK"]
+  ):
+    return None
+  if any(
+    tag.startswith(b) for b in ["score_"]
+  ):
+    return None
+  if any(
+    tag.startswith(b) for b in ["BREAK", "ADD"]
+  ):
+    if "," in tag:  
+      tag = ",".join(tag.split(",")[1:])
+    elif "\n" in tag:
+      tag = "\n".join(tag.split("\n")[1:])
+    else:
+      tag = " ".join(tag.split()[1:])
+    if tag == "," or tag == "\n" or tag == "":
+      return None
+  
+  tag = tag.lower()
+  norm = " ".join(tag.replace("_", " ").split())
+
+  # 外側の未エスケープ括弧を削除
+  norm = re.sub(r"(?<!\\)^[\(\[\{]+", "", norm)
+  norm = re.sub(r"(?<!\\)[\)\]\}]+$", "", norm)
+
+  # 未エスケープの weight を削除
+  norm = re.sub(r"(?<!\\):[0-9]+(?:\.[0-9]+)?$", "", norm)
+
+  # 末尾の未エスケープ区切り
+  norm = re.sub(r"(?<!\\)[,:]+$", "", norm)
+  norm = re.sub(r"[\u200b\u200c\u200d\ufeff\xa0]", "", norm)
+  
+  if "." in norm or "" == norm.strip(): 
+    return None 
+  
+  if len(p) >= 1:
+    p.append(norm)
+    return tuple(p)
+  return norm
+
+
 class PreProcessor:
   def __init__(
     self, 
@@ -37,60 +98,9 @@ class PreProcessor:
   
   @staticmethod
   def normalize_tag(tag: str) -> Optional[str | list[str]]:
-    tag = tag.strip()
-    p = []
-    if is_lora_trigger(tag):
-      return re.sub(r"(<lora:[^:>]+):[^>]+>", r"\1>", tag)
-    elif "<lora:" in tag:
-      tags = tag.split()
-      for t in tags:
-        if is_lora_trigger(t):
-          p.append(re.sub(r"(<lora:[^:>]+):[^>]+>", r"\1>", t))
-          tag = tag.replace(t, "")
-      tag = " ".join(tag.split())
-      if tag.strip() == "":
-        return p
-    
-    if any(
-      tag == b for b in ["BREAK"]
-    ):
-      return None
-    if any(
-      tag.startswith(b) for b in ["score_"]
-    ):
-      return None
-    if any(
-      tag.startswith(b) for b in ["BREAK", "ADD"]
-    ):
-      if "," in tag:  
-        tag = ",".join(tag.split(",")[1:])
-      elif "\n" in tag:
-        tag = "\n".join(tag.split("\n")[1:])
-      else:
-        tag = " ".join(tag.split()[1:])
-      if tag == "," or tag == "\n" or tag == "":
-        return None
-    
-    tag = tag.lower()
-    norm = " ".join(tag.replace("_", " ").split())
-
-    # 外側の未エスケープ括弧を削除
-    norm = re.sub(r"(?<!\\)^[\(\[\{]+", "", norm)
-    norm = re.sub(r"(?<!\\)[\)\]\}]+$", "", norm)
-
-    # 未エスケープの weight を削除
-    norm = re.sub(r"(?<!\\):[0-9]+(?:\.[0-9]+)?$", "", norm)
-
-    # 末尾の未エスケープ区切り
-    norm = re.sub(r"(?<!\\)[,:]+$", "", norm)
-    norm = re.sub(r"[\u200b\u200c\u200d\ufeff\xa0]", "", norm)
-    
-    if "." in norm or "" == norm.strip(): 
-      return None 
-    
-    if len(p) >= 1:
-      p.append(norm)
-      return p
+    norm = _normalize_tag(tag)
+    if isinstance(norm, tuple):
+      return list(norm)
     return norm
   
   @staticmethod
@@ -112,11 +122,8 @@ class PreProcessor:
           debug(f"[PreProc] Skipping: {t}")
     return a
   
-  async def prepare(self, dataset_dir: list[str], c: int = 1):
-    if c is None: c = max(1, os.cpu_count() - 2)
-    pool = [[], [], []] # prompts, booru inferred, rating
-    await self.pred.load_model_cuda()
-    
+  @staticmethod
+  def list_files(dataset_dir: list[str]) -> list[tuple[str, str]]:
     files = []
     for d in dataset_dir:
       if not op.exists(d) or not op.isdir(d):
@@ -125,40 +132,73 @@ class PreProcessor:
       for f in os.listdir(d):
         if op.splitext(f)[1].lower() == ".png":
           files.append((d, f))
+    return files
+  
+  def process_file(self, file: tuple[str, str]) -> Optional[tuple[list[str], list[str], str]]:
+    """Returns (prompt_tags, booru_tags, rating) or None when the image has no usable rating."""
+    basedir = file[0]
+    f = file[1]
+    b = os.path.basename(f)
+    cap = op.join(basedir, b + ".txt")
     
-    def p(file):
-      basedir = file[0]
-      f = file[1]
-      b = os.path.basename(f)
-      cap = op.join(basedir, b + ".txt")
-      
-      if op.exists(cap):
-        info = open(cap, "r", encoding="utf-8").read()
-        prompt = info.split("Negative prompt:")[0].strip()
-      else:
-        info = self.read_pnginfo(Image.open(op.join(basedir, f)))
-        prompt = info
-        
-      pd = self.pred.predict_sync(
-        Image.open(op.join(basedir, f)).convert("RGBA"),
-        threshold=self.booru_threshold,
-        character_threshold=0.8,
-      )
-      inferred = pd[0] | pd[1]
-      rate, _, _ = get_rating(pd[2], self.ignore_questionable)
+    if op.exists(cap):
+      info = open(cap, "r", encoding="utf-8").read()
+      prompt = info.split("Negative prompt:")[0].strip()
+    else:
+      info = self.read_pnginfo(Image.open(op.join(basedir, f)))
+      prompt = info
       
-      if rate != "?":
-        pool[0].append(self.seprompt(prompt))
-        pool[1].append(self.seprompt(list(inferred.keys())))
-        pool[2].append(rate)
-      else:
-        warn(f"Skipping {b} due to no rating found.")
-        return
+    pd = self.pred.predict_sync(
+      Image.open(op.join(basedir, f)).convert("RGBA"),
+      threshold=self.booru_threshold,
+      character_threshold=0.8,
+    )
+    inferred = pd[0] | pd[1]
+    rate, _, _ = get_rating(pd[2], self.ignore_questionable)
+    
+    if rate != "?":
+      return self.seprompt(prompt), self.seprompt(list(inferred.keys())), rate
+    warn(f"Skipping {b} due to no rating found.")
+    return None
+  
+  async def prepare_files(self, files: list[tuple[str, str]], c: int = 1) -> list[Optional[tuple[list[str], list[str], str]]]:
+    """Preprocess the given (dir, filename) pairs. Results are aligned with `files`."""
+    if c is None: c = max(1, os.cpu_count() - 2)
+    if len(files) == 0:
+      return []
+    await self.pred.load_model_cuda()
     
     def run_pool():
       with ThreadPoolExecutor(max_workers=c) as executor:
-        list(executor.map(p, files))
-    await asyncio.to_thread(run_pool)
+        return list(executor.map(self.process_file, files))
+    results = await asyncio.to_thread(run_pool)
     await self.pred.unload_model()
-    
-    return pool
\ No newline at end of file
+    return results
+
+  async def iter_prepare_files(self, files: list[tuple[str, str]], c: int = 1, batch_size: int = 256):
+    """
+    Same as prepare_files, but yields [(file, result), ...] every `batch_size` files
+    so the caller can persist results instead of holding all of them.
+    """
+    if c is None: c = max(1, os.cpu_count() - 2)
+    if len(files) == 0:
+      return
+    await self.pred.load_model_cuda()
+    try:
+      with ThreadPoolExecutor(max_workers=c) as executor:
+        for i in range(0, len(files), batch_size):
+          batch = files[i:i + batch_size]
+          results = await asyncio.to_thread(lambda: list(executor.map(self.process_file, batch)))
+          yield list(zip(batch, results))
+    finally:
+      await self.pred.unload_model()
+
+  async def prepare(self, dataset_dir: list[str], c: int = 1):
+    pool = [[], [], []] # prompts, booru inferred, rating
+    for r in await self.prepare_files(self.list_files(dataset_dir), c):
+      if r is None:
+        continue
+      pool[0].append(r[0])
+      pool[1].append(r[1])
+      pool[2].append(r[2])
+    return pool
@@ -0,0 +1,199 @@
+"""
+Streaming queries over the generation log (SaveGenLog)
+
+generation_log() のレコードを 1 件ずつ流しながら絞り込む。履歴の長さに関係なく
+メモリに載るのは展開中のフレーム 1 つと返す途中のレコードだけ。
+
+- 時間範囲: 索引で範囲外のフレームを展開せずに飛ばし、フレーム内は行頭の時刻だけを正規表現で読んで判定する
+- script / rating / LoRA / タグ: JSON を decode する前に行の文字列で足切りし (誤検出はあっても見落としはない)、
+  残った行だけを decode して正確に判定する
+- ページングは最後に返したレコードの位置 (SegmentedLog の segment:offset:行) をカーソルにして続きから読む。
+  時刻ではなく追記順の位置なので、時刻が前後して追記されたレコードも飛ばさない
+"""
+
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Any, Iterator, Optional
+
+from modules.calculator.save import ENDTYPES, RATES, SCRIPTS, generation_log
+from modules.utils.prompt import disweight
+from modules.utils.segment_log import Position, SegmentedLog
+
+# v1/v2 のレコードは必ず時刻から始まる ({"v2":1712345678.123,...})
+_TS_PATTERN = re.compile(r'\{"v[12]":(-?[0-9]+(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?)[,}]')
+_LORA_PATTERN = re.compile(r"<lora:([^:>]+)", re.IGNORECASE)
+_NEGATIVE = "\nNegative prompt:"
+
+def _norm_tag(tag: str) -> str:
+  return tag.replace("\\", "").replace("_", " ").strip().lower()
+
+def _norm_lora(name: str) -> str:
+  name = name.strip().lower()
+  for ext in (".safetensors", ".ckpt", ".pt"):
+    if name.endswith(ext):
+      return name[:-len(ext)]
+  return name
+
+def positive_prompt(infotext: str) -> str:
+  return infotext.split(_NEGATIVE, 1)[0]
+
+def prompt_tags(infotext: str) -> set[str]:
+  """Weight-stripped, normalized tags of the positive prompt"""
+  tags = set()
+  for piece in re.split(r"[,\n]", positive_prompt(infotext)):
+    piece = piece.strip()
+    if not piece:
+      continue
+    text, _ = disweight(piece)
+    tag = _norm_tag(text)
+    if tag:
+      tags.add(tag)
+  return tags
+
+def prompt_loras(infotext: str) -> set[str]:
+  return {_norm_lora(m) for m in _LORA_PATTERN.findall(positive_prompt(infotext))}
+
+def _indices(values: list[str], names: list[str], kind: str) -> Optional[set[int]]:
+  if not values:
+    return None
+  unknown = [v for v in values if v not in names]
+  if unknown:
+    raise ValueError(f"Unknown {kind}: {', '.join(unknown)} (one of {', '.join(names)})")
+  return {names.index(v) for v in values}
+
+@dataclass
+class RecordQuery:
+  """
+  start <= 時刻 < end で、指定された項目すべてに当てはまるレコード。
+  scripts / ratings / end_types は「どれか」、loras / tags は「すべて」を含むもの。
+  """
+  start: Optional[float] = None
+  end: Optional[float] = None
+  scripts: list[str] = field(default_factory=list)
+  ratings: list[str] = field(default_factory=list)
+  end_types: list[str] = field(default_factory=list)
+  loras: list[str] = field(default_factory=list)
+  tags: list[str] = field(default_factory=list)
+
+  def __post_init__(self):
+    self._scripts = _indices(self.scripts, SCRIPTS, "script")
+    self._ratings = _indices(self.ratings, RATES, "rating")
+    self._end_types = _indices(self.end_types, ENDTYPES, "end type")
+    self._loras = [_norm_lora(x) for x in self.loras if x.strip()]
+    self._tags = [_norm_tag(x) for x in self.tags if _norm_tag(x)]
+    # decode 前の足切り用: 列挙値はどれか 1 つ、文字列はすべてが行に含まれていること
+    self._enum_needles = [
+      [f'"{key}":{i}' for i in sorted(indices)]
+      for key, indices in (("s", self._scripts), ("r", self._ratings), ("et", self._end_types))
+      if indices is not None
+    ]
+    self._text_needles = [_norm_tag(f"<lora:{x}") for x in self._loras] + self._tags
+
+  def _line_ts(self, line: str) -> Optional[float]:
+    m = _TS_PATTERN.match(line)
+    return float(m.group(1)) if m else None
+
+  def _in_range(self, ts: Optional[float]) -> bool:
+    if self.start is None and self.end is None:
+      return True
+    if ts is None:
+      return False
+    return (self.start is None or ts >= self.start) and (self.end is None or ts < self.end)
+
+  def prefilter(self, line: str) -> bool:
+    """Cheap check on the raw JSON line (False: surely not a match, True: decode and check)."""
+    ts = self._line_ts(line)
+    if ts is not None and not self._in_range(ts):
+      return False
+    for needles in self._enum_needles:
+      if not any(n in line for n in needles):
+        return False
+    if self._text_needles:
+      # JSON のエスケープ (\" \\ など) とタグの _ / 空白の違いを吸収してから探す
+      text = _norm_tag(line)
+      if not all(n in text for n in self._text_needles):
+        return False
+    return True
+
+  def matches(self, record: dict[str, Any], log: SegmentedLog) -> bool:
+    if not self._in_range(log.record_ts(record)):
+      return False
+    for key, indices in (("s", self._scripts), ("r", self._ratings), ("et", self._end_types)):
+      if indices is not None and record.get(key) not in indices:
+        return False
+    if self._loras or self._tags:
+      infotext = record.get("itx")
+      if not isinstance(infotext, str):
+        return False
+      if self._loras and not set(self._loras) <= prompt_loras(infotext):
+        return False
+      if self._tags and not set(self._tags) <= prompt_tags(infotext):
+        return False
+    return True
+
+def expand_record(record: dict[str, Any], log: SegmentedLog) -> dict[str, Any]:
+  """Short keys / enum indices of a stored record to readable names."""
+  def name(values: list[str], i: Any) -> Any:
+    return values[i] if isinstance(i, int) and 0 <= i < len(values) else i
+
+  r = {
+    "timestamp": log.record_ts(record),
+    "infotext": record.get("itx"),
+    "end_type": name(ENDTYPES, record.get("et")),
+    "rate": name(RATES, record.get("r")),
+    "script": name(SCRIPTS, record.get("s")),
+  }
+  for key, readable in (
+    ("pp", "pem_params"), ("ps", "prompt_score"), ("b", "booru"),
+    ("lst", "lost_tags"), ("gst", "ghost_tags"), ("u", "luuid"), ("ts", "ts"), ("img", "result_images"),
+  ):
+    if key in record:
+      r[readable] = record[key]
+  return r
+
+def _iter_matches(
+  query: RecordQuery, log: SegmentedLog, after: Optional[Position] = None,
+) -> Iterator[tuple[Position, dict[str, Any]]]:
+  for pos, line in log.read_positions(query.start, query.end, after):
+    if not query.prefilter(line):
+      continue
+    record = json.loads(line)
+    if query.matches(record, log):
+      yield pos, record
+
+def iter_records(query: RecordQuery, log: Optional[SegmentedLog] = None) -> Iterator[dict[str, Any]]:
+  """Stored records matching the query in append order (lazily; constant memory)."""
+  for _, record in _iter_matches(query, log or generation_log()):
+    yield record
+
+def encode_cursor(pos: Position) -> str:
+  return ":".join(str(x) for x in pos)
+
+def decode_cursor(cursor: str) -> Position:
+  try:
+    segment, offset, line = (int(x) for x in cursor.split(":"))
+  except ValueError:
+    raise ValueError(f"Invalid cursor: {cursor!r}")
+  return segment, offset, line
+
+def iter_page_records(
+  query: RecordQuery, cursor: Optional[str] = None, log: Optional[SegmentedLog] = None,
+) -> Iterator[tuple[dict[str, Any], str]]:
+  """(record, cursor to resume after it) from the record after `cursor` (from the start if None)."""
+  after = decode_cursor(cursor) if cursor else None
+  for pos, record in _iter_matches(query, log or generation_log(), after):
+    yield record, encode_cursor(pos)
+
+def query_page(
+  query: RecordQuery, limit: int = 100, cursor: Optional[str] = None, log: Optional[SegmentedLog] = None,
+) -> tuple[list[dict[str, Any]], Optional[str]]:
+  """One page of records and the cursor of the next page (None: no more records)."""
+  items = []
+  next_cursor = None
+  for record, c in iter_page_records(query, cursor, log):
+    if len(items) >= limit:
+      return items, next_cursor
+    items.append(record)
+    next_cursor = c
+  return items, None
@@ -1,47 +1,61 @@
-import time, uuid
+import time
 import os
 import traceback
-import json
 
-from logger import warn
+from logger import info, warn
 from modules.events.generation_ended import OnGenerationEndedEvent, onGenerationEnded
-from modules.utils import zstd, jsonl
-from modules.utils.zipper import Booru, Scores
+from modules.utils.segment_log import SegmentedLog
 from modules.config import get_config
 config = get_config()
 
+# 1 件の形式:
+#   v1: {"v1": 時刻, "itx": zstd(infotext), ...} (フィールドごとに zstd/parquet で圧縮)
+#   v2: {"v2": 時刻, "itx": infotext, "pp": pem_params, "ps": [[tag, score], ...], ...}
+#       ログ全体をフレーム単位で圧縮するので、フィールドは平文で持つ
+ENDTYPES = ["interrupt", "booru_interrupt", "complete"]
+RATES = ["perfect", "ok", "bad", "worst", "undefined"]
+SCRIPTS = ["sdpem/lora", "sdpem/image", "sdpem/mlora", "sdpem/db", "webui", "webui/api", "other", "undefined"]
+
+_generation_logs: dict[str, SegmentedLog] = {}
+
+def generation_log(root: str | None = None) -> SegmentedLog:
+  """Segmented generation log under <db_dir>/generation_log (imports the old generation_records.jsonl once)."""
+  root = root or config.db_dir
+  log = _generation_logs.get(root)
+  if log is None:
+    log = _generation_logs[root] = SegmentedLog(os.path.join(root, "generation_log"), ts_key=("v2", "v1"))
+    legacy = os.path.join(root, "generation_records.jsonl")
+    if os.path.exists(legacy):
+      n = log.import_jsonl(legacy)
+      info(f"[SaveGenLog] Imported {n} record(s) from {legacy}")
+  return log
+
+def _scores(scores) -> list[list]:
+  return [[s.tag, s.score] for s in scores or []]
+
 def SaveGenLog(event: OnGenerationEndedEvent):
-  root = config.db_dir
-  genlog = os.path.join(root, "generation_records.jsonl")
-  stats_dir = os.path.join(root, "tag_stats")
-  os.makedirs(root, exist_ok=True)
-  os.makedirs(stats_dir, exist_ok=True)
-  
-  # create entry
-  ## v1
-  endtypes = ["interrupt", "booru_interrupt", "complete"]
-  rates = ["perfect", "ok", "bad", "worst", "undefined"]
-  scripts = ["sdpem/lora", "sdpem/image", "sdpem/mlora", "sdpem/db", "webui", "webui/api", "other", "undefined"]
-  
   try:
     entry = {
-      "v1": int(time.time()),
-      "itx": zstd.zip(event.infotxt),
-      "et": endtypes.index(event.end_type),
-      "r": rates.index(event.rate),
-      "s": scripts.index(event.script),
+      "v2": time.time(),
+      "itx": event.infotxt,
+      "et": ENDTYPES.index(event.end_type),
+      "r": RATES.index(event.rate),
+      "s": SCRIPTS.index(event.script),
     }
     
     if event.script.startswith("sdpem/"):
-      entry["ps"] = Scores.compact(event.prompt_score)
-      entry["pp"] = zstd.zip(json.dumps(event.pem_params, ensure_ascii=False))
+      entry["ps"] = _scores(event.prompt_score)
+      entry["pp"] = event.pem_params
       
       if event.booru_out:
-        entry["b"] = Booru.compact(event.booru_out)
+        b = event.booru_out
+        entry["b"] = {
+          "tag": _scores(b.tags), "c": _scores(b.characters), "r": _scores(b.rating), "t": b.threshold,
+        }
       
       if event.lost_tags:
-        entry["lst"] = Scores.compact(event.lost_tags)
-        entry["gst"] = Scores.compact(event.ghost_tags)
+        entry["lst"] = _scores(event.lost_tags)
+        entry["gst"] = _scores(event.ghost_tags)
       
       if event.luuid:
         entry["u"] = event.luuid
@@ -49,9 +63,9 @@ def SaveGenLog(event: OnGenerationEndedEvent):
       
       if event.result_images:
         entry["img"] = event.result_images
-    jsonl.append(entry, genlog) 
+    generation_log().append(entry)
   except Exception as e:
-    warn(f"[SaveGenLog] Unknown event type: {event.event_name}")
+    warn(f"[SaveGenLog] Failed to save the generation log ({event.event_name}): {e}")
     traceback.print_exc()
 
-onGenerationEnded.add_callback(SaveGenLog)
\ No newline at end of file
+onGenerationEnded.add_callback(SaveGenLog)
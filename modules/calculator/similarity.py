@@ -26,6 +26,15 @@ to create varied, rich prompt compositions.
 This is NOT "tags that appear together" (co-occurrence).
 This IS "tags that appear in similar contexts" (distributional similarity).
 
+Tags are TagVocab ids (see vocab.py); the examples use tag strings for readability.
+
+## Embeddings
+
+When trained data contains truncated-SVD tag embeddings (see embedding.py),
+similarity is the dot product of the normalized vectors instead of the exact
+sparse PPMI cosine. Lookups become constant-time and the redundancy checks
+compare one candidate against all kept tags with a single matrix product.
+
 ## Example Use Cases
 
 ```python
@@ -41,7 +50,9 @@ diverse_tags = sim.filter_diverse_tags(candidates, max_similarity=0.5)
 """
 
 import math
-from typing import Dict, List, Set, Tuple
+from typing import Dict, List, Optional, Set, Tuple
+
+from modules.calculator.embedding import TagEmbeddings
 
 
 class SimilarityMatrix:
@@ -54,18 +65,24 @@ class SimilarityMatrix:
     - Cosine Similarity = measures how similar two tag contexts are
     """
     
-    def __init__(self, matrix_data: dict[str, dict[str, float]]):
+    # Maximum number of memoized tag pairs (cleared when exceeded)
+    pair_cache_size: int = 1_000_000
+    
+    def __init__(self, matrix_data: dict[int, dict[int, float]], embeddings: Optional[TagEmbeddings] = None):
         """
         Initialize with PMI matrix data.
         
         Args:
             matrix_data: PMI matrix from CooccurrenceMatrix (tag -> other_tag -> pmi_score)
+            embeddings: Optional SVD tag embeddings; when given, similarity uses their dot product
         """
         self.matrix_data = matrix_data
-        self._ppmi_cache: Dict[str, Dict[str, float]] = {}
-        self._norm_cache: Dict[str, float] = {}
+        self.embeddings = embeddings
+        self._ppmi_cache: Dict[int, Dict[int, float]] = {}
+        self._norm_cache: Dict[int, float] = {}
+        self._pair_cache: Dict[Tuple[int, int], float] = {}
     
-    def _get_ppmi_vector(self, tag: str) -> Dict[str, float]:
+    def _get_ppmi_vector(self, tag: int) -> Dict[int, float]:
         """
         Get PPMI (Positive PMI) context vector for a tag.
         
@@ -91,7 +108,7 @@ class SimilarityMatrix:
         self._ppmi_cache[tag] = ppmi_vector
         return ppmi_vector
     
-    def _get_vector_norm(self, tag: str) -> float:
+    def _get_vector_norm(self, tag: int) -> float:
         """
         Calculate L2 norm (magnitude) of PPMI context vector.
         ||v|| = sqrt(sum(v_i^2))
@@ -109,7 +126,7 @@ class SimilarityMatrix:
         self._norm_cache[tag] = norm
         return norm
     
-    def calculate_similarity(self, tag_a: str, tag_b: str) -> float:
+    def calculate_similarity(self, tag_a: int, tag_b: int) -> float:
         """
         Calculate distributional similarity between two tags.
         
@@ -132,6 +149,21 @@ class SimilarityMatrix:
             - 1.0 = extremely similar contexts (highly redundant)
             - 0.0 = completely different contexts (maximally diverse)
         """
+        if self.embeddings is not None:
+            return self.embeddings.similarity(tag_a, tag_b)
+        
+        key = (tag_a, tag_b) if tag_a <= tag_b else (tag_b, tag_a)
+        cached = self._pair_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        similarity = self._calculate_similarity(tag_a, tag_b)
+        if len(self._pair_cache) >= self.pair_cache_size:
+            self._pair_cache.clear()
+        self._pair_cache[key] = similarity
+        return similarity
+    
+    def _calculate_similarity(self, tag_a: int, tag_b: int) -> float:
         # Get PPMI context vectors
         ppmi_a = self._get_ppmi_vector(tag_a)
         ppmi_b = self._get_ppmi_vector(tag_b)
@@ -158,7 +190,24 @@ class SimilarityMatrix:
         # Clamp to [0, 1] range
         return max(0.0, min(1.0, similarity))
     
-    def get_similar_tags(self, tag: str, top_k: int = 10, min_similarity: float = 0.3) -> List[Tuple[str, float]]:
+    def max_similarity(self, tag: int, others: List[int] | Set[int]) -> float:
+        """
+        Highest similarity between a tag and any of the given tags (0.0 if none).
+        
+        Args:
+            tag: Tag to compare
+            others: Tags to compare against
+        
+        Returns:
+            Maximum similarity score in range [0, 1]
+        """
+        if not others:
+            return 0.0
+        if self.embeddings is not None:
+            return float(self.embeddings.similarities(tag, list(others)).max())
+        return max(self.calculate_similarity(tag, other) for other in others)
+    
+    def get_similar_tags(self, tag: int, top_k: int = 10, min_similarity: float = 0.3) -> List[Tuple[int, float]]:
         """
         Find most similar (potentially redundant) tags.
         
@@ -177,6 +226,12 @@ class SimilarityMatrix:
         if tag not in self.matrix_data:
             return []
         
+        if self.embeddings is not None:
+            others = [t for t in self.matrix_data.keys() if t != tag]
+            scores = self.embeddings.similarities(tag, others)
+            order = scores.argsort()[::-1][:top_k]
+            return [(others[i], float(scores[i])) for i in order if scores[i] >= min_similarity]
+        
         similarities = []
         
         for other_tag in self.matrix_data.keys():
@@ -192,7 +247,7 @@ class SimilarityMatrix:
         similarities.sort(key=lambda x: x[1], reverse=True)
         return similarities[:top_k]
     
-    def is_redundant(self, tag_a: str, tag_b: str, threshold: float = 0.6) -> bool:
+    def is_redundant(self, tag_a: int, tag_b: int, threshold: float = 0.6) -> bool:
         """
         Check if two tags are redundant (too similar).
         
@@ -214,9 +269,9 @@ class SimilarityMatrix:
     
     def filter_redundant_tags(
         self, 
-        tags: List[str], 
+        tags: List[int], 
         max_similarity: float = 0.6
-    ) -> List[str]:
+    ) -> List[int]:
         """
         Remove redundant tags from a list, keeping only diverse tags.
         
@@ -244,23 +299,18 @@ class SimilarityMatrix:
         
         for candidate in tags[1:]:
             # Check if candidate is too similar to any already-kept tag
-            is_redundant = any(
-                self.calculate_similarity(candidate, kept) >= max_similarity
-                for kept in kept_tags
-            )
-            
-            if not is_redundant:
+            if self.max_similarity(candidate, kept_tags) < max_similarity:
                 kept_tags.append(candidate)
         
         return kept_tags
     
     def get_diverse_candidates(
         self,
-        base_tags: Set[str],
-        candidate_tags: List[str],
+        base_tags: Set[int],
+        candidate_tags: List[int],
         max_count: int = 10,
         min_diversity: float = 0.4
-    ) -> List[str]:
+    ) -> List[int]:
         """
         Select diverse candidates that don't overlap with base tags.
         
@@ -291,21 +341,11 @@ class SimilarityMatrix:
         
         for candidate in candidate_tags:
             # Skip if candidate is too similar to any base tag
-            too_similar_to_base = any(
-                self.calculate_similarity(candidate, base) >= max_similarity
-                for base in base_tags
-            )
-            
-            if too_similar_to_base:
+            if self.max_similarity(candidate, base_tags) >= max_similarity:
                 continue
             
             # Skip if candidate is too similar to already-selected diverse candidates
-            too_similar_to_selected = any(
-                self.calculate_similarity(candidate, selected) >= max_similarity
-                for selected in diverse_candidates
-            )
-            
-            if too_similar_to_selected:
+            if self.max_similarity(candidate, diverse_candidates) >= max_similarity:
                 continue
             
             diverse_candidates.append(candidate)
@@ -316,14 +356,15 @@ class SimilarityMatrix:
         return diverse_candidates
     
     @classmethod
-    def from_cooccurrence_matrix(cls, cooccurrence_matrix) -> "SimilarityMatrix":
+    def from_cooccurrence_matrix(cls, cooccurrence_matrix, embeddings: Optional[TagEmbeddings] = None) -> "SimilarityMatrix":
         """
         Create SimilarityMatrix from CooccurrenceMatrix instance.
         
         Args:
             cooccurrence_matrix: CooccurrenceMatrix instance
+            embeddings: Optional SVD tag embeddings trained from the same matrix
         
         Returns:
             SimilarityMatrix instance
         """
-        return cls(cooccurrence_matrix.matrix)
\ No newline at end of file
+        return cls(cooccurrence_matrix.matrix, embeddings)
\ No newline at end of file
@@ -0,0 +1,65 @@
+"""
+Training stages that can run in worker processes
+
+prompt と booru のマトリクス / 競合検出は互いに独立しているので、
+training.train() はこれらを別プロセスで同時に実行する。
+ワーカーは spawn で起動されるため、このモジュールは重い依存 (torch, config) を import しないこと。
+ワーカーでは logger が初期化されていないので、ログは親 (training.train) で出す。
+"""
+
+from typing import Optional
+
+from modules.calculator.conflict import ConflictMap
+from modules.calculator.delta import CooccurrenceCounts
+from modules.calculator.embedding import TagEmbeddings
+from modules.calculator.matrix import CooccurrenceMatrix
+from modules.calculator.vocab import TagVocab
+
+
+def build_matrix(
+  counts: CooccurrenceCounts,
+  vocab: TagVocab,
+  min_sample: int,
+  previous: Optional[CooccurrenceMatrix] = None,
+  touched: Optional[set[int]] = None,
+  previous_total: int = 0,
+) -> CooccurrenceMatrix:
+  """Full build from counts, or an incremental update of `previous` when given."""
+  if previous is None:
+    return CooccurrenceMatrix.from_counts(counts, vocab, min_sample)
+  previous.vocab = vocab
+  previous.apply_counts_delta(counts, touched or set(), previous_total, min_sample)
+  return previous
+
+
+def train_conflict(min_occr: int, confidence: float, matrix: CooccurrenceMatrix, samples: int, exist_data: ConflictMap = None, only_tags: Optional[set[int]] = None, shard: tuple[int, int] = (0, 1)) -> ConflictMap:
+  if exist_data is None:
+    exist_data = ConflictMap()
+  if not isinstance(exist_data, ConflictMap):
+    raise ValueError("exist_data must be a ConflictMap instance or None")
+  r = ConflictMap.auto_detect_conflicts(
+    matrix=matrix,
+    tag_counts=matrix.counts,
+    total_documents=samples,
+    min_occurrences=min_occr,
+    min_confidence=confidence,
+    merge_with_existing=False,
+    base_map=exist_data,
+    only_tags=only_tags,
+    shard=shard
+  )
+  return r
+
+
+def merge_conflict_shards(exist_data: Optional[ConflictMap], only_tags: Optional[set[int]], shards: list[ConflictMap]) -> ConflictMap:
+  """train_conflict を shard ごとに exist_data=None で実行した結果をまとめる"""
+  r = exist_data.copy() if exist_data is not None else ConflictMap()
+  if only_tags is not None:
+    r.discard_tags(only_tags)
+  for m in shards:
+    r.merge(m)
+  return r
+
+
+def fit_embedding(matrix_data: dict[int, dict[int, float]], size: int, dim: int) -> TagEmbeddings:
+  return TagEmbeddings.fit(matrix_data, size, dim)
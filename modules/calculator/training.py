@@ -1,9 +1,13 @@
 import asyncio
-import json
 import sys
 import os
 import math
+import shutil
+import uuid
+import multiprocessing
 import torch
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
 # Add project root to path when running as standalone script
@@ -13,10 +17,16 @@ if __name__ == "__main__":
 from modules.calculator.preprocessing import PreProcessor
 from modules.calculator.matrix import CooccurrenceMatrix
 from modules.calculator.conflict import ConflictMap
+from modules.calculator.delta import CaptionJournal, TrainingState, read_json, write_json_atomic
+from modules.calculator.stages import build_matrix, fit_embedding, merge_conflict_shards, train_conflict
 from typing import AsyncGenerator, Optional
 from logger import info, warn
 from modules.config import get_config
 
+# 差分で競合を検出してよい総サンプル数のずれ (最後に全件で検出したときからの比率)。
+# 差分に含まれないタグ同士の組は前回の総数で判定したままなので、ずれが大きくなったら全件で検出し直す
+CONFLICT_DELTA_MAX_DRIFT = 0.05
+
 def calculate_avail_processes(model_size: float = 1.35, inference_vram: float = 0.4, reserve: float = 1.5) -> int:
   """Available VRAM/CPUから安全な並列数を見積もるため。"""
   try:
@@ -41,23 +51,25 @@ def calculate_avail_processes(model_size: float = 1.35, inference_vram: float =
   max_proc = math.floor(usable_gb / inference_vram) if inference_vram > 0 else 1
   return max(1, max_proc)
 
-def train_conflict(min_occr: int, confidence: float, matrix: dict, samples: int, exist_data: ConflictMap = None) -> dict:
-  info(f"detecting conflicts (min_occurrences={min_occr}, confidence={confidence}, exist_data: {exist_data})...")
-  
-  if exist_data is None:
-    exist_data = ConflictMap()
-  if not isinstance(exist_data, ConflictMap):
-    raise ValueError("exist_data must be a ConflictMap instance or None")
-  r = ConflictMap.auto_detect_conflicts(
-    matrix=matrix,
-    tag_counts=matrix.counts,
-    total_documents=samples,
-    min_occurrences=min_occr,
-    min_confidence=confidence,
-    merge_with_existing=False,
-    base_map=exist_data
-  )
-  return r
+def calculate_stage_workers() -> int:
+  """マトリクス構築/競合検出のワーカープロセス数 (CPUのみ使う)"""
+  return max(1, min(8, (os.cpu_count() or 1) - 1))
+
+async def _run_parallel(executor: Optional[ProcessPoolExecutor], calls: list[partial]) -> list:
+  """独立したステージ呼び出しをワーカープロセスで同時に実行する (executor が None なら順番に実行)"""
+  if executor is None:
+    return [await asyncio.to_thread(c) for c in calls]
+  loop = asyncio.get_running_loop()
+  return await asyncio.gather(*(loop.run_in_executor(executor, c) for c in calls))
+
+def _stage_checkpoint(path: Path, revision: Optional[str], settings: dict) -> Optional[dict]:
+  """ステージのチェックポイントが同じ設定で作られていれば返す"""
+  data = read_json(path)
+  if data is None or data.get("settings") != settings or data.get("revision") is None:
+    return None
+  if data["revision"] != revision:
+    data["stale"] = True
+  return data
 
 async def train(
   dataset_dir: list[os.PathLike | Path], 
@@ -65,9 +77,16 @@ async def train(
   output: os.PathLike | Path,
   min_conflict_occurrences: int = 250,
   conflict_confidence: float = 0.7,
-  processes: int = calculate_avail_processes(), # 1.5(safe) + 1.35(model) + 0.3(infer) * proc (GB)
+  processes: int = -1, # 1.5(safe) + 1.35(model) + 0.3(infer) * proc (GB); -1 = calculate_avail_processes()
   ignore_questionable: bool = True,
   booru_threshold: float = 0.45,
+  incremental: bool = True,
+  workers: int = -1,
+  embedding_dim: int = 0,
+  prune_min_pmi: Optional[float] = None,
+  prune_top_k: int = 0,
+  prune_min_count: int = 0,
+  value_dtype: Optional[str] = None,
 ) -> AsyncGenerator[None, str]:
   """
   Train the database system on image data.
@@ -78,12 +97,30 @@ async def train(
   3. ConflictMap: Detect conflicts using co-occurrence data
   4. Save all generated matrices
   
+  Every step is checkpointed in `<output stem>.ckpt/`:
+  captions.jsonl (preprocessed captions, appended per batch), state.json (raw counts),
+  matrix.json (PMI / rating / LoRA matrices), conflict.json and embedding.json.
+  An interrupted run resumes from the last completed step, and captions are streamed
+  from the journal instead of being kept in memory.
+  With incremental=True only added/changed/removed images are processed and
+  only the affected rows are recalculated; incremental=False discards the checkpoints.
+  Conflicts are re-detected only for pairs involving touched tags, until the sample count has
+  drifted more than CONFLICT_DELTA_MAX_DRIFT from the last full detection.
+  
   Args:
-    pth: Path to directory containing images
-    walkdir: If True, recursively process subdirectories
+    dataset_dir: Directories containing images
     output: Path to output file where metadata is saved
     min_conflict_occurrences: Minimum tag occurrences for conflict detection
     conflict_confidence: Minimum confidence for auto-detected conflicts
+    incremental: Reuse the checkpoints of the previous training if they are compatible
+    processes: Preprocessing threads (-1 = estimate from free VRAM / CPUs)
+    workers: Worker processes for the matrix and conflict steps (-1 = CPUs - 1, 1 = no subprocess).
+      The prompt and booru matrices are built concurrently and the conflict pair scan is split into shards.
+    embedding_dim: Also store truncated-SVD tag embeddings of this size (0 = disabled, see embedding.py)
+    prune_min_pmi / prune_top_k / prune_min_count: Prune the exported PMI rows
+      (pairs below this PMI / beyond the top-K of a row / seen together fewer times).
+      Checkpoints keep the full matrices so incremental training stays exact.
+    value_dtype: Store the exported PMI values as "float32" or "float16" (None = JSON numbers)
   
   Returns:
     Dictionary with statistics and file paths
@@ -101,86 +138,246 @@ async def train(
   if processes <= -1:
     processes = calculate_avail_processes()
   processes = max(1, processes)
-  yield log(f"Using {processes} parallel processes for training.")
-  
-  # === Step 1: PreProcessor ===
-  yield log("Step 1/3: Preprocessing images...")
-  
-  all_prompts = []
-  all_booru_inferred = []
-  all_ratings = []
+  if workers is None or workers <= -1:
+    workers = calculate_stage_workers()
+  workers = max(1, int(workers))
+  embedding_dim = max(0, int(embedding_dim or 0))
+  prune_top_k = max(0, int(prune_top_k or 0))
+  prune_min_count = max(0, int(prune_min_count or 0))
+  if value_dtype in ("", "float64"):
+    value_dtype = None
+  yield log(f"Using {processes} parallel processes for preprocessing, {workers} workers for matrices/conflicts.")
   
   if len(dataset_dir) == 0:
     yield log("No dataset directories specified. Training aborted.")
     return
   
-  preprocessor = PreProcessor("WD1.4 Vit Tagger v3 (large)", ignore_questionable, booru_threshold=booru_threshold)
-
-  # pool = [prompts, booru_inferred, ratings]
-  pool = await preprocessor.prepare(
-    [str(p) for p in dataset_dir],
-    processes
-  )
+  booru_model = "WD1.4 Vit Tagger v3 (large)"
+  fingerprint = {
+    "booru_model": booru_model,
+    "ignore_questionable": bool(ignore_questionable),
+    "booru_threshold": float(booru_threshold),
+  }
+  analysis = {
+    "min_conflict_occurrences": int(min_conflict_occurrences),
+    "conflict_confidence": float(conflict_confidence),
+  }
+  
+  ckpt_dir = TrainingState.checkpoint_dir(output)
+  if not incremental and ckpt_dir.exists():
+    shutil.rmtree(ckpt_dir)
+  ckpt_dir.mkdir(parents=True, exist_ok=True)
+  state_path = ckpt_dir / "state.json"
+  matrix_path = ckpt_dir / "matrix.json"
+  conflict_path = ckpt_dir / "conflict.json"
+  embedding_path = ckpt_dir / "embedding.json"
   
-  all_prompts.extend(pool[0])
-  all_booru_inferred.extend(pool[1])
-  all_ratings.extend(pool[2])
+  journal = CaptionJournal(ckpt_dir / "captions.jsonl", fingerprint)
+  if not journal.open():
+    yield log("Preprocessing settings changed since the last training; starting from scratch.")
+  state = TrainingState.load(state_path)
+  if state is not None and state.fingerprint != fingerprint:
+    state = None
+  if state is None:
+    state = TrainingState(fingerprint)
+  
+  # === Step 1: PreProcessor ===
+  # 前処理結果はバッチごとにジャーナルへ追記する (中断しても処理済みの画像は再開時にスキップされる)
+  yield log("Step 1/4: Preprocessing images...")
   
-  total_samples = len(all_prompts)
-  yield log(f"Preprocessing complete. Total samples: {total_samples}")
+  files = PreProcessor.list_files([str(p) for p in dataset_dir])
+  signatures = {}
+  for d, f in files:
+    key = os.path.abspath(os.path.join(d, f))
+    signatures[key] = (TrainingState.signature(key), (d, f))
+  
+  latest = journal.scan()
+  targets = [k for k, (sig, _) in signatures.items() if latest.get(k) != sig]
+  removed = [k for k in latest if k not in signatures]
+  yield log(f"  Images: {len(signatures)} (to preprocess: {len(targets)}, removed: {len(removed)})")
+  if removed:
+    journal.append({"key": k, "removed": True} for k in removed)
+  
+  if len(targets) > 0:
+    preprocessor = PreProcessor(booru_model, ignore_questionable, booru_threshold=booru_threshold)
+    by_file = {signatures[k][1]: k for k in targets}
+    done = 0
+    async for batch in preprocessor.iter_prepare_files([signatures[k][1] for k in targets], processes):
+      entries = []
+      for file, r in batch:
+        key = by_file[file]
+        if r is None:
+          entries.append({"key": key, "sig": signatures[key][0], "prompt": None, "booru": None, "rating": None})
+        else:
+          entries.append({"key": key, "sig": signatures[key][0], "prompt": r[0], "booru": r[1], "rating": r[2]})
+      journal.append(entries)
+      done += len(batch)
+      yield log(f"  Preprocessed {done}/{len(targets)}")
+  del signatures
+  
+  # === Step 2: Counts ===
+  yield log("Step 2/4: Counting co-occurrences...")
+  latest = journal.scan()
+  touched_prompt, touched_booru = await asyncio.to_thread(state.update, journal, latest)
+  if state.revision is None:
+    state.revision = uuid.uuid4().hex
+  state.save(state_path)
+  # カウントが保存された後なら古いエントリは不要
+  journal.compact(latest)
+  total_samples = state.prompt.total
+  yield log(f"  Total samples: {total_samples} (prompt tags touched: {len(touched_prompt)}, booru tags touched: {len(touched_booru)})")
   
   if total_samples == 0:
     yield log("No valid samples found. Training aborted.")
     return
   
-  # === Step 2: CooccurrenceMatrix ===
-  yield log("Step 2/3: Building co-occurrence matrices...")
-  
-  # Build prompt matrix
-  yield log("  - Building prompt co-occurrence matrix...")
-  comtx = await CooccurrenceMatrix.build_cls(
-    tag_lists=all_prompts,
-    rating=all_ratings,
-    min_sample=min_conflict_occurrences
-  )
-  b_comtx = await CooccurrenceMatrix.build_cls(
-    tag_lists=all_booru_inferred,
-    rating=all_ratings,
-    min_sample=min_conflict_occurrences
-  )
-  
-  yield log(f"  Prompt tags: {len(comtx.counts)}")
-  yield log(f"  LoRA triggers found: {len(comtx.lora_matrix)}")
-  
-  # === Step 3: ConflictMap ===
-  yield log("Step 3/3: Detecting tag conflicts...")
-  conflict_map = await asyncio.to_thread(train_conflict,
-    min_occr=min_conflict_occurrences, 
-    confidence=conflict_confidence, 
-    matrix=comtx, 
-    samples=total_samples
-  )
-  b_conf = await asyncio.to_thread(train_conflict, 
-    min_occr=min_conflict_occurrences, 
-    confidence=conflict_confidence, 
-    matrix=b_comtx, 
-    samples=total_samples
-  )
-  
-  # === Step 4: Save everything ===
+  pending = state.pending or {}
+  delta_base = pending.get("base")
+  
+  # prompt と booru は独立しているので同時に計算する
+  executor = None
+  if workers > 1:
+    # fork だと親のスレッド/CUDAの状態を引き継いでしまうので spawn で起動する
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+  try:
+    # === Step 3: CooccurrenceMatrix ===
+    yield log("Step 3/4: Building co-occurrence matrices...")
+    matrix_settings = {"min_sample": int(min_conflict_occurrences)}
+    ckpt = _stage_checkpoint(matrix_path, state.revision, matrix_settings)
+    if ckpt is not None and not ckpt.get("stale"):
+      yield log("  - Up to date (checkpoint)")
+      comtx = CooccurrenceMatrix.from_file(ckpt["matrix"], state.vocab)
+      b_comtx = CooccurrenceMatrix.from_file(ckpt["booru"], state.vocab)
+    else:
+      if ckpt is not None and delta_base is not None and ckpt["revision"] == delta_base:
+        yield log("  - Updating matrices from the previous checkpoint...")
+        calls = [
+          partial(build_matrix, state.prompt, state.vocab, min_conflict_occurrences,
+                  CooccurrenceMatrix.from_file(ckpt["matrix"], state.vocab), set(pending["prompt"]), pending["total"]),
+          partial(build_matrix, state.booru, state.vocab, min_conflict_occurrences,
+                  CooccurrenceMatrix.from_file(ckpt["booru"], state.vocab), set(pending["booru"]), pending["total"]),
+        ]
+      else:
+        yield log("  - Building matrices from counts (full)...")
+        calls = [
+          partial(build_matrix, state.prompt, state.vocab, min_conflict_occurrences),
+          partial(build_matrix, state.booru, state.vocab, min_conflict_occurrences),
+        ]
+      del ckpt
+      comtx, b_comtx = await _run_parallel(executor, calls)
+      del calls
+      # ワーカーから返ってきたマトリクスは語彙のコピーを持っているので共有のものに戻す
+      comtx.vocab = b_comtx.vocab = state.vocab
+      write_json_atomic(matrix_path, {
+        "revision": state.revision,
+        "settings": matrix_settings,
+        "matrix": comtx.to_file(None, build_data=True, include_vocab=False),
+        "booru": b_comtx.to_file(None, build_data=True, include_vocab=False),
+      })
+    
+    yield log(f"  Prompt tags: {len(comtx.counts)}")
+    yield log(f"  LoRA triggers found: {len(comtx.lora_matrix)}")
+    
+    # === Step 4: ConflictMap ===
+    yield log("Step 4/4: Detecting tag conflicts...")
+    ckpt = _stage_checkpoint(conflict_path, state.revision, analysis)
+    if ckpt is not None and not ckpt.get("stale"):
+      yield log("  - Up to date (checkpoint)")
+      conflict_map = ConflictMap.from_file(ckpt["matrix.conflict"], state.vocab)
+      b_conf = ConflictMap.from_file(ckpt["booru.conflict"], state.vocab)
+    else:
+      use_delta = ckpt is not None and delta_base is not None and ckpt["revision"] == delta_base
+      full_total = ckpt.get("full_total") if use_delta else None
+      if full_total is None or abs(total_samples - full_total) > full_total * CONFLICT_DELTA_MAX_DRIFT:
+        use_delta = False
+        full_total = total_samples
+      only_prompt = set(pending["prompt"]) if use_delta else None
+      only_booru = set(pending["booru"]) if use_delta else None
+      shards = [(i, workers) for i in range(workers)]
+      yield log(
+        f"  - min_occurrences={min_conflict_occurrences}, confidence={conflict_confidence}, "
+        f"only_tags: {'all' if only_prompt is None else (len(only_prompt), len(only_booru))}, shards: {len(shards)}"
+      )
+      calls = [
+        partial(train_conflict, min_conflict_occurrences, conflict_confidence, m, total_samples, None, only, shard)
+        for m, only in ((comtx, only_prompt), (b_comtx, only_booru))
+        for shard in shards
+      ]
+      results = await _run_parallel(executor, calls)
+      del calls
+      conflict_map = merge_conflict_shards(
+        ConflictMap.from_file(ckpt["matrix.conflict"], state.vocab) if use_delta else None,
+        only_prompt, results[:workers],
+      )
+      b_conf = merge_conflict_shards(
+        ConflictMap.from_file(ckpt["booru.conflict"], state.vocab) if use_delta else None,
+        only_booru, results[workers:],
+      )
+      del ckpt, results
+      write_json_atomic(conflict_path, {
+        "revision": state.revision,
+        "settings": analysis,
+        "full_total": full_total,
+        "matrix.conflict": conflict_map.to_file(None, build_data=True),
+        "booru.conflict": b_conf.to_file(None, build_data=True),
+      })
+    
+    embeddings = None
+    if embedding_dim > 0:
+      embedding_settings = {"dim": int(embedding_dim)}
+      ckpt = _stage_checkpoint(embedding_path, state.revision, embedding_settings)
+      if ckpt is not None and not ckpt.get("stale"):
+        yield log("  - Tag embeddings up to date (checkpoint)")
+        embeddings = (ckpt["matrix.embedding"], ckpt["booru.embedding"])
+      else:
+        yield log(f"  - Fitting tag embeddings (dim={embedding_dim})...")
+        # SVD は差分更新できないので毎回作り直す
+        results = await _run_parallel(executor, [
+          partial(fit_embedding, m.matrix, len(state.vocab), embedding_dim)
+          for m in (comtx, b_comtx)
+        ])
+        embeddings = tuple(e.to_file() for e in results)
+        del results
+        write_json_atomic(embedding_path, {
+          "revision": state.revision,
+          "settings": embedding_settings,
+          "matrix.embedding": embeddings[0],
+          "booru.embedding": embeddings[1],
+        })
+      del ckpt
+  finally:
+    if executor is not None:
+      executor.shutdown(cancel_futures=True)
+  
+  # === Save everything ===
   yield log("Saving matrices and maps...")
   met = {}
   
-  met["matrix"] = comtx.to_file(None, build_data=True)
-  met["booru"] = b_comtx.to_file(None, build_data=True)
+  export, b_export = comtx, b_comtx
+  if prune_min_pmi is not None or prune_top_k > 0 or prune_min_count > 0:
+    export = comtx.pruned(prune_min_pmi, prune_top_k, prune_min_count, state.prompt)
+    b_export = b_comtx.pruned(prune_min_pmi, prune_top_k, prune_min_count, state.booru)
+    yield log(f"  Pruned PMI pairs: prompt {comtx.entry_count()} -> {export.entry_count()}, booru {b_comtx.entry_count()} -> {b_export.entry_count()}")
+  
+  # matrix と booru は同じ語彙を共有するので一度だけ保存する
+  met["vocab"] = state.vocab.to_list()
+  met["matrix"] = export.to_file(None, build_data=True, include_vocab=False, dtype=value_dtype)
+  met["booru"] = b_export.to_file(None, build_data=True, include_vocab=False, dtype=value_dtype)
+  del export, b_export
   
   met["matrix.conflict"] = conflict_map.to_file(None, build_data=True)
   met["booru.conflict"] = b_conf.to_file(None, build_data=True)
+  if embeddings is not None:
+    met["matrix.embedding"], met["booru.embedding"] = embeddings
+  met["state"] = {"revision": state.revision, "total": total_samples, "analysis": analysis}
   
-  with output.open("w", encoding="utf-8") as f:
-    json.dump(met, f, ensure_ascii=False, separators=(",", ":"))
+  write_json_atomic(output, met)
+  del met
+  # 全ステージが現在のカウントを反映したので差分をリセットする
+  state.commit()
+  state.save(state_path)
     
-  yield log(f"Saved matrices to {output}")
+  yield log(f"Saved matrices to {output} ({os.path.getsize(output) / 1024 / 1024:.1f} MiB)")
   # === Summary ===
   yielded = ""
   yield log("=" * 60)
@@ -191,4 +388,4 @@ async def train(
   yield log(f"  Booru conflicts detected: {len(b_conf.conflicts)}")
   yield log(f"  Output file: {output}")
   yield log("=" * 60)
-  yield log("Training completed.")
\ No newline at end of file
+  yield log("Training completed.")
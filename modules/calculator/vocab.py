@@ -0,0 +1,144 @@
+"""
+Integer-id tag vocabulary for the prompt calculator
+
+正規化済みのタグを連番の整数IDに割り当てる。マトリクス・類似度・競合・LoRA の各モジュールは
+内部ではこのIDをキーとして扱い、文字列を扱うのは入出力の境界だけにする。
+
+学習済みデータでは "vocab" (IDの順に並んだタグのリスト) として保存され、
+各行は [row_id, [col_ids...], [values...]] の形式で保存される。
+値の精度を指定した場合 (float32 / float16) は CSR 形式のバイナリ (base64) として保存される:
+  {"dtype": "float16", "rows": b64(int32), "indptr": b64(int32), "indices": b64(int32), "values": b64(dtype)}
+"""
+
+import base64
+import re
+from typing import Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+# 行の値を保存するときに使える精度 (None は JSON の数値のまま)
+ROW_DTYPES = ("float32", "float16")
+
+LORA_TRIGGER_PATTERN = r"^<lora:(.*)?>"
+
+def is_lora_trigger(tag: str) -> bool:
+  """Check if a tag is a LoRA trigger (e.g., <lora:name:weight>)"""
+  return re.match(LORA_TRIGGER_PATTERN, tag.strip()) is not None
+
+
+class TagVocab:
+  """Interns normalized tags to dense integer ids."""
+
+  def __init__(self, tags: Optional[Iterable[str]] = None):
+    self.tags: List[str] = []
+    self.ids: Dict[str, int] = {}
+    self.lora_ids: Set[int] = set()
+    for tag in tags or []:
+      self.add(tag)
+
+  def __len__(self) -> int:
+    return len(self.tags)
+
+  def __contains__(self, tag: str) -> bool:
+    return tag in self.ids
+
+  def add(self, tag: str) -> int:
+    """Return the id of the tag, assigning a new one if needed."""
+    i = self.ids.get(tag)
+    if i is None:
+      i = len(self.tags)
+      self.tags.append(tag)
+      self.ids[tag] = i
+      if is_lora_trigger(tag):
+        self.lora_ids.add(i)
+    return i
+
+  def get(self, tag: str) -> Optional[int]:
+    return self.ids.get(tag)
+
+  def tag(self, i: int) -> str:
+    return self.tags[i]
+
+  def is_lora(self, i: int) -> bool:
+    return i in self.lora_ids
+
+  def encode(self, tags: Iterable[str], add: bool = True) -> List[int]:
+    """Tags → ids. With add=False unknown tags are skipped."""
+    if add:
+      return [self.add(t) for t in tags]
+    return [self.ids[t] for t in tags if t in self.ids]
+
+  def decode(self, ids: Iterable[int]) -> List[str]:
+    return [self.tags[i] for i in ids]
+
+  def to_list(self) -> List[str]:
+    return list(self.tags)
+
+  @classmethod
+  def from_list(cls, tags: List[str]) -> "TagVocab":
+    return cls(tags)
+
+
+def _b64(array: np.ndarray) -> str:
+  return base64.b64encode(array.tobytes()).decode("ascii")
+
+
+def _unb64(data: str, dtype: str) -> np.ndarray:
+  return np.frombuffer(base64.b64decode(data), dtype=np.dtype(dtype).newbyteorder("<"))
+
+
+def pack_rows(rows: Dict[int, Dict[int, float]], dtype: Optional[str] = None) -> list | dict:
+  """
+  {row: {col: value}} → [[row, [cols], [values]], ...] (JSON向け)
+  dtype ("float32" / "float16") を指定すると CSR 形式のバイナリにする
+  """
+  if dtype is None:
+    return [[row, list(cols.keys()), list(cols.values())] for row, cols in rows.items()]
+  if dtype not in ROW_DTYPES:
+    raise ValueError(f"unsupported dtype: {dtype} (expected one of {ROW_DTYPES})")
+  indptr = [0]
+  indices: List[int] = []
+  values: List[float] = []
+  for cols in rows.values():
+    indices.extend(cols.keys())
+    values.extend(cols.values())
+    indptr.append(len(indices))
+  return {
+    "dtype": dtype,
+    "rows": _b64(np.asarray(list(rows.keys()), dtype="<i4")),
+    "indptr": _b64(np.asarray(indptr, dtype="<i4")),
+    "indices": _b64(np.asarray(indices, dtype="<i4")),
+    "values": _b64(np.asarray(values, dtype=np.dtype(dtype).newbyteorder("<"))),
+  }
+
+
+def unpack_rows(packed: list | dict, size: int = 0) -> Dict[int, Dict[int, float]]:
+  """
+  pack_rows の逆変換。
+  size を渡すと同じIDに同じ int オブジェクトを使い回す (JSONから読んだ int は毎回別オブジェクトになるため)
+  """
+  if isinstance(packed, dict):
+    rows = _unb64(packed["rows"], "int32").tolist()
+    indptr = _unb64(packed["indptr"], "int32").tolist()
+    indices = _unb64(packed["indices"], "int32").tolist()
+    # float16 の値も Python の float (double) として扱う
+    values = _unb64(packed["values"], packed["dtype"]).astype(np.float64).tolist()
+    packed = [
+      [row, indices[indptr[i]:indptr[i + 1]], values[indptr[i]:indptr[i + 1]]]
+      for i, row in enumerate(rows)
+    ]
+  if size <= 0:
+    return {row: dict(zip(cols, values)) for row, cols, values in packed}
+  shared = list(range(size))
+  return {
+    shared[row]: {shared[c]: v for c, v in zip(cols, values)}
+    for row, cols, values in packed
+  }
+
+
+def encode_rows(rows: Dict[str, Dict[str, float]], vocab: TagVocab) -> Dict[int, Dict[int, float]]:
+  """文字列キーの旧形式の行を ID キーに変換する。"""
+  return {
+    vocab.add(row): {vocab.add(col): value for col, value in cols.items()}
+    for row, cols in rows.items()
+  }
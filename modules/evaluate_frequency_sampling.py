@@ -0,0 +1,111 @@
+"""
+from_frequency_like sampler check (sample_sequential vs. the previous Bernoulli fill loop)
+
+Usage:
+  python modules/evaluate_frequency_sampling.py [--trials 100000] [--seed 0] [--json]
+
+以前の実装 (重みの昇順に「random() < p なら採用」を k 個たまるまで周回する) をそのまま再現し、
+sample_sequential と同じ確率・同じ k で何度も引いて、
+タグごとの採用率 (marginal) と結果 (順序つき) の分布を比べる。
+差が標準誤差の --z-limit 倍を超えたら終了コード 1 で終わる。
+"""
+
+import argparse
+import json
+import math
+import random
+import sys
+from collections import Counter
+from pathlib import Path
+
+# Add project root to path when running as standalone script
+if __name__ == "__main__":
+  sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from modules.prompt_processor import sample_sequential
+
+
+# (名前, 確率 (昇順), k, 重複を許すか)
+CASES = [
+  ("review", [.1, .2, .3, .5, .8, .9], 3, False),
+  ("small-probs", [.01, .02, .02, .05, .1], 2, False),
+  ("sure-tags", [.2, .4, 1.0, 1.0, 1.0], 2, False),
+  ("duplicates", [.1, .3, .6], 5, True),
+]
+
+
+def legacy_fill(probs: list[float], k: int, allow_duplicate: bool, rng: random.Random) -> list[int]:
+  """The previous from_frequency_like loop (without prompt weighting), returning indices."""
+  picks = []
+  while len(picks) < k:
+    for i, p in enumerate(probs):
+      if len(picks) >= k:
+        break
+      if rng.random() < p:
+        if not allow_duplicate and i in picks:
+          continue
+        picks.append(i)
+  return picks
+
+
+def compare(name: str, probs: list[float], k: int, allow_duplicate: bool, trials: int, seed: int) -> dict:
+  rng = random.Random(seed)
+  old_counts, new_counts = Counter(), Counter()
+  old_outcomes, new_outcomes = Counter(), Counter()
+  for _ in range(trials):
+    old = legacy_fill(probs, k, allow_duplicate, rng)
+    old_counts.update(set(old))
+    old_outcomes[tuple(old)] += 1
+  random.seed(seed + 1)
+  for _ in range(trials):
+    new = sample_sequential(probs, k, allow_duplicate=allow_duplicate)
+    new_counts.update(set(new))
+    new_outcomes[tuple(new)] += 1
+
+  old_marginals = [old_counts[i] / trials for i in range(len(probs))]
+  new_marginals = [new_counts[i] / trials for i in range(len(probs))]
+  z = []
+  for a, b in zip(old_marginals, new_marginals):
+    # 2 標本の比率の差の標準誤差
+    pooled = (a + b) / 2
+    se = math.sqrt(max(pooled * (1 - pooled), 1e-12) * 2 / trials)
+    z.append(abs(a - b) / se)
+  # 順序つきの結果の全変動距離 (順序・重複の入り方まで同じかを見る)
+  outcomes = set(old_outcomes) | set(new_outcomes)
+  tv = sum(abs(old_outcomes[o] - new_outcomes[o]) for o in outcomes) / (2 * trials)
+  return {
+    "case": name,
+    "probs": probs,
+    "k": k,
+    "allow_duplicate": allow_duplicate,
+    "old_marginals": [round(x, 4) for x in old_marginals],
+    "new_marginals": [round(x, 4) for x in new_marginals],
+    "max_z": round(max(z), 2),
+    "outcomes": len(outcomes),
+    "total_variation": round(tv, 4),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--trials", type=int, default=100_000)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--z-limit", type=float, default=4.5)
+  parser.add_argument("--json", action="store_true")
+  args = parser.parse_args()
+
+  results = [compare(*case, trials=args.trials, seed=args.seed) for case in CASES]
+  failed = [r for r in results if r["max_z"] > args.z_limit]
+  if args.json:
+    print(json.dumps({"results": results, "ok": not failed}, indent=2))
+  else:
+    for r in results:
+      print(f"{r['case']:>12}  k={r['k']}  max z={r['max_z']:.2f}  TV={r['total_variation']:.4f} ({r['outcomes']} outcomes)")
+      print(f"{'old':>12}  {r['old_marginals']}")
+      print(f"{'new':>12}  {r['new_marginals']}")
+    print("OK" if not failed else f"FAILED: {', '.join(r['case'] for r in failed)}")
+  sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+  main()
@@ -1,10 +1,14 @@
 import asyncio
+import atexit
+import threading
+import time
 import traceback
+from collections import deque
 from pydantic import BaseModel
-from typing import Any, Callable, Optional, get_type_hints
+from typing import Any, Callable, Literal, Optional, get_type_hints
 import inspect
 
-from logger import critical
+from logger import critical, warn
 
 class CallbackChainObject:
   def __init__(self, result: Any, sid, prv: "CallbackChainObject" = None):
@@ -36,7 +40,10 @@ class Callback:
         "mode": "any"
       }
   
-  async def run(self, this: "Event", event: "EventType", chain: "CallbackChainObject" = None) -> CallbackChainObject:
+  async def run(
+    self, this: "Event", event: "EventType", chain: "CallbackChainObject" = None, inline_sync: bool = False
+  ) -> CallbackChainObject:
+    """inline_sync: 同期コールバックを to_thread を経由せずその場で呼ぶ (専用スレッドで処理する場合)"""
     sig = get_type_hints(self.cb)
     sig.pop("return", None)
     args = [event.model_copy()]
@@ -46,6 +53,8 @@ class Callback:
     try:
       if inspect.iscoroutinefunction(self.cb):
         res = await self.cb(*args)
+      elif inline_sync:
+        res = self.cb(*args)
       else:
         res = await asyncio.to_thread(self.cb, *args)
     except Exception:
@@ -67,6 +76,99 @@ EventEnum = {
   0: "generation_ended",
 }
 
+OverflowPolicy = Literal["block", "drop_newest", "drop_oldest", "coalesce"]
+
+
+class EventQueue:
+  """
+  Bounded queue of triggered events consumed by a dedicated thread (with its own event loop).
+
+  満杯のときの扱い (policy):
+    block       空くまで待つ (イベントは失わない)
+    drop_newest 新しいイベントを捨てる
+    drop_oldest 一番古い未処理のイベントを捨てる
+    coalesce    coalesce_key が同じ未処理のイベントを新しいもので置き換える (なければ block)
+  """
+  def __init__(
+    self, event: "Event", maxsize: int = 1024, policy: OverflowPolicy = "block",
+    coalesce_key: Optional[Callable[["EventType"], Any]] = None,
+  ):
+    self.event = event
+    self.maxsize = maxsize
+    self.policy = policy
+    self.coalesce_key = coalesce_key or (lambda ev: getattr(ev, "event_name", None))
+    self.dropped = 0
+    self._items: deque[tuple[str, EventType]] = deque()
+    self._cond = threading.Condition()
+    self._busy = False
+    self._thread: Optional[threading.Thread] = None
+
+  def __len__(self) -> int:
+    return len(self._items)
+
+  def _start(self) -> None:
+    if self._thread is None or not self._thread.is_alive():
+      name = EventEnum.get(self.event.EventId, "event")
+      self._thread = threading.Thread(target=self._consume, daemon=True, name=f"event-{name}")
+      self._thread.start()
+
+  def _drop(self, what: str) -> None:
+    self.dropped += 1
+    # 大量に落ちたときにログを埋めないよう 2 の冪回目だけ警告する
+    if self.dropped & (self.dropped - 1) == 0:
+      warn(f"[Event] {EventEnum.get(self.event.EventId, 'unknown')}: queue full, dropped {what} (total {self.dropped})")
+
+  def put(self, type: str, obj: "EventType", timeout: Optional[float] = None) -> bool:
+    """Enqueue without running callbacks. Returns False if the event was dropped."""
+    with self._cond:
+      self._start()
+      if len(self._items) >= self.maxsize:
+        if self.policy == "drop_newest":
+          self._drop("newest event")
+          return False
+        if self.policy == "drop_oldest":
+          self._items.popleft()
+          self._drop("oldest event")
+        else:
+          if self.policy == "coalesce":
+            key = self.coalesce_key(obj)
+            for i in range(len(self._items) - 1, -1, -1):
+              if self.coalesce_key(self._items[i][1]) == key:
+                self._items[i] = (type, obj)
+                return True
+          if not self._cond.wait_for(lambda: len(self._items) < self.maxsize, timeout):
+            self._drop("event after waiting")
+            return False
+      self._items.append((type, obj))
+      self._cond.notify_all()
+      return True
+
+  def full(self) -> bool:
+    return len(self._items) >= self.maxsize
+
+  def _consume(self) -> None:
+    loop = asyncio.new_event_loop()
+    try:
+      while True:
+        with self._cond:
+          self._cond.wait_for(lambda: len(self._items) > 0)
+          type, obj = self._items.popleft()
+          self._busy = True
+          self._cond.notify_all()
+        try:
+          loop.run_until_complete(self.event.dispatch(type, obj, inline_sync=True))
+        finally:
+          with self._cond:
+            self._busy = False
+            self._cond.notify_all()
+    finally:
+      loop.close()
+
+  def flush(self, timeout: Optional[float] = None) -> bool:
+    """Wait until every queued event has been handled. Returns False on timeout."""
+    with self._cond:
+      return self._cond.wait_for(lambda: not self._items and not self._busy, timeout)
+
 
 class Event:
   """base class for event/triggers
@@ -80,18 +182,33 @@ class Event:
     self.target_cls = None
     
     self.callbacks: list[Callback] = []
+    # None なら trigger() はコールバックをその場で await する
+    self.queue: Optional[EventQueue] = None
     
     # todo: anycb
   
+  def use_queue(
+    self, maxsize: int = 1024, policy: OverflowPolicy = "block",
+    coalesce_key: Optional[Callable[[EventType], Any]] = None,
+  ) -> EventQueue:
+    """
+    trigger() をキューに積むだけにし、コールバックは専用スレッドで順番に処理する。
+    コールバックは order の昇順 (同じ order なら登録順) に、イベントは trigger された順に呼ばれる。
+    """
+    self.queue = EventQueue(self, maxsize, policy, coalesce_key)
+    _queued_events.append(self)
+    return self.queue
+
+  def flush(self, timeout: Optional[float] = None) -> bool:
+    """Wait for the queued events to be handled (True when there is no queue)."""
+    if self.queue is None:
+      return True
+    return self.queue.flush(timeout)
+
   def preproc(self, cb: Callback) -> Optional[Callback]: return cb
   def add_callback(self, cb: Callable, order: int = -1, chain: bool = True) -> Optional[int]:
     """return: callback id or None (not added)"""
-    callback = Callback(cb, order, auto_chain=chain)
-    proc_cb = self.preproc(callback)
-    if proc_cb is not None:
-      self.callbacks[order] = proc_cb
-      return proc_cb.id
-    return None
+    return self.put_callback(Callback(cb, order, auto_chain=chain))
   def put_callback(self, cb: Callback) -> Optional[int]:
     """return: callback id or None (not added)"""
     proc_cb = self.preproc(cb)
@@ -112,16 +229,33 @@ class Event:
     self, type: str,
     obj: EventType,
   ):
+    if self.queue is None:
+      await self.dispatch(type, obj)
+      return
+    if not self.callbacks:
+      return
+    if self.queue.full() and self.queue.policy in ("block", "coalesce"):
+      # 待つ場合でもイベントループは止めない
+      await asyncio.to_thread(self.queue.put, type, obj)
+    else:
+      self.queue.put(type, obj)
+
+  async def dispatch(
+    self, type: str,
+    obj: EventType,
+    inline_sync: bool = False,
+  ):
+    """Run the callbacks for `obj` now, in order."""
     callbacks = sorted(self.callbacks, key=lambda x: x.order)
     try:
       if not callbacks:
         return
-      chain = await callbacks[0].run(self, obj)
+      chain = await callbacks[0].run(self, obj, inline_sync=inline_sync)
       for cb in callbacks[1:]:
         if cb.chain:
-          chain = await cb.run(self, obj, chain)
+          chain = await cb.run(self, obj, chain, inline_sync=inline_sync)
         else:
-          await cb.run(self, obj)
+          await cb.run(self, obj, inline_sync=inline_sync)
     except Exception:
       critical(f"{EventEnum.get(self.EventId, 'unknown')} ({type}): Callback Error")
       traceback.print_exc()
@@ -134,4 +268,20 @@ class Event:
       await self.trigger(getattr(ev, "event_name", "blank"), ev)
     except Exception:
       critical(f"{EventEnum.get(self.EventId, 'unknown')}: Callback Error in auto_trig")
-      traceback.print_exc()
\ No newline at end of file
+      traceback.print_exc()
+
+
+_queued_events: list[Event] = []
+
+def flush_events(timeout: Optional[float] = 30.0) -> bool:
+  """Wait for every queued event to be handled (registered for interpreter exit)."""
+  deadline = None if timeout is None else time.monotonic() + timeout
+  ok = True
+  for ev in _queued_events:
+    remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+    if not ev.flush(remaining):
+      critical(f"{EventEnum.get(ev.EventId, 'unknown')}: {len(ev.queue)} event(s) not handled before shutdown")
+      ok = False
+  return ok
+
+atexit.register(flush_events)
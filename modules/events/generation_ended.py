@@ -42,7 +42,8 @@ class OnGenerationEnded(Event):
   """
   実際には生成完了時ではなく、各画像の最終処理終了後、または外部hookに対し結果の引き渡しが行われた際に画像ごとに呼ばれる
   
-  
+  コールバック (生成ログ、タグ統計など) は専用スレッドで処理され、生成ループは待たない。
+  記録を失わないよう、キューが満杯のときだけ空くまで待つ (block)。
   """
 
   def __init__(self):
@@ -50,6 +51,7 @@ class OnGenerationEnded(Event):
     self.EventId = 0
     self.accept_events = [OnGenerationEndedEvent]
     self.target_cls = OnGenerationEndedEvent
+    self.use_queue(maxsize=1024, policy="block")
     
   async def trigger_from_result(
     self, p: GenerationResult, saved: bool,
@@ -22,6 +22,7 @@ from modules.utils.timer import TimerInstance
 from modules.utils.util import rndrange, sha256
 from modules.forever_generation import ForeverGeneration, ForeverGenerationResponse
 from modules.prompt_setting import setting
+from modules.blacklist import BlacklistMatcher
 from modules.booru_filter import BooruOptions, booru_filter
 from modules.utils.lora_util import is_lora_trigger
 from modules.utils.tagger import get_rating
@@ -1263,12 +1264,12 @@ class ForeverGenerationTemplate(ForeverGeneration):
                 continue
 
             # blacklist check
-            b = opt.booru_blacklist
+            b = BlacklistMatcher.from_patterns(opt.booru_blacklist)
 
             itms = chain(tags.items(), character_tags.items())
             for tag, _ in itms:
                 # debug(f"[Checking tag]: {tag}")
-                if any(bl.search(tag) for bl in b):
+                if b.matches(tag):
                     self.stdout(
                         f"[Caption]: Tag '{tag}' is blacklisted. Skipping image."
                     )
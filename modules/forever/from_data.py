@@ -1,6 +1,6 @@
 import random
 
-from modules.calculator.inference import PromptInferenceEngine
+from modules.calculator.engine_cache import engine_cache
 from modules.forever.common import ForeverGenerationTemplate
 import gradio as gr
 
@@ -13,8 +13,8 @@ class ForeverGenerationFromData(ForeverGenerationTemplate):
     self.instance_name = "from Data"
   
   def on_reset(self):
-    if hasattr(self, "engine") and self.engine is not None: del self.engine
-    self.engine: PromptInferenceEngine = None
+    # エンジンはプロセス全体で共有されるキャッシュから毎回取り出す (学習データが更新されたら差し替わる)
+    self.datapath: str = None
     self.top_k = [] # min, max
     self.temperature = 1.0
     self.sim_thres = []
@@ -38,9 +38,10 @@ class ForeverGenerationFromData(ForeverGenerationTemplate):
     **kw
   ):
     try:
-      self.engine = PromptInferenceEngine(datapath)
+      await engine_cache.aget(datapath)
     except FileNotFoundError:
       raise gr.Error(f"Data file not found: {datapath}")
+    self.datapath = datapath
     self.input_data = init_data_tags.split(",")
     if self.input_data == [""] or len(self.input_data) == 0:
       raise gr.Error("Initial tags cannot be empty!")
@@ -59,8 +60,9 @@ class ForeverGenerationFromData(ForeverGenerationTemplate):
   
   async def get_payload(self):
     p = await self._get_payload()
+    engine = await engine_cache.aget(self.datapath)
     p["prompt"] = self.combine_header_footer(
-        self.engine.generate_prompt(
+        engine.generate_prompt(
           self.input_data, 
           self.input_negatives,
           rndrange(self.temperature),
@@ -1,12 +1,17 @@
+import atexit
 import os
-import re
+import sqlite3
+import threading
 import time
 import uuid
 import json
+from collections import Counter
+from itertools import combinations, product
 from pydantic import BaseModel, ConfigDict
 from typing import Optional, Any
 
 from modules.events.generation_ended import OnGenerationEndedEvent, onGenerationEnded
+from modules.utils.segment_log import SegmentedLog
 
 
 class MismatchData(BaseModel):
@@ -45,6 +50,177 @@ class TagStatsMaster(BaseModel):
   co_detected: dict[str, int] = {}
 
 
+class TagStatsStore:
+  """
+  タグ統計の集計ストア (sqlite)
+
+  更新はメモリ上の差分カウンタに足すだけで、flush_interval 秒ごと (と終了時) に
+  まとめて sqlite に書き込む。クラッシュ時に失うのは最後の flush 以降の分のみ。
+  TagStatsMaster (タグごとの成績表) は get() で必要なときに計算する。
+
+  - tags: タグごとの使用回数 / 検出回数 / Keep 回数
+  - pairs: 同じプロンプトに含まれた回数 (a < b の組で 1 行)
+  - co_detected: tag が検出されたときに other と同時に使われた回数 (向きあり)
+  """
+  SCHEMA = """
+  CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT PRIMARY KEY, usage INTEGER NOT NULL, detection INTEGER NOT NULL, keep INTEGER NOT NULL
+  );
+  CREATE TABLE IF NOT EXISTS pairs (
+    a TEXT NOT NULL, b TEXT NOT NULL, co INTEGER NOT NULL, PRIMARY KEY (a, b)
+  ) WITHOUT ROWID;
+  CREATE INDEX IF NOT EXISTS pairs_b ON pairs(b);
+  CREATE TABLE IF NOT EXISTS co_detected (
+    tag TEXT NOT NULL, other TEXT NOT NULL, n INTEGER NOT NULL, PRIMARY KEY (tag, other)
+  ) WITHOUT ROWID;
+  """
+  TOP_CO_OCCURRENCE = 100
+
+  def __init__(self, db_path: str, legacy_dir: Optional[str] = None, flush_interval: float = 10.0):
+    self.db_path = db_path
+    self.legacy_dir = legacy_dir
+    self.flush_interval = flush_interval
+    self._conn: Optional[sqlite3.Connection] = None
+    self._lock = threading.RLock()
+    self._timer: Optional[threading.Timer] = None
+    self._reset_pending()
+    atexit.register(self.flush)
+
+  def _reset_pending(self) -> None:
+    self._tags: dict[str, list[int]] = {}
+    self._pairs: Counter[tuple[str, str]] = Counter()
+    self._co_detected: Counter[tuple[str, str]] = Counter()
+
+  def _connect(self) -> sqlite3.Connection:
+    if self._conn is None:
+      os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+      is_new = not os.path.exists(self.db_path)
+      conn = sqlite3.connect(self.db_path, check_same_thread=False)
+      conn.execute("PRAGMA journal_mode=WAL")
+      conn.executescript(self.SCHEMA)
+      self._conn = conn
+      if is_new and self.legacy_dir and os.path.isdir(self.legacy_dir):
+        self._import_legacy()
+    return self._conn
+
+  def _import_legacy(self) -> None:
+    """Import the per-tag JSON files written by the previous implementation (once, into a new store)."""
+    tags, pairs, co_detected = [], {}, []
+    for fn in os.listdir(self.legacy_dir):
+      if not fn.endswith(".json"):
+        continue
+      try:
+        with open(os.path.join(self.legacy_dir, fn), "r", encoding="utf-8") as f:
+          stats = TagStatsMaster(**json.load(f))
+      except Exception:
+        continue
+      tag = stats.tag_name
+      tags.append((tag, stats.usage_count, stats.detection_count, stats.keep_count))
+      for other, n in stats.co_occurrence.items():
+        # 両方のファイルに同じ組が (上位 100 件で切られつつ) 入っているので大きい方を採る
+        key = (tag, other) if tag < other else (other, tag)
+        pairs[key] = max(pairs.get(key, 0), n)
+      co_detected += [(tag, other, n) for other, n in stats.co_detected.items()]
+    conn = self._conn
+    conn.executemany("INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?)", tags)
+    conn.executemany("INSERT OR REPLACE INTO pairs VALUES (?, ?, ?)", [(a, b, n) for (a, b), n in pairs.items()])
+    conn.executemany("INSERT OR REPLACE INTO co_detected VALUES (?, ?, ?)", co_detected)
+    conn.commit()
+
+  def add(self, prompt_tags: set[str], detected: set[str], keep: bool, seen: set[str] = frozenset()) -> None:
+    """
+    Count one generation (memory only).
+    seen: tags that appeared only in the tagger output (registered with zero counts)
+    """
+    with self._lock:
+      tags = self._tags
+      for tag in prompt_tags:
+        c = tags.get(tag)
+        if c is None:
+          c = tags[tag] = [0, 0, 0]
+        c[0] += 1
+        if tag in detected:
+          c[1] += 1
+        if keep:
+          c[2] += 1
+      for tag in seen:
+        if tag not in tags:
+          tags[tag] = [0, 0, 0]
+      self._pairs.update(combinations(sorted(prompt_tags), 2))
+      # (tag, tag) の組も数えてしまうが、flush で捨てる
+      self._co_detected.update(product(detected, prompt_tags))
+      if self._timer is None:
+        self._timer = threading.Timer(self.flush_interval, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+  def flush(self) -> None:
+    """Write the pending counters to sqlite."""
+    with self._lock:
+      timer, self._timer = self._timer, None
+      if timer is not None:
+        timer.cancel()
+      if not self._tags and not self._pairs:
+        return
+      tags, pairs, co_detected = self._tags, self._pairs, self._co_detected
+      self._reset_pending()
+      conn = self._connect()
+      with conn:
+        conn.executemany(
+          "INSERT INTO tags VALUES (?, ?, ?, ?) ON CONFLICT(tag) DO UPDATE SET "
+          "usage = usage + excluded.usage, detection = detection + excluded.detection, keep = keep + excluded.keep",
+          [(t, *c) for t, c in tags.items()],
+        )
+        conn.executemany(
+          "INSERT INTO pairs VALUES (?, ?, ?) ON CONFLICT(a, b) DO UPDATE SET co = co + excluded.co",
+          [(a, b, n) for (a, b), n in pairs.items()],
+        )
+        conn.executemany(
+          "INSERT INTO co_detected VALUES (?, ?, ?) ON CONFLICT(tag, other) DO UPDATE SET n = n + excluded.n",
+          [(t, o, n) for (t, o), n in co_detected.items() if t != o],
+        )
+
+  def get(self, tag: str) -> Optional[TagStatsMaster]:
+    """Per-tag statistics (the same shape as the former per-tag JSON files)."""
+    self.flush()
+    with self._lock:
+      conn = self._connect()
+      row = conn.execute("SELECT usage, detection, keep FROM tags WHERE tag = ?", (tag,)).fetchone()
+      if row is None:
+        return None
+      co_rows = conn.execute(
+        "SELECT other, co FROM ("
+        "  SELECT b AS other, co FROM pairs WHERE a = ? UNION ALL SELECT a AS other, co FROM pairs WHERE b = ?"
+        ") ORDER BY co DESC LIMIT ?",
+        (tag, tag, self.TOP_CO_OCCURRENCE),
+      ).fetchall()
+      co_detected_all = dict(conn.execute("SELECT other, n FROM co_detected WHERE tag = ?", (tag,)).fetchall())
+    usage, detection, keep = row
+    co_occurrence = dict(co_rows)
+    co_detected = {k: v for k, v in co_detected_all.items() if k in co_occurrence}
+    detection_rate = round((detection / usage) * 100.0, 2) if usage else 0.0
+    conflicts = [
+      co_tag for co_tag, co_count in co_occurrence.items()
+      if co_count >= 2 and (co_detected.get(co_tag, 0) / co_count) * 100.0 < detection_rate
+    ]
+    return TagStatsMaster(
+      tag_name=tag,
+      usage_count=usage,
+      detection_rate=detection_rate,
+      keep_rate=round((keep / usage) * 100.0, 2) if usage else 0.0,
+      co_occurrence=co_occurrence,
+      conflicts=conflicts,
+      detection_count=detection,
+      keep_count=keep,
+      co_detected=co_detected,
+    )
+
+  def tags(self) -> list[str]:
+    self.flush()
+    with self._lock:
+      return [r[0] for r in self._connect().execute("SELECT tag FROM tags ORDER BY usage DESC, tag")]
+
+
 class OutputLogger:
   """今後の機能のための出力保存機構の統合管理クラス"""
 
@@ -57,20 +233,6 @@ class OutputLogger:
       os.makedirs(logs_dir, exist_ok=True)
     return logs_dir
 
-  @classmethod
-  def sanitize_tag_name(cls, tag_name: str) -> str:
-    """特殊文字を全角疑問符に置換してファイル名を正規化"""
-    return re.sub(r'[\\/:*?"<>|\x00-\x1f]', "？", tag_name)
-
-  @classmethod
-  def get_tag_stats_path(cls, tag_name: str) -> str:
-    """タグマスタJSONファイルのパスを取得"""
-    stats_dir = os.path.join(cls.get_logs_dir(), "tag_stats")
-    if not os.path.exists(stats_dir):
-      os.makedirs(stats_dir, exist_ok=True)
-    safe_name = cls.sanitize_tag_name(tag_name)
-    return os.path.join(stats_dir, f"{safe_name}.json")
-
   @classmethod
   def extract_normalized_tags(cls, event: Optional[OnGenerationEndedEvent] = None, raw_tags: Optional[list[str]] = None) -> list[str]:
     """プロンプトまたはイベントから正規化済みタグリストを生成"""
@@ -244,86 +406,51 @@ class OutputLogger:
       param=record_param,
     )
 
+  _records_log: Optional[SegmentedLog] = None
+
+  @classmethod
+  def records_log(cls) -> SegmentedLog:
+    """生成ログ (/logs/generation_records/ のセグメント化ログ。旧 generation_records.jsonl は初回に取り込む)"""
+    if cls._records_log is None:
+      logs_dir = cls.get_logs_dir()
+      cls._records_log = SegmentedLog(os.path.join(logs_dir, "generation_records"), ts_key="timestamp")
+      legacy = os.path.join(logs_dir, "generation_records.jsonl")
+      if os.path.exists(legacy):
+        cls._records_log.import_jsonl(legacy)
+    return cls._records_log
+
   @classmethod
   def save_generation_record(cls, record: GenerationLogRecord) -> None:
-    """生成ログを /logs/generation_records.jsonl に保存"""
-    logs_dir = cls.get_logs_dir()
-    jsonl_path = os.path.join(logs_dir, "generation_records.jsonl")
+    """生成ログを /logs/generation_records/ に保存"""
     data_dict = record.model_dump() if hasattr(record, "model_dump") else record.dict()
-    os.makedirs(os.path.dirname(jsonl_path), exist_ok=True)
-    if not os.path.exists(jsonl_path):
-      with open(jsonl_path, "w", encoding="utf-8") as f:
-        pass
-    try:
-      from modules.utils import jsonl
-      jsonl.append(data_dict, jsonl_path, ensure_ascii=False, encoding="utf-8")
-    except Exception:
-      with open(jsonl_path, "a", encoding="utf-8") as f:
-        f.write(json.dumps(data_dict, ensure_ascii=False) + "\n")
+    cls.records_log().append(data_dict)
+
+  _tag_stats: Optional[TagStatsStore] = None
+
+  @classmethod
+  def tag_stats(cls) -> TagStatsStore:
+    """タグ統計の集計ストア (/logs/tag_stats.sqlite3)"""
+    if cls._tag_stats is None:
+      logs_dir = cls.get_logs_dir()
+      cls._tag_stats = TagStatsStore(
+        os.path.join(logs_dir, "tag_stats.sqlite3"),
+        legacy_dir=os.path.join(logs_dir, "tag_stats"),
+      )
+    return cls._tag_stats
+
+  @classmethod
+  def get_tag_stats(cls, tag_name: str) -> Optional[TagStatsMaster]:
+    """タグごとの成績表を集計ストアから計算して返す (記録がなければ None)"""
+    return cls.tag_stats().get(tag_name)
 
   @classmethod
   def update_tag_stats(cls, record: GenerationLogRecord) -> None:
-    """IOベースで全ログ結果からタグ統計マスタを集計・更新し保存"""
+    """生成結果をタグ統計に加算する (書き込みは集計ストアがまとめて行う)"""
     lost_set = set(record.mismatch_data.get("Lost", record.mismatch_data.get("lost", [])) or [])
     prompt_set = set(record.prompt_tags)
-
-    for tag in prompt_set:
-      fp = cls.get_tag_stats_path(tag)
-      stats: Optional[TagStatsMaster] = None
-      if os.path.exists(fp):
-        try:
-          with open(fp, "r", encoding="utf-8") as f:
-            stats = TagStatsMaster(**json.load(f))
-        except Exception:
-          stats = None
-      if stats is None:
-        stats = TagStatsMaster(tag_name=tag)
-
-      stats.usage_count += 1
-      is_detected = (tag in record.inferred_tags) and (tag not in lost_set)
-      if is_detected:
-        stats.detection_count += 1
-      if record.user_action == "Keep":
-        stats.keep_count += 1
-
-      stats.detection_rate = round((stats.detection_count / stats.usage_count) * 100.0, 2)
-      stats.keep_rate = round((stats.keep_count / stats.usage_count) * 100.0, 2)
-
-      for other_tag in prompt_set:
-        if other_tag != tag:
-          stats.co_occurrence[other_tag] = stats.co_occurrence.get(other_tag, 0) + 1
-          if is_detected:
-            stats.co_detected[other_tag] = stats.co_detected.get(other_tag, 0) + 1
-
-      sorted_co = dict(sorted(stats.co_occurrence.items(), key=lambda item: item[1], reverse=True)[:100])
-      stats.co_occurrence = sorted_co
-      stats.co_detected = {k: v for k, v in stats.co_detected.items() if k in stats.co_occurrence}
-
-      conflicts: list[str] = []
-      for co_tag, co_count in stats.co_occurrence.items():
-        co_det_rate = (stats.co_detected.get(co_tag, 0) / co_count) * 100.0
-        if co_count >= 2 and co_det_rate < stats.detection_rate:
-          conflicts.append(co_tag)
-      stats.conflicts = conflicts
-
-      try:
-        data_dump = stats.model_dump() if hasattr(stats, "model_dump") else stats.dict()
-        with open(fp, "w", encoding="utf-8") as f:
-          json.dump(data_dump, f, ensure_ascii=False, indent=2)
-      except Exception:
-        pass
-
-    for inferred_tag in record.inferred_tags.keys():
-      if inferred_tag not in prompt_set:
-        fp = cls.get_tag_stats_path(inferred_tag)
-        if not os.path.exists(fp):
-          stats = TagStatsMaster(tag_name=inferred_tag)
-          try:
-            data_dump = stats.model_dump() if hasattr(stats, "model_dump") else stats.dict()
-            with open(fp, "w", encoding="utf-8") as f:
-              json.dump(data_dump, f, ensure_ascii=False, indent=2)
-          except Exception:
-            pass
+    detected = {tag for tag in prompt_set if tag in record.inferred_tags and tag not in lost_set}
+    seen = {tag for tag in record.inferred_tags.keys() if tag not in prompt_set}
+    cls.tag_stats().add(prompt_set, detected, record.user_action == "Keep", seen)
 
   @classmethod
   async def on_generation_ended(cls, event: OnGenerationEndedEvent) -> None:
@@ -1,10 +1,82 @@
 import os, re
-from typing import Literal, Optional
-from logger import println, critical, debug
+import contextvars
+import importlib.util
+import inspect
+import time
+from types import ModuleType
+from typing import Any, Callable, Literal, Optional
+from logger import println, critical, debug, warn
 from pathlib import Path
 import json 
 from modules.utils.prompt import Prompt, PromptPiece
 
+
+class UserScriptCache:
+    """
+    userconf/scripts/*.py のモジュールキャッシュ。
+    ファイルの (mtime, size) が変わったときだけ import し直す。
+    (mtime, size) は check_interval 秒ごと (か invalidate() の後) にだけ stat し直す。
+    """
+    def __init__(self, root: Path = Path("./userconf/scripts"), check_interval: float = 1.0):
+        self.root = root
+        self.check_interval = check_interval
+        self.modules: dict[str, tuple[tuple[int, int], ModuleType]] = {}
+        # name -> (確認した時刻, signature)
+        self._checked: dict[str, tuple[float, Optional[tuple[int, int]]]] = {}
+        # import し直すたびに増える
+        self.revision = 0
+
+    def path(self, name: str) -> Path:
+        path = (self.root / name).resolve()
+        if path.suffix != ".py":
+            path = path.with_suffix(".py")
+        if self.root.resolve() not in path.parents:
+            raise ValueError(f"Script '{name}' is outside of {self.root}")
+        return path
+
+    def signature(self, name: str) -> Optional[tuple[int, int]]:
+        now = time.monotonic()
+        checked = self._checked.get(name)
+        if checked is not None and now - checked[0] < self.check_interval:
+            return checked[1]
+        try:
+            st = self.path(name).stat()
+            sig = (st.st_mtime_ns, st.st_size)
+        except (OSError, ValueError):
+            sig = None
+        self._checked[name] = (now, sig)
+        return sig
+
+    def invalidate(self) -> None:
+        """Re-stat every script on the next lookup."""
+        self._checked.clear()
+
+    def get(self, name: str) -> ModuleType:
+        sig = self.signature(name)
+        if sig is None:
+            raise FileNotFoundError(f"Placeholder script not found: {self.path(name)}")
+        cached = self.modules.get(name)
+        if cached is not None and cached[0] == sig:
+            return cached[1]
+        path = self.path(name)
+        spec = importlib.util.spec_from_file_location(f"userconf_scripts.{path.stem}", path)
+        module = importlib.util.module_from_spec(spec)
+        # スクリプトからは __get_self() で呼び出し中の PromptPlaceholder を取れる
+        module.__dict__["__get_self"] = _current_placeholder.get
+        spec.loader.exec_module(module)
+        self.modules[name] = (sig, module)
+        self.revision += 1
+        debug(f"[UserScriptCache] (Re)loaded {path}")
+        return module
+
+
+# スクリプトの関数を呼んでいる間だけ、その PromptPlaceholder を指す (タスクごとに独立)
+_current_placeholder: contextvars.ContextVar[Optional["PromptPlaceholder"]] = contextvars.ContextVar(
+    "current_placeholder", default=None
+)
+
+user_scripts = UserScriptCache()
+
 class PromptPlaceholder: # pattern mode
     @staticmethod
     def default_if() -> dict:
@@ -64,6 +136,14 @@ class PromptPlaceholder: # pattern mode
         self.refill_after = self.if_opt.get("refill_after_blacklist", False) #+
         self.d_ver = self.data.get("version", 1.0) #-
         
+        # v1.2 script mode: key の代わりに userconf/scripts/<script> の関数の戻り値で置き換える
+        self.script: Optional[str] = self.data.get("script") or None
+        self.script_function: str = self.data.get("function", "do")
+        self._script_fn: Optional[Callable[..., Any]] = None
+        
+        # 全パターンをまとめたもの (どれにもマッチしない piece を 1 回の search で飛ばす)
+        self.combined: Optional[re.Pattern] = None
+        
     async def apply_pattern(self):
         flag = 0
         for f in self.flags:
@@ -82,8 +162,40 @@ class PromptPlaceholder: # pattern mode
                     flags=flag
                 )
             )
+        self.combined = combine_patterns(self.should_process)
         self.initialized = True
 
+    def literal_matches(self) -> Optional[list[tuple[str, bool]]]:
+        """
+        (literal, ignorecase) of every matchTo when they all match as plain text
+        (default patternTemplate, no regex syntax). None if any pattern needs the regex.
+        """
+        if self.pattern_template != self.default_if()["patternTemplate"]:
+            return None
+        flags = {p.flags & ~re.UNICODE for p in self.should_process}
+        if len(flags) > 1 or not flags <= {0, re.IGNORECASE}:
+            return None
+        ignorecase = re.IGNORECASE in flags
+        literals = []
+        for m in self.matchTo:
+            if not m or m != m.strip() or not (self.escape or re.escape(m) == m):
+                return None
+            literals.append((m, ignorecase))
+        return literals
+
+    def resolve_script(self) -> None:
+        """Look up the script function (the module is re-imported only when the file changed)."""
+        if self.script is None:
+            return
+        try:
+            module = user_scripts.get(self.script)
+            fn = getattr(module, self.script_function)
+        except Exception as e:
+            warn(f"[PromptPlaceholder] Failed to load script '{self.script}' ({self.name}): {e}")
+            self._script_fn = None
+            return
+        self._script_fn = fn
+
     def _mark_refill_snapshot(self, piece: PromptPiece) -> None:
         entries: list[dict[str, str]] = piece.ensure_meta("placeholder_refill", [])
         label = f"placeholder:{self.name}:{id(piece)}:{len(entries)}"
@@ -95,39 +207,229 @@ class PromptPlaceholder: # pattern mode
         })
         piece.set_meta("placeholder_refill", entries)
 
-    async def trig(self, piece: PromptPiece, trigger_word: str) -> PromptPiece:
+    async def replacement(self, trigger_word: str, full: str) -> Optional[str]:
+        """Replacement text for `trigger_word` (None removes the piece in script mode)"""
+        if self.script is None:
+            return self.rprTo
+        if self._script_fn is None:
+            self.resolve_script()
+        if self._script_fn is None:
+            return trigger_word
+        token = _current_placeholder.set(self)
+        try:
+            result = self._script_fn(trigger_word, full)
+            if inspect.isawaitable(result):
+                result = await result
+        except Exception as e:
+            # 例外のときは元のプロンプトを使う
+            warn(f"[PromptPlaceholder] Script '{self.script}' raised for '{trigger_word}': {e}")
+            return trigger_word
+        finally:
+            _current_placeholder.reset(token)
+        return None if result is None else str(result)
+
+    async def trig(self, piece: PromptPiece, trigger_word: str, full: str = "") -> PromptPiece:
         if self.if_opt["replace"] and trigger_word in piece.value:
-            debug(f"[PromptPlaceholder] Replacing '{trigger_word}' with '{self.rprTo}'")
-            piece.set(piece.value.replace(trigger_word, self.rprTo, 1), source=self.name)
+            replacement = await self.replacement(trigger_word, full)
+            debug(f"[PromptPlaceholder] Replacing '{trigger_word}' with '{replacement}'")
+            if replacement is None:
+                piece.set("", source=self.name)
+            else:
+                piece.set(piece.value.replace(trigger_word, replacement, 1), source=self.name)
         return piece
     
+    async def process_piece(self, piece: PromptPiece, matched: int = 0, full: str = "") -> int:
+        """
+        Apply this placeholder to one piece.
+        matched は process_prompt 中に piece をまたいで数えるヒット数 (atLeast 用)。更新後の値を返す
+        """
+        target_text = piece.text
+        if self.combined is not None and not self.combined.search(target_text):
+            return matched
+        for pattern in self.should_process:
+            match = pattern.search(target_text)
+            if not match:
+                continue
+            debug(f"[PromptPlaceholder] Matched pattern: {pattern.pattern}")
+            matched += 1
+            if matched >= self.at_least:
+                if self.refill_after:
+                    self._mark_refill_snapshot(piece)
+                await self.trig(piece, match.group(1), full)
+                return 0
+        return matched
+    
     async def process_prompt(self, prompt: Prompt) -> Prompt:
+        self.resolve_script()
+        full = prompt.combine() if self.script is not None else ""
         matched = 0
         for piece in prompt:
-            target_text = piece.text
-            # debug(f"[PromptPlaceholder] Checking '{piece.value}' ({target_text})")
-            for pattern in self.should_process:
-                match = pattern.search(target_text)
-                if not match:
-                    continue
-                debug(f"[PromptPlaceholder] Matched pattern: {pattern.pattern}")
-                matched += 1
-                if matched >= self.at_least:
-                    if self.refill_after:
-                        self._mark_refill_snapshot(piece)
-                    await self.trig(piece, match.group(1))
-                    matched = 0
-                    break
-
+            matched = await self.process_piece(piece, matched, full)
         return prompt
 
+
+def combine_patterns(patterns: list[re.Pattern]) -> Optional[re.Pattern]:
+    """
+    One alternation that matches whenever any of `patterns` matches (search).
+    同じフラグでまとめられない場合 (後方参照, 名前付きグループの重複など) は None
+    """
+    if not patterns or len({p.flags for p in patterns}) != 1:
+        return None
+    if any(re.search(r"\\[1-9]|\(\?P[<=]|^\(\?[aiLmsux]+\)", p.pattern) for p in patterns):
+        return None
+    try:
+        return re.compile("|".join(f"(?:{p.pattern})" for p in patterns), patterns[0].flags)
+    except re.error:
+        return None
+
+def uncaptured_pattern(pattern: str) -> Optional[str]:
+    """
+    `pattern` with every capturing group turned into (?:...), for use inside a large alternation
+    (グループがあると re が alternation を先頭文字/接頭辞でまとめて探す最適化が効かなくなる)。
+    後方参照・条件分岐・途中のフラグ指定があってグループを外せないものは None
+    """
+    if re.search(r"\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)", pattern):
+        return None
+    out = []
+    i, n = 0, len(pattern)
+    in_class = False
+    while i < n:
+        c = pattern[i]
+        if c == "\\":
+            out.append(pattern[i:i + 2])
+            i += 2
+        elif in_class:
+            in_class = c != "]"
+            out.append(c)
+            i += 1
+        elif c == "[":
+            # [] と [^] の直後の ] は文字として扱われる
+            j = i + 1 + (pattern.startswith("^", i + 1))
+            j += pattern.startswith("]", j)
+            out.append(pattern[i:j])
+            in_class = True
+            i = j
+        elif pattern.startswith("(?P<", i):
+            j = pattern.find(">", i)
+            if j < 0:
+                return None
+            out.append("(?:")
+            i = j + 1
+        elif c == "(" and not pattern.startswith("(?", i):
+            out.append("(?:")
+            i += 1
+        else:
+            out.append(c)
+            i += 1
+    return "".join(out)
+
+class PatternTree:
+    """
+    Which items have a pattern that matches (search) a text, without searching every item.
+    
+    フラグと shape (placeholder なら patternTemplate) が同じ item ごとに木を作り、各ノードは配下の item の
+    全パターンをグループなしで 1 段にまとめた alternation にする (根はその組の全パターン)。
+    どれにも当たらないテキストは根の search 1 回で終わり、当たったときは当たった半分にだけ降りるので、
+    マッチした item 1 つにつき O(log n) 回の search で済む。
+    re は枝の先頭の形が揃っているときだけ alternation を先頭の文字でまとめて絞り込むので、形の違うものは混ぜない。
+    まとめられないパターンを持つ item は fallback として個別に search する。
+    """
+    def __init__(self, items: dict[int, list[re.Pattern]], shapes: Optional[dict[int, Any]] = None):
+        self.fallback: list[tuple[int, list[re.Pattern]]] = []
+        groups: dict[tuple[int, Any], list[tuple[int, list[str], list[re.Pattern]]]] = {}
+        for item, patterns in items.items():
+            if not patterns:
+                continue
+            parts = [uncaptured_pattern(p.pattern) for p in patterns]
+            if len({p.flags for p in patterns}) != 1 or any(part is None for part in parts):
+                self.fallback.append((item, patterns))
+                continue
+            shape = shapes.get(item) if shapes is not None else None
+            groups.setdefault((patterns[0].flags, shape), []).append((item, parts, patterns))
+        self.roots = [self._build(scoped, flags) for (flags, _), scoped in groups.items()]
+
+    def _build(self, scoped: list[tuple[int, list[str], list[re.Pattern]]], flags: int) -> Optional[tuple]:
+        """(pattern, item, None) for a leaf, (pattern, None, (left, right)) otherwise (pattern None: always descend)"""
+        if not scoped:
+            return None
+        try:
+            # 入れ子にせず 1 段の alternation にする (re が先頭の文字でまとめて絞り込めるように)
+            pattern = re.compile("|".join(f"(?:{part})" for _, parts, _ in scoped for part in parts), flags)
+        except re.error:
+            pattern = None
+        if len(scoped) == 1:
+            item, _, patterns = scoped[0]
+            if pattern is None:
+                self.fallback.append((item, patterns))
+                return None
+            return (pattern, item, None)
+        half = len(scoped) // 2
+        return (pattern, None, (self._build(scoped[:half], flags), self._build(scoped[half:], flags)))
+
+    def matching(self, text: str) -> set[int]:
+        found = {item for item, patterns in self.fallback if any(p.search(text) for p in patterns)}
+        stack = list(self.roots)
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            pattern, item, children = node
+            if pattern is not None and not pattern.search(text):
+                continue
+            if children is None:
+                found.add(item)
+            else:
+                stack.extend(children)
+        return found
+
+class PlaceholderDispatch:
+    """
+    Index of every placeholder pattern, to find the placeholders a piece can hit without trying them all.
+    
+    - 既定の patternTemplate (^\s*{MATCH}\s*$) でリテラルの matchTo は、strip したテキスト
+      (IGNORECASE なら小文字) の dict で引く
+    - それ以外のパターンを持つ placeholder (generic) は PatternTree で引く
+      (全パターンの alternation 1 回で外れを弾き、当たった枝にだけ降りる)
+    """
+    def __init__(self, scripts: list[PromptPlaceholder]):
+        self.scripts = scripts
+        self.exact: dict[str, list[int]] = {}
+        self.lower: dict[str, list[int]] = {}
+        self.generic: list[int] = []
+        for i, p in enumerate(scripts):
+            literals = p.literal_matches()
+            if literals is None:
+                self.generic.append(i)
+                continue
+            for literal, ignorecase in literals:
+                if ignorecase:
+                    self.lower.setdefault(literal.lower(), []).append(i)
+                else:
+                    self.exact.setdefault(literal, []).append(i)
+        self.generic_tree = PatternTree(
+            {i: scripts[i].should_process for i in self.generic},
+            {i: scripts[i].pattern_template for i in self.generic},
+        )
+    
+    def candidates(self, text: str, after: int = -1) -> list[int]:
+        """Indices (> after, ascending) of the placeholders that match `text`"""
+        stripped = text.strip()
+        found = set(self.exact.get(stripped, ())) | set(self.lower.get(stripped.lower(), ()))
+        if self.generic:
+            found |= self.generic_tree.matching(text)
+        return sorted(i for i in found if i > after)
+
+
 class PromptPlaceholderManager:
     def __init__(self):
         self.placeholders = {}
         self.config_path = Path("./config/prompt_placeholder.json")
         self.config_default = Path("./defaults/DEF/!prompt_placeholder.json")
         self.scripts: list[PromptPlaceholder] = []
+        self.dispatch: Optional[PlaceholderDispatch] = None
         self.initialized = False
+        # scripts を作り直すたびに増える (フィルタ結果のキャッシュの無効化に使う)
+        self.revision = 0
 
         try:
             self.load()
@@ -136,8 +438,11 @@ class PromptPlaceholderManager:
             raise
 
     async def init(self):
+        user_scripts.invalidate()
         self.scripts = await self.runners()
+        self.dispatch = PlaceholderDispatch(self.scripts)
         self.initialized = True
+        self.revision += 1
     async def reload(self): return await self.init()
 
     def load(self):
@@ -202,8 +507,24 @@ class PromptPlaceholderManager:
         prompt_obj, mode = self._coerce_prompt(prompt)
         for p in self.scripts:
             if not p.initialized:
-                await p.apply_pattern() # TODO: cache?
-            prompt_obj = await p.process_prompt(prompt_obj)
+                await p.apply_pattern()
+                self.dispatch = PlaceholderDispatch(self.scripts)
+            p.resolve_script()
+        
+        # piece ごとに全 placeholder を順に適用する (placeholder ごとに全 piece を回すのと同じ結果)
+        full = prompt_obj.combine() if any(p.script is not None for p in self.scripts) else ""
+        matched = [0] * len(self.scripts)
+        for piece in prompt_obj:
+            after = -1
+            while after is not None:
+                text = piece.text
+                last, after = after, None
+                for i in self.dispatch.candidates(text, last):
+                    matched[i] = await self.scripts[i].process_piece(piece, matched[i], full)
+                    if piece.text != text:
+                        # 置き換え後のテキストで後続の placeholder の候補を引き直す
+                        after = i
+                        break
 
         if mode == "prompt":
             return prompt_obj
@@ -213,5 +534,16 @@ class PromptPlaceholderManager:
     
     def all_names(self) -> list[str]:
         return list(self.placeholders.keys())
+    
+    def has_scripts(self) -> bool:
+        """True when a script placeholder is in use (its output may be random or depend on the full prompt)."""
+        return any(p.script is not None for p in self.scripts)
+
+    def script_signature(self) -> tuple:
+        """
+        (script, (mtime, size)) of the script placeholders in use (changes when a script file is edited).
+        stat は UserScriptCache.check_interval 秒に 1 回だけなので、verdict を引くたびに呼んでよい。
+        """
+        return tuple((p.script, user_scripts.signature(p.script)) for p in self.scripts if p.script is not None)
 
 placeholder = PromptPlaceholderManager()
\ No newline at end of file
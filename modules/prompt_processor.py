@@ -12,18 +12,101 @@ from modules.utils.prompt import Prompt, separate_prompt, combine_prompt
 
 from logger import debug, warn
 
+def sample_sequential(probs: list[float], k: int, allow_duplicate: bool = False) -> list[int]:
+    """
+    Draw k indices with the same distribution as the sequential fill of from_frequency_like:
+    walk the indices in order (wrapping around), keep index i when random() < probs[i] and stop at k.
+    Without allow_duplicate, indices already kept are skipped. Returns them in the order they were kept.
+
+    外れ続ける周回は引かず、次に採用される位置を直接引く (1 件あたり O(n), 全体 O(n·k) で打ち切りなし)。
+    位置 s から 1 周ぶんの候補を並べると、j 番目が次に採用される確率は
+    p_j · Π(手前の候補の 1 - p) / (1 - Π(全候補の 1 - p))。
+    """
+    n = len(probs)
+    probs = [min(1.0, max(0.0, p)) for p in probs]
+    kept = [False] * n
+    picks = []
+    start = 0
+    while len(picks) < k:
+        order = [i % n for i in range(start, start + n) if allow_duplicate or not kept[i % n]]
+        miss = 1.0
+        for i in order:
+            miss *= 1.0 - probs[i]
+        total = 1.0 - miss
+        if total <= 0.0:
+            raise notEnoughTag(f"Not enough tags with positive weight ({len(picks)} found, {k} required)")
+        u = random.random() * total
+        chosen = None
+        miss = 1.0
+        for i in order:
+            w = probs[i] * miss
+            if w > 0.0:
+                chosen = i
+                if u < w:
+                    break
+                u -= w
+            miss *= 1.0 - probs[i]
+            if miss == 0.0:
+                break
+        picks.append(chosen)
+        kept[chosen] = True
+        start = chosen + 1
+    return picks
+
+
 class PromptProcessor:
+    # from_frequency_like でタグの組み合わせによって数が減ったときに引き直す最大回数
+    frequency_resample_limit: int = 32
+    # will_be_filtered の結果 (tag -> filtered)。設定の fingerprint が変わったら捨てる
+    verdict_cache_size: int = 200_000
+    _verdict_fingerprint: tuple | None = None
+    _verdicts: dict[str, bool] = {}
+    
     @classmethod
     async def single_proc(cls, p: str, proc_kw: dict = {}) -> bool:
         i = cls(p)
         return len(await i.process(**proc_kw)) > 0
     
+    @staticmethod
+    async def filter_fingerprint(proc_kw: dict = {}) -> tuple:
+        """
+        Everything a single-tag verdict depends on: the process() options and the
+        blacklist / filter rule / placeholder / character configuration in use.
+        """
+        if not placeholder.initialized:
+            await placeholder.init()
+        if not blacklist_filter_rules.initialized:
+            await blacklist_filter_rules.init()
+        special = proc_kw.get("special_blacklist") or []
+        return (
+            proc_kw.get("do_blacklist", True),
+            proc_kw.get("do_placeholder", True),
+            proc_kw.get("remove_character", False),
+            tuple((p.pattern, p.flags) if isinstance(p, Pattern) else (p, 0) for p in special),
+            setting.calculate_blacklist_hash(),
+            blacklist_filter_rules.revision,
+            placeholder.revision,
+            placeholder.script_signature(),
+            waic.revision,
+        )
+    
     @classmethod
     async def will_be_filtered(cls, tag: str, proc_kw: dict = {}) -> bool:
-        i = cls(tag)
-        res = await i.process(**proc_kw)
-        debug(f"[LoraPrompt] will_be_filtered: {tag} -> {res} ({len(res)})")
-        return len(res) == 0
+        fingerprint = await cls.filter_fingerprint(proc_kw)
+        # スクリプトの placeholder は乱数や full (プロンプト全体) で結果が変わりうるので、結果を覚えない
+        cacheable = not (proc_kw.get("do_placeholder", True) and placeholder.has_scripts())
+        if fingerprint != cls._verdict_fingerprint or len(cls._verdicts) >= cls.verdict_cache_size:
+            cls._verdict_fingerprint = fingerprint
+            cls._verdicts = {}
+        verdict = cls._verdicts.get(tag) if cacheable else None
+        if verdict is None:
+            i = cls(tag)
+            res = await i.process(**proc_kw)
+            debug(f"[LoraPrompt] will_be_filtered: {tag} -> {res} ({len(res)})")
+            verdict = len(res) == 0
+            if cacheable:
+                cls._verdicts[tag] = verdict
+        return verdict
 
     def __init__(self, prompt: str):
         self.prompt = Prompt(prompt)
@@ -34,9 +117,7 @@ class PromptProcessor:
         self,
         extra_blacklist: list[Pattern[str]] | None = None,
     ) -> Prompt:
-        blacklist = setting.obtain_blacklist()
-        if extra_blacklist:
-            blacklist = blacklist + list(extra_blacklist)
+        blacklist = setting.obtain_blacklist_matcher(extra_blacklist)
 
         # Apply filter rules to get keep_map
         keep_map = await blacklist_filter_rules.apply_filter_rules(self.prompt, blacklist)
@@ -216,32 +297,26 @@ class PromptProcessor:
         rt = sorted(rt, key=lambda x: x[1])
         if len(rt) < tags and disallow_duplicate:
             raise notEnoughTag(f"Not enough filtered tags found ({len(rt)} found, {tags} required)")
+        if tags > 0 and len(rt) == 0:
+            raise notEnoughTag(f"No tags left after filtering ({tags} required)")
         
-        tried = 0
-        proc = True
-        prompts = []
-        while proc:
+        probs = [weight for _, weight in rt]
+        res = []
+        for attempt in range(cls.frequency_resample_limit):
+            picks = sample_sequential(probs, tags, allow_duplicate=not disallow_duplicate)
             prompts = []
-            while len(prompts) < tags:
-                for (tag, weight) in rt:
-                    if len(prompts) >= tags:
-                        break
-                    if random.random() < weight:
-                        if disallow_duplicate and tag in prompts:
-                            continue
-                        if random.random() < prompt_weight_chance:
-                            tag = f"({tag}:{random.uniform(prompt_weight_min, prompt_weight_max):.2f})"
-                        prompts.append(tag)
-                    tried += 1
-                    if tried > max_tries*2:
-                        raise RuntimeError(f"Tried too many times to gather tags ({max_tries*2}), aborting")
+            for i in picks:
+                tag = rt[i][0]
+                if random.random() < prompt_weight_chance:
+                    tag = f"({tag}:{random.uniform(prompt_weight_min, prompt_weight_max):.2f})"
+                prompts.append(tag)
             res = await cls(combine_prompt(prompts)).process(**proc_kw)
-            if len(res) != tags:
-                debug(f"[FrequencyLike] Re-gathering tags, got {len(res)} tags, expected {tags}")
-                prompts.clear()
-            else:
-                proc = True
+            if len(res) == tags:
                 break
+            # 単体では通るタグ同士の組み合わせ (filter rule など) で減った場合だけ引き直す
+            debug(f"[FrequencyLike] Re-gathering tags, got {len(res)} tags, expected {tags}")
+        else:
+            raise RuntimeError(f"Tried too many times ({cls.frequency_resample_limit}) to gather tags, aborting")
         if not finalize:
             return res
         p = combine_prompt(res)
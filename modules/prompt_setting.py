@@ -2,6 +2,7 @@ import json
 import gradio as gr
 import re
 from logger import warn
+from modules.blacklist import BlacklistMatcher
 import os.path as op
 import os
 
@@ -93,6 +94,13 @@ class PromptSettingManager:
         self.blacklist_formatted = l
         return l
     
+    def obtain_blacklist_matcher(self, extra: list[re.Pattern] | None = None) -> BlacklistMatcher:
+        """obtain_blacklist() (+ extra) compiled into a single matcher (reused until the blacklist changes)"""
+        blacklist = self.obtain_blacklist()
+        if extra:
+            blacklist = blacklist + list(extra)
+        return BlacklistMatcher.from_patterns(blacklist)
+    
     async def setup(self) -> PromptSetting:
         opt = self.setting.copy()
         blacklist = opt.get("blacklist", "")
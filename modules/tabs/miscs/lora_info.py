@@ -5,6 +5,7 @@ import shared
 from typing import Any, Callable, Dict
 from utils import *
 
+from modules.utils.lora_index import lora_index
 from modules.utils.lora_util import list_lora, has_lora_tags, find_lora, read_lora_name, get_tag_freq_from_lora, LoRAMetadataReader, extract_external_lora_meta
 from modules.utils.ui.register import RegisterComponent, Path
 
@@ -302,6 +303,7 @@ class LoRAInfo(UiTabs):
             )
             
             def refresh_lora_list():
+                lora_index.refresh(wait=True)
                 return gr.update(choices=list_lora())
             
             refresh_btn.click(
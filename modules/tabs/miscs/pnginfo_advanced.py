@@ -30,13 +30,13 @@ class PngInfo(UiTabs):
                 raise gr.Error("Image has no metadata")
             info = img.info
             prompt = info.get("parameters", "").split("\nNegative prompt: ")[0].strip()
-            blacklist = setting.obtain_blacklist()
+            blacklist = setting.obtain_blacklist_matcher()
             
             filtered = []
             p = []
             for tag in prompt.split(","):
                 tag = tag.strip()
-                if not any(b.search(tag) for b in blacklist):
+                if not blacklist.matches(tag):
                     p.append(tag)
                 else:
                     filtered.append(tag)
@@ -6,7 +6,7 @@ from webui import UiTabs
 import gradio as gr
 from typing import Callable
 from modules.utils.browse import select_file, select_folder, select_folders
-from modules.calculator.inference import PromptInferenceEngine
+from modules.calculator.engine_cache import engine_cache
 
 class LoRAToPrompt(UiTabs):
   def title(self) -> str:
@@ -25,9 +25,10 @@ class LoRAToPrompt(UiTabs):
     async def generate_prompt(
       datadir, inputs, header, footer, temp, top_k, sim_thres, append_always_prompt,
       rating, rating_str, force_rating, negative, negative_strength, negative_thres, strict_negative,
+      mode, beam_width, time_budget,
     ) -> str:
       try:
-        engine = PromptInferenceEngine(datadir)
+        engine = await engine_cache.aget(datadir)
       except FileNotFoundError as e:
         return str(e)
       
@@ -43,6 +44,9 @@ class LoRAToPrompt(UiTabs):
         negative_strength=float("inf") if strict_negative else negative_strength,
         negative_threshold=negative_thres,
         append_always_tags=append_always_prompt,
+        mode=mode,
+        beam_width=int(beam_width),
+        time_budget=time_budget / 1000,
       )
     
       return combine_prompt(header, res, footer)
@@ -166,6 +170,39 @@ class LoRAToPrompt(UiTabs):
                 ),
               )
           
+          with gr.Row():
+            mode = r(
+              "mode",
+              gr.Dropdown(
+              label="Generation mode",
+              info="sample: independent softmax sampling / beam: beam search that also scores how well the picked tags fit together",
+              choices=["sample", "beam"],
+              value=d("mode", "sample"),
+              ),
+            )
+            beam_width = r(
+              "beam_width",
+              gr.Slider(
+              label="Beam width",
+              info="Partial prompts kept per step (beam mode only)",
+              minimum=1,
+              maximum=32,
+              value=d("beam_width", 4),
+              step=1,
+              ),
+            )
+            time_budget = r(
+              "time_budget",
+              gr.Slider(
+              label="Time budget (ms)",
+              info="Per prompt; the best beam is completed greedily when exceeded (beam mode only)",
+              minimum=1,
+              maximum=1000,
+              value=d("time_budget", 50),
+              step=1,
+              ),
+            )
+          
           with gr.Row():
             neg_str = r(
               "neg_str",
@@ -227,6 +264,7 @@ class LoRAToPrompt(UiTabs):
           inputs=[
             datapth, init, header, footer, temp, top_k, sim_thres, append_always_prompt,
             rating, rating_str, force_rating, init_neg, neg_str, neg_thres, strict_negative,
+            mode, beam_width, time_budget,
           ],
           outputs=output,
         )
@@ -287,17 +325,71 @@ class LoRAToPrompt(UiTabs):
               value=d("cconfidence", 0.7), label="Conflict confidence threshold", minimum=0.05, maximum=1.0, step=0.05
             ),
           )
-        proc = r(
-          "proc",
-          gr.Number(
-            value=d("proc", -1),
-            label="Processes to use (for training; set to -1 to auto-detect)",
-          ),
-        )
+        with gr.Row():
+          proc = r(
+            "proc",
+            gr.Number(
+              value=d("proc", -1),
+              label="Processes to use (for training; set to -1 to auto-detect)",
+            ),
+          )
+          workers = r(
+            "workers",
+            gr.Number(
+              value=d("workers", -1),
+              label="Worker processes (for matrices/conflicts; set to -1 to auto-detect)",
+            ),
+          )
+          embedding_dim = r(
+            "embedding_dim",
+            gr.Number(
+              value=d("embedding_dim", 0),
+              label="Tag embedding dimensions (SVD; used for similarity checks, 0 to disable)",
+            ),
+          )
+          incremental = r(
+            "incremental",
+            gr.Checkbox(
+              label="Incremental training",
+              info="Only process added/changed/removed images since the last training of this data file (checkpoints are kept in <data>.ckpt/, an interrupted training resumes from them)",
+              value=d("incremental", True),
+            ),
+          )
+        with gr.Row():
+          prune_min_pmi = r(
+            "prune_min_pmi",
+            gr.Number(
+              value=d("prune_min_pmi", None),
+              label="Prune: minimum PMI (empty to keep all; 0 drops negative associations)",
+            ),
+          )
+          prune_top_k = r(
+            "prune_top_k",
+            gr.Number(
+              value=d("prune_top_k", 0),
+              label="Prune: top-K pairs per tag (0 to keep all)",
+            ),
+          )
+          prune_min_count = r(
+            "prune_min_count",
+            gr.Number(
+              value=d("prune_min_count", 0),
+              label="Prune: minimum co-occurrence count (0 to keep all)",
+            ),
+          )
+          value_dtype = r(
+            "value_dtype",
+            gr.Dropdown(
+              label="Stored value precision",
+              info="float32/float16 store the PMI values as binary (much smaller files)",
+              choices=["float64", "float32", "float16"],
+              value=d("value_dtype", "float64"),
+            ),
+          )
         train_btn = gr.Button("Train database", variant="primary")
         
         train_log = gr.Textbox(label="log", lines=10, max_lines=200, interactive=False)
         train_btn.click(
-          fn=train, inputs=[dataset_directory, datapth, min_cocc, cconfidence, proc, ignore_questionable, booru_threshold], outputs=train_log, show_progress="minimal"
+          fn=train, inputs=[dataset_directory, datapth, min_cocc, cconfidence, proc, ignore_questionable, booru_threshold, incremental, workers, embedding_dim, prune_min_pmi, prune_top_k, prune_min_count, value_dtype], outputs=train_log, show_progress="minimal"
         )
         
\ No newline at end of file
@@ -1,54 +1,119 @@
 # https://github.com/lanner0403/WAI-NSFW-illustrious-character-select-EN
 import json
 import os
+from typing import Optional
 
 from modules.utils.prompt import Prompt
 from modules.utils.lora_util import is_lora_trigger
 
 from logger import println, debug, critical
 
+INDEX_HEADER = "# waic-index v1"
+
 class WAICharacters:
+    """
+    キャラクター名 (小文字・前後空白なし) の集合。
+
+    import 時には何も読まない。最初に使われたときに characters.json から
+    1 行 1 名の索引ファイル (characters.index) を作り、以降はそれを読むだけにする。
+    索引の 1 行目に元ファイルの (mtime_ns, size) を持ち、元ファイルが変わったら作り直す。
+    """
+
     def __init__(self):
-        self.data = []
-        self.characters: set[str] = set()
         self.path = "./models/characters.json"
+        self.index_path = "./models/characters.index"
         self.warn = False
-        
-        self.load()
-        
+        self._characters: Optional[frozenset[str]] = None
+        # load() のたびに増える (フィルタ結果のキャッシュの無効化に使う)
+        self.revision = 0
+
+    @property
+    def characters(self) -> frozenset[str]:
+        if self._characters is None:
+            self.load()
+        return self._characters
+
+    def _source_signature(self) -> Optional[str]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return f"{st.st_mtime_ns} {st.st_size}"
+
+    def _read_index(self, signature: str) -> Optional[frozenset[str]]:
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        header, _, body = data.partition("\n")
+        if header != f"{INDEX_HEADER} {signature}":
+            return None
+        return frozenset(body.split("\n")) - {""}
+
+    def _build_index(self, signature: str) -> frozenset[str]:
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        # Normalize character tokens to lower-case, trimmed entries
+        characters: set[str] = set()
+        for c in data.get("proj", []):
+            for t in c.get("title", "").split(","):
+                norm = t.strip().lower()
+                if norm:
+                    characters.add(norm)
+        tmp = self.index_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(f"{INDEX_HEADER} {signature}\n")
+                f.write("\n".join(sorted(characters)))
+            os.replace(tmp, self.index_path)
+        except OSError as e:
+            critical(f"[WAICharacters] Failed to write character index {self.index_path}: {e}")
+        return frozenset(characters)
+
     def load(self):
-        if os.path.exists(self.path):
-            with open(self.path, "r", encoding="utf-8") as f:
-                self.data = json.load(f)
-                # Normalize character tokens to lower-case, trimmed entries
-                characters: set[str] = set()
-                for c in self.data.get("proj", []):
-                    for t in c.get("title", "").split(","):
-                        norm = t.strip().lower()
-                        if norm:
-                            characters.add(norm)
-                self.characters = characters
-            println(f"[WAICharacters] Loaded {len(self.characters)} character identifies")
-        else:
+        signature = self._source_signature()
+        if signature is None:
             critical(f"Character data file not found at {self.path}")
             self.warn = True
-    
+            self._characters = frozenset()
+            return
+        characters = self._read_index(signature)
+        if characters is None:
+            characters = self._build_index(signature)
+            println(f"[WAICharacters] Built character index {self.index_path}")
+        self._characters = characters
+        self.warn = False
+        self.revision += 1
+        println(f"[WAICharacters] Loaded {len(self._characters)} character identifies")
+
+    def prepare_index(self):
+        """Build the persisted index if it is missing or stale, without keeping it in memory."""
+        signature = self._source_signature()
+        if signature is not None and self._read_index(signature) is None:
+            self._build_index(signature)
+            println(f"[WAICharacters] Built character index {self.index_path}")
+
     async def remove_character(self, prompt: Prompt) -> Prompt:
         # print("Removing character prompts...")
+        characters = self.characters
         if self.warn:
             critical("Character data not loaded. Cannot remove characters.")
             return prompt
-        
-        for p in list(prompt):
+
+        def keep(p) -> bool:
+            tag = p.text.strip().lower()
+            if not tag or tag not in characters:
+                return True
+            # LoRA トリガーは名前が一致しても残す (一致したときだけ正規表現を使う)
             if is_lora_trigger(p):
                 debug(f"[WAICharacters] Skipping LoRA trigger tag: {p.value}")
-                continue
-            tag = (p.text or "").strip().lower()
-            # debug(f"[WAICharacters] Checking tag: {p.value} -> {tag}")
-            if tag and tag in self.characters:
-                debug(f"[WAICharacters] Removed character tag: {p.value}")
-                prompt.remove(p)
+                return True
+            debug(f"[WAICharacters] Removed character tag: {p.value}")
+            return False
+
+        prompt.filter_inplace(keep)
         return prompt
-    
+
 
 waic = WAICharacters()
@@ -0,0 +1,266 @@
+"""
+LoRA library index (sqlite)
+
+LoRA の一覧・検索のたびにディレクトリ内の全ファイルを開かないよう、
+LoRA ディレクトリを走査した結果を sqlite に保存して、一覧と検索はそこに問い合わせる。
+
+- 起動時 (init_models) に裏で走査を始める。一度も走査が終わっていない索引に問い合わせた場合だけ
+  その走査を待つ (async なハンドラからは asyncio.to_thread で呼ぶこと)。以降は索引をそのまま返し、
+  最後の走査から refresh_interval 秒以上経っていれば裏で走査し直す
+- 走査は差分のみ: (mtime_ns, size) が変わったファイルだけを読み直し、消えたファイルは索引から消す。
+  読み直しは lora_metadata_cache を通す (一覧や学習で既に読んだファイルは開き直さない)
+- 保存するもの: ファイル名 / 出力名 / ベースモデル / ハッシュ (メタデータの sshs_*) /
+  プレビュー画像とサイドカー (.json) のパス / タグとタグ頻度
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Iterable, Optional
+
+from logger import info, warn, critical
+from shared import api_path
+from modules.utils.lora_util import lora_metadata_cache
+
+LORA_EXTENSIONS = (".safetensors", ".ckpt", ".pt")
+PREVIEW_SUFFIXES = (".png", ".preview.png", ".jpg", ".jpeg", ".preview.jpg", ".webp", ".preview.webp")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS loras (
+    fn TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    loadable INTEGER NOT NULL,
+    has_tags INTEGER NOT NULL,
+    base_model TEXT,
+    model_hash TEXT,
+    legacy_hash TEXT,
+    preview TEXT,
+    sidecar TEXT
+);
+CREATE TABLE IF NOT EXISTS lora_tags (
+    fn TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    frequency REAL NOT NULL,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lora_tags_tag ON lora_tags(tag);
+CREATE INDEX IF NOT EXISTS lora_tags_fn ON lora_tags(fn);
+CREATE INDEX IF NOT EXISTS loras_has_tags ON loras(has_tags, fn);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+# テーブルの形を変えたら上げる (古い索引は作り直す)
+SCHEMA_VERSION = "1"
+
+COLUMNS = ("fn", "path", "mtime_ns", "size", "name", "loadable", "has_tags",
+           "base_model", "model_hash", "legacy_hash", "preview", "sidecar")
+
+
+def _escape_like(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class LoRAIndex:
+    def __init__(
+        self,
+        db_path: str = "./models/lora_index.sqlite3",
+        roots: Optional[list[str]] = None,
+        refresh_interval: float = 30.0,
+        batch_size: int = 200,
+    ):
+        self.db_path = db_path
+        self.roots = roots if roots is not None else [os.path.join(api_path, "models/Lora")]
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+        # 走査は同時に 1 つだけ
+        self._scan_lock = threading.Lock()
+        self._last_check = 0.0
+
+    # --- connection / scanning ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            version = None
+            try:
+                version = conn.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()
+            except sqlite3.OperationalError:
+                pass
+            if version is None or version[0] != SCHEMA_VERSION:
+                conn.executescript("DROP TABLE IF EXISTS loras; DROP TABLE IF EXISTS lora_tags; DROP TABLE IF EXISTS meta;")
+                conn.executescript(SCHEMA)
+                conn.execute("INSERT INTO meta VALUES ('schema', ?)", (SCHEMA_VERSION,))
+                conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _ensure(self) -> sqlite3.Connection:
+        """Connection to an index that has been scanned at least once (refreshes in background when stale)."""
+        with self._lock:
+            conn = self._connect()
+            scanned = conn.execute("SELECT value FROM meta WHERE key = 'last_scan'").fetchone()
+        if scanned is None:
+            self.scan()
+        elif time.monotonic() - self._last_check > self.refresh_interval:
+            self.refresh(wait=False)
+        return conn
+
+    def refresh(self, wait: bool = True) -> None:
+        """Rescan the LoRA directories (in a background thread when wait=False)."""
+        self._last_check = time.monotonic()
+        if wait:
+            self.scan()
+            return
+        if self._scan_lock.locked():
+            return
+        threading.Thread(target=self.scan, daemon=True, name="lora-index").start()
+
+    def _list_files(self) -> dict[str, tuple[str, int, int, Optional[str], Optional[str]]]:
+        """{fn: (path, mtime_ns, size, preview, sidecar)} of the LoRA files in the roots"""
+        files = {}
+        for root in self.roots:
+            try:
+                with os.scandir(root) as it:
+                    dir_entries = [e for e in it if e.is_file()]
+            except FileNotFoundError:
+                warn(f"[LoRAIndex] LoRA directory not found: {root}")
+                continue
+            names = {e.name for e in dir_entries}
+            for e in dir_entries:
+                if e.name in files or not e.name.endswith(LORA_EXTENSIONS):
+                    continue
+                st = e.stat()
+                stem = os.path.splitext(e.name)[0]
+                preview = next((stem + s for s in PREVIEW_SUFFIXES if stem + s in names), None)
+                sidecar = stem + ".json" if stem + ".json" in names else None
+                files[e.name] = (
+                    e.path, st.st_mtime_ns, st.st_size,
+                    os.path.join(root, preview) if preview else None,
+                    os.path.join(root, sidecar) if sidecar else None,
+                )
+        return files
+
+    def scan(self) -> int:
+        """Incrementally update the index. Returns the number of (re)read files."""
+        with self._scan_lock:
+            self._last_check = time.monotonic()
+            t = time.perf_counter()
+            files = self._list_files()
+            with self._lock:
+                conn = self._connect()
+                known = {
+                    row[0]: row[1:]
+                    for row in conn.execute("SELECT fn, path, mtime_ns, size, preview, sidecar FROM loras")
+                }
+
+            removed = [fn for fn in known if fn not in files]
+            moved = []
+            changed = []
+            for fn, (path, mtime_ns, size, preview, sidecar) in files.items():
+                old = known.get(fn)
+                if old is None or old[:3] != (path, mtime_ns, size):
+                    changed.append(fn)
+                elif old[3:] != (preview, sidecar):
+                    moved.append((preview, sidecar, fn))
+
+            with self._lock:
+                conn.executemany("DELETE FROM loras WHERE fn = ?", [(fn,) for fn in removed])
+                conn.executemany("DELETE FROM lora_tags WHERE fn = ?", [(fn,) for fn in removed])
+                conn.executemany("UPDATE loras SET preview = ?, sidecar = ? WHERE fn = ?", moved)
+                conn.commit()
+
+            # ファイルの読み込みはロックの外で行い、batch_size ごとに書き込む (途中経過も検索できる)
+            for i in range(0, len(changed), self.batch_size):
+                rows, tags = [], []
+                for fn in changed[i:i + self.batch_size]:
+                    path, _, _, preview, sidecar = files[fn]
+                    try:
+                        entry = lora_metadata_cache.get(path)
+                    except Exception as e:
+                        critical(f"[LoRAIndex] Failed to read {path}: {e}")
+                        continue
+                    # 走査後に書き換えられていても、実際に読んだときのシグネチャを残す
+                    mtime_ns, size = entry["sig"]
+                    rows.append((
+                        fn, path, mtime_ns, size, entry["name"], int(entry["loadable"]), int(entry["has_tags"]),
+                        entry["base_model"], entry["model_hash"], entry["legacy_hash"], preview, sidecar,
+                    ))
+                    for source in ("tag_frequency", "ss_tag_frequency"):
+                        for tag, freq in entry[source].items():
+                            if isinstance(freq, (int, float)):
+                                tags.append((fn, tag, freq, source))
+                with self._lock:
+                    batch = [(r[0],) for r in rows]
+                    conn.executemany("DELETE FROM lora_tags WHERE fn = ?", batch)
+                    conn.executemany(f"INSERT OR REPLACE INTO loras VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+                    conn.executemany("INSERT INTO lora_tags VALUES (?, ?, ?, ?)", tags)
+                    conn.commit()
+
+            with self._lock:
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('last_scan', ?)", (str(time.time()),))
+                conn.commit()
+            if changed or removed:
+                info(
+                    f"[LoRAIndex] Indexed {len(changed)} changed / {len(removed)} removed LoRA(s) "
+                    f"({len(files)} total) in {time.perf_counter() - t:.2f}s"
+                )
+            return len(changed)
+
+    # --- queries ---
+
+    def _rows(self, sql: str, params: Iterable[Any] = ()) -> list[dict[str, Any]]:
+        conn = self._ensure()
+        with self._lock:
+            cursor = conn.execute(sql, tuple(params))
+            keys = [c[0] for c in cursor.description]
+            return [dict(zip(keys, row)) for row in cursor.fetchall()]
+
+    def names(self, with_tags: bool = False) -> list[str]:
+        """File names of the indexed LoRAs (only the ones with tag frequency metadata if with_tags)."""
+        conn = self._ensure()
+        sql = "SELECT fn FROM loras WHERE has_tags = 1 ORDER BY fn" if with_tags else "SELECT fn FROM loras ORDER BY fn"
+        with self._lock:
+            return [row[0] for row in conn.execute(sql)]
+
+    def get(self, fn: str) -> Optional[dict[str, Any]]:
+        rows = self._rows("SELECT * FROM loras WHERE fn = ?", (os.path.basename(fn),))
+        return rows[0] if rows else None
+
+    def search(
+        self,
+        query: str = "",
+        tags: Iterable[str] = (),
+        with_tags: bool = False,
+        limit: int = 100,
+    ) -> list[dict[str, Any]]:
+        """
+        LoRAs whose file name or output name contains `query` (case-insensitive)
+        and that were trained with all of `tags`.
+        """
+        where, params = [], []
+        if query:
+            like = f"%{_escape_like(query)}%"
+            where.append("(fn LIKE ? ESCAPE '\\' OR name LIKE ? ESCAPE '\\')")
+            params += [like, like]
+        for tag in tags:
+            where.append("fn IN (SELECT fn FROM lora_tags WHERE tag = ?)")
+            params.append(tag)
+        if with_tags:
+            where.append("has_tags = 1")
+        sql = "SELECT * FROM loras"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY fn LIMIT ?"
+        params.append(int(limit))
+        return self._rows(sql, params)
+
+
+lora_index = LoRAIndex()
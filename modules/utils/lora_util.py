@@ -2,17 +2,51 @@ import os
 import json
 import re
 import os.path as op
+import threading
 import traceback
+import atexit
+import struct
 from typing import *
 from shared import api_path
 from logger import *
-from legacy.modules.lora_metadata_util import LoRAMetadataReader
-from safetensors import safe_open
 from modules.utils.prompt import PromptPiece
 from pathlib import Path
 from PIL import Image
 
 LORA_TRIGGER_PATTERN = r"^\<lora\:(.*)?\>$"
+# safetensors のヘッダー上限 (safetensors 本体と同じ 100MB)
+SAFETENSORS_MAX_HEADER = 100_000_000
+
+class SafetensorsHeaderError(ValueError):
+    pass
+
+def read_safetensors_header(fp: str | os.PathLike) -> tuple[dict[str, str], list[str]]:
+    """
+    safetensors の先頭 (8 byte のヘッダー長 + JSON ヘッダー) だけを読み、(__metadata__, テンソル名) を返す。
+    torch も safetensors も使わず、テンソル本体は読まない。
+    raise: SafetensorsHeaderError 壊れている / 途中で切れている場合
+    """
+    with open(fp, "rb") as f:
+        prefix = f.read(8)
+        if len(prefix) < 8:
+            raise SafetensorsHeaderError(f"file is too short to be safetensors ({len(prefix)} bytes)")
+        (length,) = struct.unpack("<Q", prefix)
+        size = os.fstat(f.fileno()).st_size
+        if length < 2 or length > SAFETENSORS_MAX_HEADER or 8 + length > size:
+            raise SafetensorsHeaderError(f"invalid header length {length} for a file of {size} bytes")
+        raw = f.read(length)
+    if len(raw) < length:
+        raise SafetensorsHeaderError("header is truncated")
+    try:
+        header = json.loads(raw)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise SafetensorsHeaderError(f"header is not valid JSON: {e}") from None
+    if not isinstance(header, dict):
+        raise SafetensorsHeaderError("header is not a JSON object")
+    metadata = header.pop("__metadata__", None) or {}
+    if not isinstance(metadata, dict) or not all(isinstance(v, str) for v in metadata.values()):
+        raise SafetensorsHeaderError("__metadata__ must map strings to strings")
+    return metadata, list(header.keys())
 
 class LoRAMetadataReader:
     def __init__(self, fp):
@@ -20,15 +54,12 @@ class LoRAMetadataReader:
         self.fp = fp
         self.fn = os.path.basename(fp)
         self.metadata = {}
+        self.keys = []
         try:
-            with safe_open(os.path.abspath(fp), framework="pt") as f:
-                self.metadata = f.metadata()
-                self.keys = list(f.keys())
-                self.loadable = True
-                #print(f"[DEV]: [metadata]: {self.metadata}")
-        except Exception:
-            critical(f"[ERROR]: Error occurred in parse safetensors")
-            traceback.print_exc()
+            self.metadata, self.keys = read_safetensors_header(os.path.abspath(fp))
+            self.loadable = True
+        except (OSError, SafetensorsHeaderError) as e:
+            critical(f"[ERROR]: Error occurred in parse safetensors ({fp}): {e}")
 
     def detect_model_ver(self):
         """"""
@@ -102,6 +133,171 @@ class LoRAMetadataReader:
             traceback.print_exc()
             return "Unknown model"
 
+def _flatten_tag_frequency(raw: str) -> dict[str, Any]:
+    """ss_tag_frequency / tag_frequency ({dataset: {tag: n}} or {tag: n}) を {tag: n} にする"""
+    r = {}
+    for k, v in json.loads(raw).items():
+        if isinstance(v, int):
+            r[k] = v
+        elif isinstance(v, dict) or isinstance(v, str):
+            if isinstance(v, str):
+                v = json.loads(v)
+            for sub_k, sub_v in v.items():
+                r[sub_k] = sub_v
+    return r
+
+def _file_signature(fp: str) -> Optional[list[int]]:
+    try:
+        st = os.stat(fp)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+class LoRAMetadataCache:
+    """
+    LoRA ファイルから読んだ情報のプロセス共有キャッシュ
+
+    キーは絶対パス、ファイルの (mtime_ns, size) が変わったときだけ safetensors を読み直す。
+    保持するもの: 読めたかどうか / 出力名 (ss_output_name) / タグ頻度 (展開済み) / 学習画像数 /
+    サイドカー (<name>.json) の内容 (こちらは .json 自体の (mtime_ns, size) で読み直す)
+
+    内容は cache_path に保存し、次回起動時に読み込む (書き込みは少し遅らせてまとめる)。
+    """
+
+    # エントリの形式を変えたら上げる (古いキャッシュは捨てて読み直す)
+    VERSION = 2
+
+    def __init__(self, cache_path: str = "./models/lora_metadata_cache.json", flush_delay: float = 2.0):
+        self.cache_path = cache_path
+        self.flush_delay = flush_delay
+        self._entries: Optional[dict[str, dict]] = None
+        self._sidecars: dict[str, dict] = {}
+        self._lock = threading.RLock()
+        self._flush_timer: Optional[threading.Timer] = None
+        atexit.register(self.flush)
+
+    def _load_persisted(self) -> dict[str, dict]:
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                self._sidecars = data.get("sidecars", {})
+                return data.get("entries", {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            warn(f"[LoRAMetadataCache] Ignoring broken cache file {self.cache_path}: {e}")
+        return {}
+
+    def _schedule_flush(self) -> None:
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_delay, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self) -> None:
+        with self._lock:
+            timer, self._flush_timer = self._flush_timer, None
+            if timer is None or self._entries is None:
+                return
+            timer.cancel()
+            data = {"version": self.VERSION, "entries": self._entries, "sidecars": self._sidecars}
+            tmp = self.cache_path + ".tmp"
+            try:
+                os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+                os.replace(tmp, self.cache_path)
+            except OSError as e:
+                critical(f"[LoRAMetadataCache] Failed to write {self.cache_path}: {e}")
+
+    @staticmethod
+    def read_entry(fp: str, signature: list[int]) -> dict:
+        """Parse the LoRA file into a cache entry (always reads the file)."""
+        entry = {
+            "sig": signature,
+            "loadable": False,
+            "name": op.splitext(op.basename(fp))[0],
+            "base_model": "Unknown model",
+            "model_hash": None,
+            "legacy_hash": None,
+            "has_tags": False,
+            "tag_frequency": {},
+            "ss_tag_frequency": {},
+            "train_images": None,
+        }
+        if not fp.endswith(".safetensors"):
+            return entry
+        reader = LoRAMetadataReader(fp)
+        if not reader.loadable:
+            return entry
+        metadata = reader.metadata or {}
+        entry["loadable"] = True
+        output_name = metadata.get("ss_output_name", None)
+        if output_name is not None:
+            entry["name"] = output_name
+        entry["base_model"] = reader.detect_base_model_for_ui()
+        # kohya sd-scripts が書き込むハッシュ (ファイル全体を読まずに済む)
+        entry["model_hash"] = metadata.get("sshs_model_hash")
+        entry["legacy_hash"] = metadata.get("sshs_legacy_hash")
+        raw_ss = metadata.get("ss_tag_frequency", "{}")
+        raw_tag = metadata.get("tag_frequency", "{}")
+        entry["has_tags"] = raw_ss != "{}" or raw_tag != "{}"
+        try:
+            entry["ss_tag_frequency"] = _flatten_tag_frequency(raw_ss)
+            entry["tag_frequency"] = _flatten_tag_frequency(raw_tag)
+        except Exception as e:
+            critical(f"[LoRAMetadataCache] Broken tag frequency in {fp}: {e}")
+        try:
+            entry["train_images"] = json.loads(metadata["ss_datasets"])[0].get("num_train_images", 1)
+        except Exception:
+            pass
+        return entry
+
+    def get(self, fp: str | os.PathLike) -> dict:
+        """Cached entry of the LoRA file (read the file again only when it changed)."""
+        key = os.path.abspath(fp)
+        signature = _file_signature(key)
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load_persisted()
+            entry = self._entries.get(key)
+            if entry is not None and entry["sig"] == signature:
+                return entry
+        if signature is None:
+            raise FileNotFoundError(f"LoRA file not found at {key}")
+        entry = self.read_entry(key, signature)
+        with self._lock:
+            self._entries[key] = entry
+            self._schedule_flush()
+        return entry
+
+    def sidecar(self, fp: str | os.PathLike) -> Optional[dict]:
+        """Contents of <name>.json next to the LoRA (None when missing or unreadable)."""
+        key = op.splitext(os.path.abspath(fp))[0] + ".json"
+        signature = _file_signature(key)
+        if signature is None:
+            return None
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load_persisted()
+            cached = self._sidecars.get(key)
+            if cached is not None and cached["sig"] == signature:
+                return cached["data"]
+        try:
+            with open(key, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            critical(f"Error reading LoRA info from {key}: {e}")
+            traceback.print_exc()
+            return None
+        with self._lock:
+            self._sidecars[key] = {"sig": signature, "data": data}
+            self._schedule_flush()
+        return data
+
+lora_metadata_cache = LoRAMetadataCache()
+
 async def find_lora(lora_name: str, allow_none: bool = True) -> Optional[str | os.PathLike]:
     r"""渡されたLoRA名をシンプルに models/Lora から探す
     
@@ -150,56 +346,18 @@ async def extract_external_lora_meta(lora_path: str) -> dict:
 async def get_tag_freq_from_lora(lora_name: str, test_frequency: bool = False) -> tuple[dict[str, int]]:
   """[tag_freq, ss_tag_freq]の形式で返す"""
   lora = await find_lora(lora_name, allow_none=False)
-  metadata = LoRAMetadataReader(lora)
+  entry = lora_metadata_cache.get(lora)
   if not test_frequency:
-    tf = {}
-    sstf = {}
-    if not metadata.loadable:
+    if not entry["loadable"]:
         critical(f"LoRA '{lora_name}' is not loadable")
-        return tf, sstf
-    
-    tag_freq = json.loads(metadata.metadata.get("ss_tag_frequency", "{}"))
-    ss_freq = json.loads(metadata.metadata.get("tag_frequency", "{}"))
-    for k, v in tag_freq.items():
-      if isinstance(v, int):
-        tf[k] = v
-      elif isinstance(v, dict) or isinstance(v, str):
-        if isinstance(v, str):
-          v = json.loads(v)
-        for sub_k, sub_v in v.items():
-          tf[sub_k] = sub_v
-    for k, v in ss_freq.items():
-      if isinstance(v, int):
-        sstf[k] = v
-      elif isinstance(v, dict) or isinstance(v, str):
-        if isinstance(v, str):
-          v = json.loads(v)
-        for sub_k, sub_v in v.items():
-          sstf[sub_k] = sub_v
-    return tf, sstf
+        return {}, {}
+    return dict(entry["ss_tag_frequency"]), dict(entry["tag_frequency"])
   
-  relative_tag_freq = {}
-  relative_ss_tag_freq = {}
-  tag_freq = json.loads(metadata.metadata.get("tag_frequency", "{}"))
-  ss_tag_freq = json.loads(metadata.metadata.get("ss_tag_frequency", "{}"))
-  dataset_info = json.loads(metadata.metadata.get("ss_datasets", "{[{}]}"))
-  train_images = dataset_info[0].get("num_train_images", 1)
-  for k, v in tag_freq.items():
-    if isinstance(v, int):
-      relative_tag_freq[k] = v / train_images if v > 0 else 0
-    elif isinstance(v, dict) or isinstance(v, str):
-      if isinstance(v, str):
-        v = json.loads(v)
-      for sub_k, sub_v in v.items():
-        relative_tag_freq[sub_k] = sub_v / train_images if sub_v > 0 else 0
-  for k, v in ss_tag_freq.items():
-    if isinstance(v, int):
-      relative_ss_tag_freq[k] = v / train_images if v > 0 else 0
-    elif isinstance(v, dict) or isinstance(v, str):
-      if isinstance(v, str):
-        v = json.loads(v)
-      for sub_k, sub_v in v.items():
-        relative_ss_tag_freq[sub_k] = sub_v / train_images if sub_v > 0 else 0
+  train_images = entry["train_images"]
+  if train_images is None:
+    raise ValueError(f"LoRA '{lora_name}' has no ss_datasets to compute relative frequency")
+  relative_tag_freq = {k: v / train_images if v > 0 else 0 for k, v in entry["tag_frequency"].items()}
+  relative_ss_tag_freq = {k: v / train_images if v > 0 else 0 for k, v in entry["ss_tag_frequency"].items()}
   return relative_tag_freq, relative_ss_tag_freq
 
 async def read_lora_name(lora_name: str, allow_none: bool = True) -> str:
@@ -209,12 +367,12 @@ async def read_lora_name(lora_name: str, allow_none: bool = True) -> str:
         if allow_none:
             return ""
         raise FileNotFoundError(f"LoRA '{lora_name}' not found")
-    meta = LoRAMetadataReader(lora)
-    if not meta.loadable:
+    entry = lora_metadata_cache.get(lora)
+    if not entry["loadable"]:
         if allow_none:
             return ""
         raise ValueError(f"LoRA '{lora_name}' is not loadable")
-    output = meta.get_output_name()
+    output = entry["name"]
     if output is None:
         if allow_none:
             return ""
@@ -228,16 +386,8 @@ async def read_lora_info(lora_name: str, allow_none: bool = True, keysafe: bool
         if allow_none:
             return None
         raise FileNotFoundError(f"LoRA '{lora_name}' not found")
+    d = dict(lora_metadata_cache.sidecar(lora) or {})
     lora = lora.replace(".safetensors", "")
-    
-    d = {}
-    if os.path.exists(lora+".json"):
-        try:
-            with open(lora+".json", "r", encoding="utf-8") as f:
-                d = json.load(f)
-        except Exception as e:
-            critical(f"Error reading LoRA info from {lora+'.json'}: {e}")
-            traceback.print_exc()
     if os.path.exists(lora+".png"):
         try:
             d["image"] = lora+".png"
@@ -252,13 +402,9 @@ async def read_lora_info(lora_name: str, allow_none: bool = True, keysafe: bool
     return d if d != {} else None
 
 def list_lora() -> list[str]:
-    """LoRA一覧を取得する"""
-    lora_dir = os.path.join(api_path, "models/Lora")
-    lora_files = [
-        f for f in os.listdir(lora_dir)
-        if f.endswith(".safetensors") or f.endswith(".ckpt") or f.endswith(".pt")
-    ]
-    return lora_files
+    """LoRA一覧を取得する (LoRA 索引から)"""
+    from modules.utils.lora_index import lora_index
+    return lora_index.names()
 
 def has_lora_tags(lora_name: str) -> bool:
     r"""Check if a LoRA has tag metadata
@@ -286,23 +432,17 @@ def has_lora_tags(lora_name: str) -> bool:
         if not os.path.exists(lora_path):
             return False
         
-        metadata = LoRAMetadataReader(lora_path)
-        if not metadata.loadable:
-            return False
-        
         # Check if tag frequency metadata exists
-        has_ss_tag = metadata.metadata.get("ss_tag_frequency", "{}") != "{}"
-        has_tag = metadata.metadata.get("tag_frequency", "{}") != "{}"
-        
-        return has_ss_tag or has_tag
+        entry = lora_metadata_cache.get(lora_path)
+        return entry["loadable"] and entry["has_tags"]
     except Exception as e:
         critical(f"Error checking tags for LoRA '{lora_name}': {e}")
         return False
 
 def list_lora_with_tags() -> list[str]:
     """LoRA一覧を取得する (タグを持つもののみ)"""
-    all_loras = list_lora()
-    return [lora for lora in all_loras if has_lora_tags(lora)]
+    from modules.utils.lora_index import lora_index
+    return lora_index.names(with_tags=True)
   
 def is_lora_trigger(tag: str | PromptPiece) -> bool:
     if isinstance(tag, str):
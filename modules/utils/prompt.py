@@ -83,6 +83,34 @@ def _compose_prompt_piece(components: dict[str, Union[str, bool, None]]) -> str:
     return f"{prefix}{body}{suffix}"
 
 
+# 同じタグは毎回同じ形に分解されるので、分解結果 (components, weight) を共有する。
+# components の dict は共有されるため変更してはいけない (変更するときは dict() でコピーする)
+_PARSE_CACHE: dict[str, tuple[dict[str, Union[str, bool, None]], float]] = {}
+_PARSE_CACHE_SIZE = 65536
+
+
+def _parse_piece(piece: str) -> tuple[dict[str, Union[str, bool, None]], float]:
+    parsed = _PARSE_CACHE.get(piece)
+    if parsed is not None:
+        return parsed
+    if ":" not in piece:
+        # 重みも LoRA 構文も持たない普通のタグ
+        parsed = ({
+            "prefix": "",
+            "text": piece.strip(),
+            "weight": None,
+            "suffix": "",
+            "explicit": False,
+        }, 1.0)
+    else:
+        components = _split_prompt_piece(piece)
+        parsed = (components, _weight_token_to_float(components.get("weight")))
+    if len(_PARSE_CACHE) >= _PARSE_CACHE_SIZE:
+        _PARSE_CACHE.clear()
+    _PARSE_CACHE[piece] = parsed
+    return parsed
+
+
 def disweight(piece: str) -> tuple[str, float]:
     components = _split_prompt_piece(piece)
     text = components.get("text", "") or ""
@@ -90,7 +118,20 @@ def disweight(piece: str) -> tuple[str, float]:
     return text, weight_val
 ###################
 
+# clone() で共有中 (書き込む前にコピーが必要) の印
+_SHARED_SNAPSHOTS = 1
+_SHARED_META = 2
+
+
 class PromptPiece:
+    """
+    One comma separated piece of a prompt.
+
+    履歴・スナップショット・meta は使われるまで確保しない (None)。
+    履歴は tuple なのでそのまま共有し、スナップショットと meta は clone() で共有して
+    最初に書き込む側がコピーする (copy-on-write)。
+    """
+
     __slots__ = (
         "raw",
         "_current",
@@ -102,20 +143,21 @@ class PromptPiece:
         "_raw_weight",
         "position",
         "_meta",
+        "_shared",
     )
 
     def __init__(self, piece: str):
         piece_str = str(piece)
         self.raw = piece_str
         self._current = piece_str
-        self._history: list[tuple[Optional[str], str]] = []
-        self._snapshots: dict[str, tuple[str, int]] = {}
-        self._components = _split_prompt_piece(piece_str)
-        self._raw_components = dict(self._components)
-        self._weight = _weight_token_to_float(self._components.get("weight"))
+        self._history: Optional[tuple[tuple[Optional[str], str], ...]] = None
+        self._snapshots: Optional[dict[str, tuple[str, int]]] = None
+        self._components, self._weight = _parse_piece(piece_str)
+        self._raw_components = self._components
         self._raw_weight = self._weight
         self.position: Optional[int] = None
-        self._meta: dict[str, Any] = {}
+        self._meta: Optional[dict[str, Any]] = None
+        self._shared = 0
 
     def __str__(self) -> str:
         return self._current
@@ -157,14 +199,37 @@ class PromptPiece:
         return self._current != self.raw
 
     def _refresh_state(self) -> None:
-        self._components = _split_prompt_piece(self._current)
-        self._weight = _weight_token_to_float(self._components.get("weight"))
+        self._components, self._weight = _parse_piece(self._current)
+
+    def _push_history(self, source: Optional[str], previous: str) -> None:
+        entry = ((source, previous),)
+        self._history = self._history + entry if self._history else entry
+
+    def _history_len(self) -> int:
+        return len(self._history) if self._history else 0
+
+    def _own_snapshots(self) -> dict[str, tuple[str, int]]:
+        if self._shared & _SHARED_SNAPSHOTS:
+            self._snapshots = dict(self._snapshots)
+            self._shared &= ~_SHARED_SNAPSHOTS
+        elif self._snapshots is None:
+            self._snapshots = {}
+        return self._snapshots
+
+    def _own_meta(self) -> dict[str, Any]:
+        # 値 (list など) は呼び出し側で変更されることがあるので deepcopy する
+        if self._shared & _SHARED_META:
+            self._meta = deepcopy(self._meta)
+            self._shared &= ~_SHARED_META
+        elif self._meta is None:
+            self._meta = {}
+        return self._meta
 
     def set(self, value: str, *, source: Optional[str] = None, allow_duplicate: bool = False) -> str:
         value = str(value)
         if not allow_duplicate and value == self._current:
             return self._current
-        self._history.append((source, self._current))
+        self._push_history(source, self._current)
         self._current = value
         self._refresh_state()
         return self._current
@@ -173,7 +238,7 @@ class PromptPiece:
         current = self._current
         updated = current.replace(old, new, count)
         if updated != current:
-            self._history.append((source, current))
+            self._push_history(source, current)
             self._current = updated
             self._refresh_state()
         return self._current
@@ -181,45 +246,48 @@ class PromptPiece:
     def revert(self, *, to_raw: bool = False) -> str:
         if to_raw:
             self._current = self.raw
-            self._history.clear()
-            self._snapshots.clear()
-            self._components = dict(self._raw_components)
+            self._history = None
+            self._snapshots = None
+            self._shared &= ~_SHARED_SNAPSHOTS
+            self._components = self._raw_components
             self._weight = self._raw_weight
             return self._current
         if self._history:
-            _, previous = self._history.pop()
+            _, previous = self._history[-1]
+            self._history = self._history[:-1]
             self._current = previous
             self._refresh_state()
         return self._current
 
     def snapshot(self, label: str) -> None:
-        self._snapshots[label] = (self._current, len(self._history))
+        self._own_snapshots()[label] = (self._current, self._history_len())
 
     def restore(self, label: str, *, discard: bool = True) -> bool:
-        snapshot = self._snapshots.get(label)
+        snapshot = self._snapshots.get(label) if self._snapshots else None
         if snapshot is None:
             return False
         text, history_len = snapshot
         self._current = text
-        while len(self._history) > history_len:
-            self._history.pop()
+        if self._history_len() > history_len:
+            self._history = self._history[:history_len] or None
         if discard:
-            self._snapshots.pop(label, None)
+            self._own_snapshots().pop(label, None)
         self._refresh_state()
         return True
 
     def changed_since(self, label: str) -> bool:
-        snapshot = self._snapshots.get(label)
+        snapshot = self._snapshots.get(label) if self._snapshots else None
         if snapshot is None:
             return True
         text, history_len = snapshot
-        return self._current != text or len(self._history) != history_len
+        return self._current != text or self._history_len() != history_len
 
     def forget_snapshot(self, label: str) -> None:
-        self._snapshots.pop(label, None)
+        if self._snapshots and label in self._snapshots:
+            self._own_snapshots().pop(label, None)
 
     def history(self) -> list[tuple[Optional[str], str]]:
-        return list(self._history)
+        return list(self._history) if self._history else []
 
     def set_text(self, text: str, *, source: Optional[str] = None) -> str:
         sanitized = text.strip()
@@ -227,7 +295,7 @@ class PromptPiece:
             return self._current
         new_components = dict(self._components)
         new_components["text"] = sanitized
-        self._history.append((source, self._current))
+        self._push_history(source, self._current)
         self._current = _compose_prompt_piece(new_components)
         self._refresh_state()
         return self._current
@@ -246,7 +314,7 @@ class PromptPiece:
         new_components = dict(self._components)
         new_components["weight"] = weight_token
         new_components["explicit"] = True
-        self._history.append((source, self._current))
+        self._push_history(source, self._current)
         self._current = _compose_prompt_piece(new_components)
         self._refresh_state()
         self._weight = weight_value
@@ -258,7 +326,7 @@ class PromptPiece:
         new_components = dict(self._components)
         new_components["weight"] = None
         new_components["explicit"] = False
-        self._history.append((source, self._current))
+        self._push_history(source, self._current)
         self._current = _compose_prompt_piece(new_components)
         self._refresh_state()
         return self._current
@@ -274,36 +342,56 @@ class PromptPiece:
         new_components = dict(self._components)
         new_components["weight"] = original_weight_token
         new_components["explicit"] = True
-        self._history.append((source, self._current))
+        self._push_history(source, self._current)
         self._current = _compose_prompt_piece(new_components)
         self._refresh_state()
         return self._current
 
     def clone(self) -> "PromptPiece":
-        cloned = PromptPiece(self.raw)
+        # 再分解せずにスロットを写す。スナップショットと meta は共有し、書き込む側がコピーする
+        cloned = PromptPiece.__new__(PromptPiece)
+        cloned.raw = self.raw
         cloned._current = self._current
-        cloned._components = dict(self._components)
-        cloned._raw_components = dict(self._raw_components)
+        cloned._history = self._history
+        cloned._components = self._components
+        cloned._raw_components = self._raw_components
         cloned._weight = self._weight
         cloned._raw_weight = self._raw_weight
         cloned.position = self.position
-        cloned._meta = deepcopy(self._meta)
+        shared = 0
+        if self._snapshots:
+            cloned._snapshots = self._snapshots
+            shared |= _SHARED_SNAPSHOTS
+        else:
+            cloned._snapshots = None
+        if self._meta:
+            cloned._meta = self._meta
+            shared |= _SHARED_META
+        else:
+            cloned._meta = None
+        cloned._shared = shared
+        self._shared |= shared
         return cloned
 
     def set_meta(self, key: str, value: Any) -> None:
-        self._meta[key] = value
+        self._own_meta()[key] = value
 
     def get_meta(self, key: str, default: Any = None) -> Any:
-        return self._meta.get(key, default)
+        if not self._meta:
+            return default
+        return self._own_meta().get(key, default)
 
     def ensure_meta(self, key: str, default: Any) -> Any:
-        return self._meta.setdefault(key, default)
+        return self._own_meta().setdefault(key, default)
 
     def pop_meta(self, key: str, default: Any = None) -> Any:
-        return self._meta.pop(key, default)
+        if not self._meta:
+            return default
+        return self._own_meta().pop(key, default)
 
     def clear_meta(self) -> None:
-        self._meta.clear()
+        self._meta = None
+        self._shared &= ~_SHARED_META
     
 class Prompt:
     __slots__ = ("raw", "_pieces")
@@ -0,0 +1,299 @@
+"""
+Segmented, zstd-compressed append-only log of JSON records
+
+root/
+  000001.zst   確定したセグメント: 独立した zstd フレームの連結 (1 フレーム = chunk_records 件程度の JSONL)
+  000001.idx   セグメントの索引: フレームごとに 1 行 {"o": offset, "n": 長さ, "c": 件数, "t0": 最小時刻, "t1": 最大時刻}
+  tail.jsonl   まだフレームにしていないレコード (クラッシュしても失わないように 1 件ずつ追記)
+
+- 追記は tail.jsonl に 1 行書くだけ。chunk_records 件 (か chunk_bytes) たまったら圧縮して
+  現在のセグメントにフレームとして追記し、索引に 1 行足して tail を空にする
+- セグメントが segment_bytes を超えたら次のセグメントに移る
+- 時間範囲の読み出しは索引 (小さい) を見て、範囲に掛かるフレームだけを展開する
+- レコードの位置 (segment, フレームの offset, フレーム内の行) は追記順で、一度付いたら変わらない。
+  tail のレコードには次のフレームが書かれる位置を先に割り当てる (seal と同じ規則で決まる)
+"""
+
+import json
+import os
+import threading
+import zlib
+from typing import Any, Iterator, Optional
+
+# (segment, フレームの offset, フレーム内の行番号)
+Position = tuple[int, int, int]
+
+import zstandard
+
+from logger import warn
+
+
+class SegmentedLog:
+    def __init__(
+        self,
+        root: str,
+        ts_key: str | tuple[str, ...] = "ts",
+        chunk_records: int = 256,
+        chunk_bytes: int = 1 << 20,
+        segment_bytes: int = 8 << 20,
+        level: int = 9,
+    ):
+        """ts_key: レコードの時刻 (UNIX 秒) が入っているキー (複数なら最初に見つかったもの)"""
+        self.root = root
+        self.ts_keys = (ts_key,) if isinstance(ts_key, str) else tuple(ts_key)
+        self.chunk_records = chunk_records
+        self.chunk_bytes = chunk_bytes
+        self.segment_bytes = segment_bytes
+        self.level = level
+        self._lock = threading.RLock()
+        self._opened = False
+        self._tail: list[str] = []
+        self._tail_bytes = 0
+        self._segment = 1
+
+    # --- paths ---
+
+    def _segment_path(self, n: int) -> str:
+        return os.path.join(self.root, f"{n:06d}.zst")
+
+    def _index_path(self, n: int) -> str:
+        return os.path.join(self.root, f"{n:06d}.idx")
+
+    @property
+    def tail_path(self) -> str:
+        return os.path.join(self.root, "tail.jsonl")
+
+    def segment_numbers(self) -> list[int]:
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(int(fn[:-4]) for fn in os.listdir(self.root) if fn.endswith(".zst") and fn[:-4].isdigit())
+
+    # --- writing ---
+
+    def _open(self) -> None:
+        if self._opened:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        segments = self.segment_numbers()
+        self._segment = segments[-1] if segments else 1
+        if segments:
+            self._repair(self._segment)
+        # 前回 flush されなかったレコードを読み戻す (途中で切れた最後の行は捨てる)
+        if os.path.exists(self.tail_path):
+            with open(self.tail_path, "r", encoding="utf-8") as f:
+                lines = f.read().split("\n")
+            for line in lines:
+                if not line:
+                    continue
+                try:
+                    json.loads(line)
+                except json.JSONDecodeError:
+                    warn(f"[SegmentedLog] Dropping a broken record in {self.tail_path}")
+                    continue
+                self._tail.append(line)
+                self._tail_bytes += len(line) + 1
+            last = self._read_index(self._segment)[-1:] if segments else []
+            if self._tail and last and last[0].get("h") == self._chunk_hash(self._tail):
+                # フレームと索引は書けたが tail を空にする前に落ちた
+                self._tail, self._tail_bytes = [], 0
+            with open(self.tail_path, "w", encoding="utf-8") as f:
+                f.writelines(line + "\n" for line in self._tail)
+        self._opened = True
+
+    @staticmethod
+    def _chunk_hash(lines: list[str]) -> int:
+        return zlib.crc32(("\n".join(lines) + "\n").encode("utf-8"))
+
+    def _repair(self, n: int) -> None:
+        """
+        書き込み途中で落ちた索引の行と、索引に載っていないフレームを末尾から切り捨てる。
+        切れた行を残すと次の seal がその続きに書いてしまい、以降のフレームが読めなくなる。
+        (切り捨てたフレームのレコードは tail.jsonl に残っているので、次の seal で書き直される)
+        """
+        index_path = self._index_path(n)
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                data = f.read()
+            valid = 0
+            for line in data.splitlines(keepends=True):
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    json.loads(line)
+                except ValueError:
+                    break
+                valid += len(line)
+            if valid < len(data):
+                warn(f"[SegmentedLog] Truncating a broken line at the end of {index_path}")
+                with open(index_path, "r+b") as f:
+                    f.truncate(valid)
+        end = 0
+        for frame in self._read_index(n):
+            end = max(end, frame["o"] + frame["n"])
+        path = self._segment_path(n)
+        if os.path.getsize(path) > end:
+            warn(f"[SegmentedLog] Truncating an unindexed frame at the end of {path}")
+            with open(path, "r+b") as f:
+                f.truncate(end)
+
+    def append(self, record: dict[str, Any]) -> None:
+        """Append one record (one small write; compression happens once per chunk)."""
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._open()
+            with open(self.tail_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self._tail.append(line)
+            self._tail_bytes += len(line) + 1
+            if len(self._tail) >= self.chunk_records or self._tail_bytes >= self.chunk_bytes:
+                self.seal()
+
+    def seal(self) -> None:
+        """Compress the pending records into one frame of the current segment."""
+        with self._lock:
+            self._open()
+            if not self._tail:
+                return
+            times = [t for t in (self.record_ts(json.loads(line)) for line in self._tail) if t is not None]
+            data = zstandard.ZstdCompressor(level=self.level).compress(("\n".join(self._tail) + "\n").encode("utf-8"))
+            self._segment, _ = self._next_frame()
+            path = self._segment_path(self._segment)
+            with open(path, "ab") as f:
+                offset = f.tell()
+                f.write(data)
+            frame = {
+                "o": offset, "n": len(data), "c": len(self._tail), "h": self._chunk_hash(self._tail),
+                "t0": min(times) if times else None, "t1": max(times) if times else None,
+            }
+            # 索引の 1 行が書けた時点でフレームが確定する
+            with open(self._index_path(self._segment), "a", encoding="utf-8") as f:
+                f.write(json.dumps(frame) + "\n")
+            open(self.tail_path, "w").close()
+            self._tail = []
+            self._tail_bytes = 0
+
+    def _next_frame(self) -> tuple[int, int]:
+        """(segment, offset) the next sealed frame will be written at (tail positions use this too)."""
+        path = self._segment_path(self._segment)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size >= self.segment_bytes:
+            return self._segment + 1, 0
+        return self._segment, size
+
+    # --- reading ---
+
+    def record_ts(self, record: dict) -> Optional[float]:
+        for key in self.ts_keys:
+            ts = record.get(key)
+            if isinstance(ts, (int, float)):
+                return float(ts)
+        return None
+
+    def _read_index(self, n: int) -> list[dict]:
+        path = self._index_path(n)
+        if not os.path.exists(path):
+            return []
+        frames = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    frames.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+        return frames
+
+    def segments(self) -> list[dict[str, Any]]:
+        """Summary of each segment: number, bytes, records and time range."""
+        r = []
+        for n in self.segment_numbers():
+            frames = self._read_index(n)
+            t0 = [f["t0"] for f in frames if f["t0"] is not None]
+            t1 = [f["t1"] for f in frames if f["t1"] is not None]
+            r.append({
+                "segment": n,
+                "bytes": os.path.getsize(self._segment_path(n)),
+                "frames": len(frames),
+                "records": sum(f["c"] for f in frames),
+                "t0": min(t0) if t0 else None,
+                "t1": max(t1) if t1 else None,
+            })
+        return r
+
+    @staticmethod
+    def _overlaps(t0: Optional[float], t1: Optional[float], start: Optional[float], end: Optional[float]) -> bool:
+        if t0 is None or t1 is None:
+            return True
+        return (start is None or t1 >= start) and (end is None or t0 < end)
+
+    def _in_range(self, record: dict, start: Optional[float], end: Optional[float]) -> bool:
+        if start is None and end is None:
+            return True
+        ts = self.record_ts(record)
+        if ts is None:
+            return False
+        return (start is None or ts >= start) and (end is None or ts < end)
+
+    def read_positions(
+        self, start: Optional[float] = None, end: Optional[float] = None, after: Optional[Position] = None,
+    ) -> Iterator[tuple[Position, str]]:
+        """
+        (position, raw JSON line) of the frames overlapping [start, end) in append order (records are not filtered),
+        only the ones after `after` when given.
+        範囲に掛かるフレームだけを 1 つずつ展開する (全体をメモリに載せない)。after より前のフレームは展開しない。
+        """
+        with self._lock:
+            self._open()
+            # 読んでいる間に seal されても重複しないよう、索引と tail (とその位置) を同時に写しておく
+            tail = list(self._tail)
+            tail_frame = self._next_frame()
+            segments = [(n, self._read_index(n)) for n in self.segment_numbers()]
+        dctx = zstandard.ZstdDecompressor()
+        for n, index in segments:
+            frames = [
+                f for f in index
+                if self._overlaps(f["t0"], f["t1"], start, end) and (after is None or (n, f["o"]) >= after[:2])
+            ]
+            if not frames:
+                continue
+            with open(self._segment_path(n), "rb") as fp:
+                for frame in frames:
+                    fp.seek(frame["o"])
+                    text = dctx.decompress(fp.read(frame["n"])).decode("utf-8")
+                    lines = [line for line in text.split("\n") if line]
+                    for i, line in enumerate(lines):
+                        pos = (n, frame["o"], i)
+                        if after is None or pos > after:
+                            yield pos, line
+        for i, line in enumerate(tail):
+            pos = (*tail_frame, i)
+            if after is None or pos > after:
+                yield pos, line
+
+    def read_lines(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[str]:
+        """Raw JSON lines of the frames overlapping [start, end) in append order (records are not filtered)."""
+        for _, line in self.read_positions(start, end):
+            yield line
+
+    def read(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[dict]:
+        """Records with start <= ts < end in append order (None: unbounded)."""
+        for line in self.read_lines(start, end):
+            record = json.loads(line)
+            if self._in_range(record, start, end):
+                yield record
+
+    def import_jsonl(self, path: str) -> int:
+        """Append the records of a plain JSONL log, then rename it to <path>.migrated."""
+        count = 0
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+                count += 1
+        self.seal()
+        os.replace(path, path + ".migrated")
+        return count